@@ -49,7 +49,7 @@ async def connection_node(state: dict) -> dict:
                 connections.append({
                     "filename": mat_obj.filename,
                     "reason":   r.get("reason", "Semantic conceptual link found."),
-                    "score":    round(1.0 - (r.get("score", 0.5)), 2), # Convert distance to similarity
+                    "score":    round(r.get("score", 0.0), 2), # FAISSStore score is already cosine similarity
                     "snippet":  r.get("chunk_text", "")[:200] + "..."
                 })
                 seen_mats.add(m_id)
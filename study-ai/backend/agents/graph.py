@@ -4,12 +4,13 @@ import logging
 import os
 from typing import Any, Optional, TypedDict, List
 
+import numpy as np
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, END
 
 from agents.parser import parse_node
 from agents.extractor import extract_node
-from agents.retriever import retrieve_node
+from agents.retriever import QUERY_CHUNKS, retrieve_node
 from agents.connections import connection_node
 from agents.summarizer import summarize_node
 from agents.quiz_gen import quiz_node
@@ -31,9 +32,10 @@ class PipelineState(TypedDict):
     material_id: str
     db: Any
     chunks: List[str]
+    chunk_pages: List[Optional[int]]  # page each chunk came from, None if unknown
     metadata: dict
     concepts: List[dict]
-    embeddings: List[Any]
+    embeddings: Any  # float32 array, one row for each of the first QUERY_CHUNKS chunks
     faiss_ids: List[str]
     related: List[dict]
     connections: List[str]
@@ -46,11 +48,25 @@ class PipelineState(TypedDict):
     pipeline_quiz_id: Optional[int]
 
 
-# ─── Embed + Index nodes ──────────────────────────────────────────────────────
+# ─── Embed + Index node ───────────────────────────────────────────────────────
+
+# Encoded chunks buffered before they are written to the user's index
+EMBED_INDEX_FLUSH = int(os.getenv("EMBED_INDEX_FLUSH", "512"))
+
 
 async def embed_node(state: PipelineState) -> PipelineState:
-    """Generate embeddings for all chunks using sentence-transformers."""
-    from tools.embedder import generate_embeddings
+    """
+    Embed all chunks and stream them into the per-user FAISS index.
+    Chunks are encoded in length buckets (see length_batches), so batches
+    pad little, and every EMBED_INDEX_FLUSH encoded chunks are indexed
+    straight away, so a whole textbook is never held as vector lists.
+    Chunks whose text the user's store already holds (e.g. the same slides
+    uploaded as PDF and DOCX) reuse the stored vector, and repeats within
+    the upload are encoded once. A failure removes what was indexed; should
+    the store be migrated to another embedding model mid-upload, the upload
+    starts over with the new model.
+    """
+    from tools.faiss_store import ModelChanged, get_store
 
     chunks = state.get("chunks", [])
     if not chunks:
@@ -58,46 +74,90 @@ async def embed_node(state: PipelineState) -> PipelineState:
         return state
 
     await _push(state, "embed", "running", "Generating embeddings…")
-    # Run CPU-bound encoding in a thread so the event loop stays free
-    loop = asyncio.get_event_loop()
-    embeddings = await loop.run_in_executor(None, generate_embeddings, chunks)
-    state["embeddings"] = embeddings
-    log.info("embed_node: embedded %d chunks", len(embeddings))
-    await _push(state, "embed", "done", f"Embedded {len(embeddings)} chunks")
+    store = await asyncio.get_running_loop().run_in_executor(None, get_store, state["user_id"])
+    for attempt in range(2):
+        try:
+            return await _embed_and_index(state, store)
+        except ModelChanged:
+            if attempt:
+                raise
+            log.info("embed_node: store moved to %s mid-upload, re-embedding", store.model.key)
     return state
 
 
-async def index_node(state: PipelineState) -> PipelineState:
-    """Add embeddings to the per-user FAISS index and persist to disk."""
-    from tools.faiss_store import FAISSStore
+async def _embed_and_index(state: PipelineState, store) -> PipelineState:
+    from tools.chunk_table import content_hash
+    from tools.embed_service import embed_texts, length_batches
+    from tools.faiss_store import user_write_lock
 
-    embeddings  = state.get("embeddings", [])
-    chunks      = state.get("chunks", [])
+    chunks      = state["chunks"]
+    pages       = state.get("chunk_pages") or [None] * len(chunks)
     material_id = state.get("material_id")
     user_id     = state.get("user_id")
-
-    if not embeddings:
-        log.warning("index_node: no embeddings to index, skipping")
-        return state
-
-    await _push(state, "index", "running", "Indexing into FAISS…")
-
-    store = FAISSStore(user_id)
-    store.load()
-
-    meta_list = [
-        {
-            "material_id": material_id,
-            "chunk_text":  chunk,
-            "chunk_index": i,
-            "embedding":   emb,
-        }
-        for i, (chunk, emb) in enumerate(zip(chunks, embeddings))
-    ]
-    ids = store.add(embeddings, meta_list)
-    state["faiss_ids"] = ids
-    log.info("index_node: indexed %d vectors", len(ids))
-    await _push(state, "index", "done", f"Indexed {len(ids)} vectors")
+    model       = store.model
+    # Store lookups and writes run on a thread and encoding on the embedding pool, so the event loop stays free
+    loop = asyncio.get_running_loop()
+    known = await loop.run_in_executor(None, store.find_duplicates, chunks)
+
+    # Only the rows retrieve_node searches with are kept; the rest are dropped once indexed
+    head = np.zeros((min(len(chunks), QUERY_CHUNKS), model.dim), dtype="float32")
+    faiss_ids: list = [None] * len(chunks)
+    pending: dict[int, np.ndarray] = {}  # chunk index → vector, until the next flush adds them
+    copies: dict[int, list[int]] = {}  # content hash → indices in chunks; the first one is encoded
+    for i, chunk in enumerate(chunks):
+        if i in known:
+            pending[i] = known[i]  # referenced, not re-added, by store.add
+        else:
+            copies.setdefault(content_hash(chunk) or -i - 1, []).append(i)  # text-less chunks are never merged
+    groups = list(copies.values())
+
+    async def flush(rows: dict[int, np.ndarray]):
+        meta_list = [{"material_id": material_id, "chunk_text": chunks[i], "chunk_index": i, "page": pages[i]}
+                     for i in rows]
+        vectors = np.stack(list(rows.values())).astype("float32", copy=False)
+        # Uploads of one user parse and embed in parallel; only their writes queue up here
+        async with user_write_lock(user_id):
+            ids = await loop.run_in_executor(None, store.add, vectors, meta_list, model)
+        for i, vid in zip(rows, ids):
+            faiss_ids[i] = vid
+            if i < len(head):
+                head[i] = rows[i]
+
+    def encode(batch: list[int]):
+        # Uncached: repeats of stored chunks are caught by content hash (find_duplicates) instead
+        return asyncio.ensure_future(embed_texts([chunks[groups[p][0]] for p in batch], model.name, cache=False))
+
+    batches = length_batches([chunks[g[0]] for g in groups])
+    encoded = 0
+    # The next bucket encodes while this one is indexed
+    next_batch = encode(batches[0]) if batches else None
+    try:
+        for n, batch in enumerate(batches):
+            vectors = np.asarray(await next_batch, dtype="float32")
+            next_batch = encode(batches[n + 1]) if n + 1 < len(batches) else None
+            for p, vec in zip(batch, vectors):
+                for i in groups[p]:
+                    pending[i] = vec
+            encoded += len(batch)
+            if len(pending) >= EMBED_INDEX_FLUSH:
+                await flush(pending)
+                pending = {}
+            await _push(state, "embed", "running", f"Embedded {encoded}/{len(groups)} chunks")
+        if pending:
+            await flush(pending)
+    except BaseException:
+        if next_batch is not None:
+            next_batch.cancel()
+        if any(vid is not None for vid in faiss_ids):
+            async with user_write_lock(user_id):
+                await loop.run_in_executor(None, store.delete_by_material, material_id)
+        raise
+
+    state["embeddings"] = head
+    state["faiss_ids"]  = faiss_ids
+    log.info("embed_node: embedded %d chunks, reused %d", encoded, len(chunks) - encoded)
+    await _push(state, "embed", "done", f"Embedded {encoded} chunks ({len(chunks) - encoded} already indexed)")
+    await _push(state, "index", "done", f"Indexed {len(faiss_ids)} vectors")
     return state
 
 
@@ -118,7 +178,6 @@ workflow = StateGraph(PipelineState)
 workflow.add_node("parse",         parse_node)
 workflow.add_node("extract",       extract_node)
 workflow.add_node("embed",         embed_node)
-workflow.add_node("index",         index_node)
 workflow.add_node("retrieve",      retrieve_node)
 workflow.add_node("connect",       connection_node)
 workflow.add_node("summarize",     summarize_node)
@@ -130,8 +189,7 @@ workflow.add_node("analyze",       analytics_node)
 workflow.set_entry_point("parse")
 workflow.add_edge("parse",         "extract")
 workflow.add_edge("extract",       "embed")
-workflow.add_edge("embed",         "index")
-workflow.add_edge("index",         "retrieve")
+workflow.add_edge("embed",         "retrieve")
 workflow.add_edge("retrieve",      "connect")
 workflow.add_edge("connect",       "summarize")
 workflow.add_edge("summarize",     "quiz")
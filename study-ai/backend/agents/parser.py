@@ -1,31 +1,191 @@
 """StudyAI — Document parser agent node."""
 import asyncio
+import multiprocessing
+import os
 import re
-from typing import Any
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterable, Iterator, Optional
 
+# Chunks smaller than this carry too little context to be worth embedding
+MIN_CHUNK  = 100
+# Chunks larger than this are sub-split on sentence boundaries into ~SPLIT_SIZE pieces
+MAX_CHUNK  = 1500
+SPLIT_SIZE = 800
+# Chunks parsed per executor call; progress is reported between calls
+PARSE_PROGRESS_CHUNKS = int(os.getenv("PARSE_PROGRESS_CHUNKS", "256"))
+# PDFs with at least this many pages are extracted in page ranges on a process pool; 0 never does
+PARSE_PARALLEL_PAGES  = int(os.getenv("PARSE_PARALLEL_PAGES", "64"))
+PARSE_RANGE_PAGES     = int(os.getenv("PARSE_RANGE_PAGES", "16"))
+# Extraction processes; 0 uses one per core
+PARSE_WORKERS         = int(os.getenv("PARSE_WORKERS", "0"))
 
-def _extract_text(file_path: str, ext: str) -> str:
-    """Synchronous text extraction — safe to run in a thread executor."""
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+# ─── Block extraction ─────────────────────────────────────────────────────────
+
+_workers = PARSE_WORKERS or os.cpu_count() or 1
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _parse_pool() -> ProcessPoolExecutor:
+    """The page extraction pool, spawned on first use (uploads parse on several threads at once)."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def shutdown():
+    """Stop the page extraction pool; it is spawned again if needed."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _extract_pages(file_path: str, start: int, stop: int) -> list[str]:
+    """Text of pages [start, stop) of a PDF (what extraction pool workers execute)."""
+    import fitz  # PyMuPDF
+    with fitz.open(file_path) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
+
+
+def _iter_pdf_parallel(file_path: str, page_count: int) -> Iterator[tuple[int, str]]:
+    """
+    Yield (page, text) for every page, extracting PARSE_RANGE_PAGES-page
+    ranges on the pool. A few ranges per worker are in flight at a time,
+    so memory stays bounded while results are yielded in page order.
+    """
+    pool = _parse_pool()
+    ahead = 2 * _workers
+    starts = iter(range(0, page_count, PARSE_RANGE_PAGES))
+    pending: deque = deque()
+    try:
+        while True:
+            while len(pending) < ahead and (start := next(starts, None)) is not None:
+                stop = min(start + PARSE_RANGE_PAGES, page_count)
+                pending.append((start, pool.submit(_extract_pages, file_path, start, stop)))
+            if not pending:
+                return
+            start, future = pending.popleft()
+            for offset, text in enumerate(future.result()):
+                yield start + offset + 1, text
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def iter_blocks(file_path: str, ext: str) -> Iterator[tuple[Optional[int], str]]:
+    """
+    Yield (page, text) blocks of a document one at a time — synchronous, run
+    it on a thread. PDFs yield one block per page, DOCX and TXT/MD one per
+    paragraph, so only one block is held at once. PDFs of PARSE_PARALLEL_PAGES
+    or more pages are extracted in parallel page ranges, still in order. page is 1-based: PDF pages,
+    DOCX page breaks, form feeds in text files; None when unknown.
+    """
     if ext == "pdf":
         import fitz  # PyMuPDF
-        doc = fitz.open(file_path)
-        text = "\n\n".join(page.get_text() for page in doc)
-        doc.close()
-        return text
+        with fitz.open(file_path) as doc:
+            if PARSE_PARALLEL_PAGES and doc.page_count >= PARSE_PARALLEL_PAGES:
+                page_count = doc.page_count
+            else:
+                page_count = 0
+                for number, page in enumerate(doc, start=1):
+                    yield number, page.get_text()
+        if page_count:
+            yield from _iter_pdf_parallel(file_path, page_count)
     elif ext in ("docx", "doc"):
+        # python-docx parses the whole XML up front; paragraphs are still chunked one at a time
         from docx import Document
-        doc = Document(file_path)
-        return "\n\n".join(p.text for p in doc.paragraphs if p.text.strip())
+        page = 1
+        for p in Document(file_path).paragraphs:
+            page += len(p._p.xpath('.//w:br[@w:type="page"]'))
+            if p.text.strip():
+                yield page, p.text
     else:  # txt, md
+        page, lines = 1, []
         with open(file_path, "r", encoding="utf-8", errors="replace") as f:
-            return f.read()
+            for line in f:
+                *done, line = line.split("\f")
+                for before in done:  # form feed: the page ends here
+                    lines.append(before)
+                    yield page, "".join(lines)
+                    page, lines = page + 1, []
+                if line.strip():
+                    lines.append(line)
+                elif lines:
+                    yield page, "".join(lines)
+                    lines = []
+        if lines:
+            yield page, "".join(lines)
+
+
+# ─── Chunking ─────────────────────────────────────────────────────────────────
+
+def _split_sentences(chunk: str) -> Iterator[str]:
+    """Sub-split an oversized chunk into ~SPLIT_SIZE pieces on sentence-end punctuation."""
+    current = ""
+    for sent in re.split(r"(?<=[.!?])\s+", chunk):
+        if len(current) + len(sent) + 1 <= SPLIT_SIZE:
+            current = (current + " " + sent).strip()
+        else:
+            if current:
+                yield current
+            current = sent
+    if current:
+        yield current
+
+
+def chunk_blocks(blocks: Iterable[tuple[Optional[int], str]]) -> Iterator[tuple[str, Optional[int]]]:
+    """
+    Turn (page, text) blocks into (chunk, page) pairs as they arrive: split
+    on blank lines, keep paragraphs of at least MIN_CHUNK chars and sub-split
+    those over MAX_CHUNK. A document with no paragraph long enough becomes
+    one chunk, so that case alone buffers its (short) text.
+    """
+    short: Optional[list] = []  # block texts, kept until the first chunk is yielded
+    first_page = None
+    for page, text in blocks:
+        if short is not None:
+            short.append(text)
+            first_page = first_page if first_page is not None else page
+        for para in _PARAGRAPH_BREAK.split(text):
+            para = para.strip()
+            if len(para) < MIN_CHUNK:
+                continue
+            for chunk in ([para] if len(para) <= MAX_CHUNK else _split_sentences(para)):
+                if len(chunk) >= MIN_CHUNK:
+                    short = None
+                    yield chunk, page
+    if short:
+        text = "\n\n".join(short).strip()
+        if text:
+            yield text, first_page
+
+
+def _take(chunks: Iterator[tuple[str, Optional[int]]], n: int) -> list:
+    """Up to n more (chunk, page) pairs from the stream."""
+    return [pair for _, pair in zip(range(n), chunks)]
 
 
+# ─── Parser node ──────────────────────────────────────────────────────────────
+
 async def parse_node(state: dict) -> dict:
     """
     Parse uploaded file into text chunks.
     Supports PDF (PyMuPDF), DOCX (python-docx), and plain TXT/MD.
     Chunks must be at least 100 characters to be useful for embedding.
+    The file is read a page (or paragraph) at a time, and the page each
+    chunk came from is kept in state["chunk_pages"].
     """
     file_path: str = state.get("file_path", "")
     filename: str  = state.get("filename", "")
@@ -34,50 +194,31 @@ async def parse_node(state: dict) -> dict:
 
     ext = filename.lower().rsplit(".", 1)[-1] if "." in filename else "txt"
 
+    chunks: list[str] = []
+    pages: list[Optional[int]] = []
+    stream = chunk_blocks(iter_blocks(file_path, ext))
     try:
         # Run blocking file I/O in a thread so the event loop stays free
         loop = asyncio.get_event_loop()
-        raw_text = await loop.run_in_executor(None, _extract_text, file_path, ext)
+        while True:
+            batch = await loop.run_in_executor(None, _take, stream, PARSE_PROGRESS_CHUNKS)
+            for chunk, page in batch:
+                chunks.append(chunk)
+                pages.append(page)
+            if len(batch) < PARSE_PROGRESS_CHUNKS:
+                break
+            where = f" (page {pages[-1]})" if pages[-1] is not None else ""
+            await _push(state, "parse", "running", f"Parsed {len(chunks)} chunks{where}…")
     except Exception as exc:
         state["error"] = f"Parse error: {exc}"
         await _push(state, "parse", "error", f"Failed to parse: {exc}")
         return state
+    finally:
+        stream.close()
 
-    # Split on blank lines, keep chunks ≥100 chars
-    raw_chunks = [c.strip() for c in re.split(r"\n\s*\n", raw_text)]
-    chunks = [c for c in raw_chunks if len(c) >= 100]
-
-    # If no chunks (e.g. very short doc), treat full text as one chunk
-    if not chunks and raw_text.strip():
-        chunks = [raw_text.strip()]
-
-    # Sub-split any chunk that is too large (>1500 chars) into ~800-char pieces
-    # by splitting on sentence boundaries so context stays coherent
-    MAX_CHUNK = 1500
-    SPLIT_SIZE = 800
-    refined: list[str] = []
-    for chunk in chunks:
-        if len(chunk) <= MAX_CHUNK:
-            refined.append(chunk)
-        else:
-            # Split on sentence-end punctuation
-            sentences = re.split(r"(?<=[.!?])\s+", chunk)
-            current = ""
-            for sent in sentences:
-                if len(current) + len(sent) + 1 <= SPLIT_SIZE:
-                    current = (current + " " + sent).strip()
-                else:
-                    if current:
-                        refined.append(current)
-                    current = sent
-            if current:
-                refined.append(current)
-    chunks = [c for c in refined if len(c) >= 100]
-    if not chunks and raw_text.strip():
-        chunks = [raw_text.strip()]
-
-    state["chunks"]   = chunks
-    state["metadata"] = {"filename": filename, "chunk_count": len(chunks)}
+    state["chunks"]      = chunks
+    state["chunk_pages"] = pages
+    state["metadata"]    = {"filename": filename, "chunk_count": len(chunks)}
 
     # Update material chunk_count in DB
     db = state.get("db")
@@ -1,5 +1,7 @@
 """StudyAI — Quiz generation agent node."""
+import asyncio
 from datetime import datetime
+from functools import partial
 
 
 async def quiz_node(state: dict) -> dict:
@@ -19,19 +21,21 @@ async def quiz_node(state: dict) -> dict:
     await _push(state, "quiz", "running", "Generating quiz questions…")
 
     from tools.quiz_tool import generate_questions
-    from tools.embedder import generate_embedding
-    from tools.faiss_store import FAISSStore
+    from tools.embed_service import embed_for_store
+    from tools.faiss_store import get_store
     from database import Quiz
 
-    store = FAISSStore(user_id)
-    store.load()
+    loop = asyncio.get_running_loop()
+    store = await loop.run_in_executor(None, get_store, user_id)
+
+    # RAG: one batched embed + search for every concept name, the search on a thread like the load
+    top_concepts = concepts[:8]
+    embs = await embed_for_store(store, [c["name"] for c in top_concepts])
+    grouped = await loop.run_in_executor(None, partial(store.search_many, embs, top_k=3, material_id=material_id))
 
     all_questions = []
-    for concept in concepts[:8]:
-        # RAG: Search for relevant context using concept name
-        emb = generate_embedding(concept["name"])
-        results = store.search(query_embedding=emb, top_k=3, exclude_material=None)
-        context = "\n".join([r.get("chunk_text", "") for r in results if r.get("material_id") == material_id])
+    for concept, results in zip(top_concepts, grouped):
+        context = "\n".join([r.get("chunk_text", "") for r in results])
 
         qs = await generate_questions(
             concept_name=concept["name"],
@@ -1,27 +1,31 @@
 """StudyAI — FAISS semantic retriever agent node."""
 import asyncio
 import os
+from functools import partial
 
 from groq import RateLimitError
 from langchain_groq import ChatGroq
 
+# Leading chunks of an upload whose embeddings search for related material
+QUERY_CHUNKS = 5
+
 
 async def retrieve_node(state: dict) -> dict:
     """
     Find related content from other materials using FAISS similarity search.
-    Searches using the first 10 chunk embeddings.
+    Searches using the embeddings of the first QUERY_CHUNKS chunks.
     Results exclude the current material to avoid self-retrieval.
     """
     embeddings  = state.get("embeddings", [])
     user_id     = state.get("user_id")
     material_id = state.get("material_id")
 
-    if not embeddings or not user_id:
+    if len(embeddings) == 0 or not user_id:
         state["related"] = []
         return state
 
     await _push(state, "retrieve", "running", "Searching related knowledge…")
-    from tools.faiss_store import FAISSStore
+    from tools.faiss_store import ModelChanged, get_store
     from database import StudyMaterial
 
     _llm = ChatGroq(
@@ -35,14 +39,20 @@ async def retrieve_node(state: dict) -> dict:
     mat = db.query(StudyMaterial).filter(StudyMaterial.id == material_id).first() if db else None
     ctx = f"File: {mat.filename}\nSummary: {mat.summary[:200]}" if mat and mat.summary else ""
 
-    store = FAISSStore(user_id)
-    store.load()
+    # Store loads and searches may wait on its locks, so they run on a thread, not the event loop
+    loop  = asyncio.get_running_loop()
+    store = await loop.run_in_executor(None, get_store, user_id)
 
     seen_ids = set()
     related  = []
 
-    for emb in embeddings[:5]:
-        results = store.search(query_embedding=emb, top_k=3, exclude_material=material_id)
+    try:
+        grouped = await loop.run_in_executor(
+            None, partial(store.search_many, embeddings[:QUERY_CHUNKS], top_k=3, exclude_material=material_id),
+        )
+    except ModelChanged:  # the store moved to another embedding model since these were computed
+        grouped = []
+    for results in grouped:
         for r in results:
             vid = r.get("_vector_id")
             if vid and vid not in seen_ids:
@@ -1,5 +1,6 @@
 """StudyAI — FastAPI application entry point with WebSocket pipeline streaming."""
 import asyncio
+import logging
 import os
 
 from dotenv import load_dotenv
@@ -7,6 +8,7 @@ from fastapi import FastAPI, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 
 load_dotenv()
+log = logging.getLogger(__name__)
 
 app = FastAPI(
     title="StudyAI",
@@ -102,6 +104,10 @@ async def ws_pipeline(
 
 # ─── Startup ─────────────────────────────────────────────────────────────────
 
+# Background tasks started at startup; the loop only keeps weak references, so they are held here
+_background_tasks: set = set()
+
+
 @app.on_event("startup")
 async def startup():
     from database import init_db
@@ -112,19 +118,70 @@ async def startup():
     os.makedirs(upload_path, exist_ok=True)
     os.makedirs(faiss_path,  exist_ok=True)
 
+    # Start the embedding workers and warm their models in the background; /health reports when ready
+    if os.getenv("EMBEDDER_WARMUP", "1") == "1":
+        from tools.embed_service import warmup
+        task = asyncio.get_running_loop().create_task(warmup())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    # Re-embed stores built with another model than EMBEDDING_MODEL, one at a time, while they keep serving
+    if os.getenv("EMBEDDING_MIGRATION", "1") == "1":
+        from tools.model_migration import migrate_stores
+        task = asyncio.get_running_loop().create_task(migrate_stores(_user_ids()))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        task.add_done_callback(_migration_done)
+
     print("✅ StudyAI backend ready on http://localhost:8000")
     print("   Docs: http://localhost:8000/docs")
 
 
+def _migration_done(task: asyncio.Task):
+    """Log a migration run that did not finish; stores it didn't reach are migrated at the next start."""
+    if task.cancelled():
+        log.warning("Embedding migration stopped before it finished")
+    elif task.exception() is not None:
+        log.error("Embedding migration failed", exc_info=task.exception())
+
+
+def _user_ids() -> list[str]:
+    from database import SessionLocal, User
+    db = SessionLocal()
+    try:
+        return [str(uid) for (uid,) in db.query(User.id).all()]
+    finally:
+        db.close()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    from agents.parser import shutdown as stop_parse_pool
+    from tools.embed_service import shutdown as stop_embedding_pool
+    # Stop warmup and migration before the pools they run on; a migration only cuts a store over once it is complete
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    stop_embedding_pool()
+    stop_parse_pool()
+
+
 # ─── Health Check ─────────────────────────────────────────────────────────────
 
 @app.get("/health")
 async def health():
+    from tools.embed_service import is_ready
+    from tools.embedder import MODEL_NAME, cache_stats
+    from tools.model_migration import migration_status
     return {
-        "status":  "ok",
-        "service": "StudyAI",
-        "db":      "sqlite",
-        "llm":     "groq/llama-3.3-70b-versatile",
+        "status":   "ok",
+        "service":  "StudyAI",
+        "db":       "sqlite",
+        "llm":      "groq/llama-3.3-70b-versatile",
+        "embedder": MODEL_NAME,
+        "ready":    is_ready(),  # False until the embedding model has warmed up
+        "embedding_cache": cache_stats(),
+        "embedding_migration": migration_status(),
     }
 
 # ─── Main API ───────────────────────────────────────────────────────────────
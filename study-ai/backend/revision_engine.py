@@ -1,10 +1,12 @@
 """StudyAI — Core engine for adaptive revision planning."""
+import asyncio
 import logging
 from datetime import datetime, timedelta
+from functools import partial
 from sqlalchemy.orm import Session
 from database import Concept, RevisionPlan, StudyMaterial, LearningEvent
-from tools.faiss_store import FAISSStore
-from tools.embedder import generate_embedding
+from tools.faiss_store import get_store
+from tools.embed_service import embed_for_store
 from db_utils import get_weak_concepts
 
 log = logging.getLogger(__name__)
@@ -46,24 +48,28 @@ async def generate_adaptive_plan(
     weak.sort(key=lambda c: (c.mastery_score, c.next_review if c.next_review is not None else datetime.utcnow()))
 
     # 3. RAG & Links (Intelligent Meta)
-    store = FAISSStore(user_id)
+    loop = asyncio.get_running_loop()  # store loads and searches run on a thread, off the event loop
     try:
-        store.load()
-    except:
-        pass # fallback if search fails
+        store = await loop.run_in_executor(None, get_store, user_id)
+    except Exception:
+        store = None # fallback if search fails
 
     schedule = {}
     weak_names = {c.id: c.name for c in weak}
+    planned = weak[:50] # Cap at 50 for performance
 
-    for concept in weak[:50]: # Cap at 50 for performance
-        suggested = []
-        try:
-            emb = generate_embedding(str(concept.name))
-            results = store.search(query_embedding=emb, top_k=2)
-            suggested = [r.get("chunk_text", "") for r in results if r.get("material_id") == concept.material_id]
-            if not suggested: suggested = [r.get("chunk_text", "") for r in results[:2]]
-        except:
-            pass
+    # One batched embed + search for all planned concepts
+    grouped: list[list[dict]] = [[] for _ in planned]
+    try:
+        if store is not None:
+            embs = await embed_for_store(store, [str(c.name) for c in planned])
+            grouped = await loop.run_in_executor(None, partial(store.search_many, embs, top_k=2))
+    except Exception:
+        pass
+
+    for concept, results in zip(planned, grouped):
+        suggested = [r.get("chunk_text", "") for r in results if r.get("material_id") == concept.material_id]
+        if not suggested: suggested = [r.get("chunk_text", "") for r in results[:2]]
 
         linked = []
         for w_id, w_name in weak_names.items():
@@ -1,4 +1,7 @@
 """StudyAI — Concept listing and semantic search routes."""
+import asyncio
+from functools import partial
+
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 
@@ -45,16 +48,17 @@ async def related_concepts(
     db: Session = Depends(get_db),
 ):
     """
-    Semantic search: embed the query and find top-5 similar chunks
-    from the user's FAISS index.
+    Hybrid search: the top-5 chunks from the user's FAISS index and BM25
+    keyword index, fused by reciprocal rank.
     """
-    from tools.embedder import generate_embedding
-    from tools.faiss_store import FAISSStore
+    from tools.embed_service import embed_for_store
+    from tools.faiss_store import get_store
 
-    embedding = generate_embedding(query)
-    store = FAISSStore(str(current_user.id))
-    store.load()
-    results = store.search(embedding, top_k=5)
+    # Store loads and searches may wait on its locks, so they run on a thread, not the event loop
+    loop = asyncio.get_running_loop()
+    store = await loop.run_in_executor(None, get_store, str(current_user.id))
+    embedding = (await embed_for_store(store, [query]))[0]
+    results = await loop.run_in_executor(None, partial(store.hybrid_search, query, embedding, top_k=5))
 
     return {
         "success": True,
@@ -64,6 +68,7 @@ async def related_concepts(
                 "material_id":  r.get("material_id"),
                 "score":        round(r.get("score", 0.0), 3),
                 "chunk_index":  r.get("chunk_index"),
+                "page":         r.get("page"),
             }
             for r in results
         ],
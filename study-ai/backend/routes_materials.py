@@ -14,6 +14,7 @@ router = APIRouter(tags=["materials"])
 
 UPLOAD_PATH = os.getenv("UPLOAD_PATH", "./uploads")
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20 MB
+UPLOAD_READ_SIZE = 1024 * 1024  # uploads are written to disk 1 MB at a time
 ALLOWED_TYPES = {"pdf", "docx", "txt", "md"}
 
 # WebSocket progress queues — shared with main.py
@@ -35,17 +36,21 @@ async def upload_material(
     if ext not in ALLOWED_TYPES:
         raise HTTPException(400, f"File type '{ext}' not supported. Use: {ALLOWED_TYPES}")
 
-    content = await file.read()
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(413, "File exceeds 20 MB limit")
-
-    # Save to disk
+    # Stream to disk, never holding the whole file in memory
     user_upload_dir = os.path.join(UPLOAD_PATH, str(current_user.id))
     os.makedirs(user_upload_dir, exist_ok=True)
     safe_name = f"{uuid.uuid4()}_{file.filename}"
     file_path = os.path.join(user_upload_dir, safe_name)
+    size = 0
     with open(file_path, "wb") as f:
-        f.write(content)
+        while block := await file.read(UPLOAD_READ_SIZE):
+            size += len(block)
+            if size > MAX_FILE_SIZE:
+                break
+            f.write(block)
+    if size > MAX_FILE_SIZE:
+        os.remove(file_path)
+        raise HTTPException(413, "File exceeds 20 MB limit")
 
     # Create DB record
     material = StudyMaterial(
@@ -261,10 +266,11 @@ async def delete_material(
 
     # Delete from FAISS
     try:
-        from tools.faiss_store import FAISSStore
-        store = FAISSStore(str(current_user.id))
-        store.load()
-        store.delete_by_material(material_id)
+        from tools.faiss_store import get_store, user_write_lock
+        loop = asyncio.get_running_loop()
+        store = await loop.run_in_executor(None, get_store, str(current_user.id))
+        async with user_write_lock(str(current_user.id)):
+            await loop.run_in_executor(None, store.delete_by_material, material_id)
     except Exception:
         pass  # best-effort
 
@@ -1,6 +1,8 @@
 """StudyAI — RAG-powered Q&A (Ask AI) routes."""
+import asyncio
 import os
 import logging
+from functools import partial
 from typing import List, Optional
 from pydantic import BaseModel
 from fastapi import APIRouter, Depends, HTTPException
@@ -9,12 +11,17 @@ from langchain_groq import ChatGroq
 
 from auth import get_current_user
 from database import User, get_db, StudyMaterial
-from tools.faiss_store import FAISSStore
-from tools.embedder import generate_embedding
+from tools.faiss_store import get_store
+from tools.embed_service import embed_for_store
 
 router = APIRouter(tags=["qna"])
 log = logging.getLogger(__name__)
 
+# Chunks less similar than this to the question are not worth sending to the LLM
+MIN_CONTEXT_SCORE = float(os.getenv("QNA_MIN_CONTEXT_SCORE", "0.2"))
+# Chunks sent to the LLM; hybrid retrieval puts exact-term matches first, so a few suffice
+CONTEXT_CHUNKS = int(os.getenv("QNA_CONTEXT_CHUNKS", "4"))
+
 _llm = ChatGroq(
     model="llama-3.3-70b-versatile",
     temperature=0.3,
@@ -40,20 +47,25 @@ async def ask_ai(
     db: Session = Depends(get_db),
 ):
     """
-    RAG-powered Q&A: Search FAISS across all user materials and answer based on found context.
+    RAG-powered Q&A: hybrid search across all user materials (or just body.material_id)
+    and answer based on found context.
     """
     if not body.question.strip():
         raise HTTPException(400, "Question cannot be empty")
 
-    # 1. Retrieve context via FAISS
-    store = FAISSStore(str(current_user.id))
+    # 1. Retrieve context: vector + keyword (BM25) search, fused.
+    # Store loads and searches may wait on its locks, so they run on a thread, not the event loop
+    loop = asyncio.get_running_loop()
     try:
-        store.load()
+        store = await loop.run_in_executor(None, get_store, str(current_user.id))
     except Exception:
         raise HTTPException(404, "No study materials indexed yet. Please upload content first.")
 
-    emb = generate_embedding(body.question)
-    search_results = store.search(query_embedding=emb, top_k=5, exclude_material=None)
+    emb = (await embed_for_store(store, [body.question]))[0]
+    search_results = await loop.run_in_executor(None, partial(
+        store.hybrid_search,
+        body.question, emb, top_k=CONTEXT_CHUNKS, material_id=body.material_id, min_score=MIN_CONTEXT_SCORE,
+    ))
     
     if not search_results:
         return {
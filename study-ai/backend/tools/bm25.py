@@ -0,0 +1,234 @@
+"""StudyAI — BM25 inverted index over chunk text, kept alongside a FAISSStore."""
+import io
+import json
+import math
+import re
+import struct
+import threading
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+from tools.chunk_table import ChunkMetadata, ChunkTable
+
+BM25_K1 = 1.2
+BM25_B  = 0.75
+
+MAGIC = b"SAIBM251"
+_HEADER = struct.Struct("<Q")  # length of the JSON header that follows MAGIC
+
+# Words, numbers and identifiers; keeps "h2o", "tcp_ip", "o(n)" parts and acronyms searchable
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN.findall(text.lower())
+
+
+class TablePostings:
+    """
+    Postings for one ChunkTable, built once since tables never change:
+    for every term, the rows containing it (ascending) and their term counts.
+    The terms' slices are laid out back to back in the dict's order.
+
+    File layout: MAGIC, u64 header length, JSON header (row count and the
+    terms in order), then the term starts (int64, terms + 1), rows (int32),
+    term counts (float32) and row lengths (int32) back to back.
+    """
+
+    def __init__(self, terms: dict[str, tuple[int, int]], rows: np.ndarray, tfs: np.ndarray, lengths: np.ndarray):
+        self.terms   = terms    # term → [start, end) slice of rows / tfs
+        self.rows    = rows
+        self.tfs     = tfs
+        self.lengths = lengths  # tokens per row
+
+    @classmethod
+    def build(cls, table: ChunkTable, field: str = "chunk_text") -> "TablePostings":
+        by_term: dict[str, list[tuple[int, int]]] = {}
+        lengths = np.zeros(len(table), dtype="int32")
+        for row in range(len(table)):
+            tokens = tokenize(str(table.row(row).get(field) or ""))
+            lengths[row] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                by_term.setdefault(term, []).append((row, tf))
+
+        terms, rows, tfs, pos = {}, [], [], 0
+        for term, hits in by_term.items():
+            terms[term] = (pos, pos + len(hits))
+            rows.extend(r for r, _ in hits)
+            tfs.extend(tf for _, tf in hits)
+            pos += len(hits)
+        return cls(terms, np.asarray(rows, dtype="int32"), np.asarray(tfs, dtype="float32"), lengths)
+
+    @classmethod
+    def concat(cls, parts: list["TablePostings"], keep: list[np.ndarray]) -> "TablePostings":
+        """
+        Postings for the concatenation of each part's kept rows (ascending),
+        as ChunkMetadata.live_table() lays them out, without re-tokenizing.
+        """
+        vocab: dict[str, int] = {}
+        term_ids, rows, tfs, lengths, base = [], [], [], [], 0
+        for p, kept in zip(parts, keep):
+            remap = np.full(len(p.lengths), -1, dtype="int32")
+            remap[kept] = np.arange(base, base + len(kept), dtype="int32")
+            local = np.array([vocab.setdefault(t, len(vocab)) for t in p.terms], dtype="int64")
+            counts = [end - start for start, end in p.terms.values()]
+            new_rows = remap[p.rows]
+            live = new_rows >= 0
+            term_ids.append(np.repeat(local, counts)[live])
+            rows.append(new_rows[live])
+            tfs.append(p.tfs[live])
+            lengths.append(p.lengths[kept])
+            base += len(kept)
+
+        term_ids = np.concatenate(term_ids or [np.empty(0, dtype="int64")])
+        order = np.argsort(term_ids, kind="stable")  # stable: rows stay ascending within a term
+        bounds = np.zeros(len(vocab) + 1, dtype="int64")
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=bounds[1:])
+        terms = {t: (int(bounds[i]), int(bounds[i + 1])) for t, i in vocab.items() if bounds[i + 1] > bounds[i]}
+        return cls(
+            terms,
+            np.concatenate(rows or [np.empty(0, dtype="int32")])[order],
+            np.concatenate(tfs or [np.empty(0, dtype="float32")])[order],
+            np.concatenate(lengths or [np.empty(0, dtype="int32")]).astype("int32"),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.rows.nbytes + self.tfs.nbytes + self.lengths.nbytes
+
+    def write_to(self, f):
+        header = json.dumps({"n": len(self.lengths), "terms": list(self.terms)}, ensure_ascii=False).encode("utf-8")
+        starts = np.array([start for start, _ in self.terms.values()] + [len(self.rows)], dtype="int64")
+        f.write(MAGIC)
+        f.write(_HEADER.pack(len(header)))
+        f.write(header)
+        for col in (starts, self.rows, self.tfs, self.lengths):
+            f.write(np.ascontiguousarray(col).tobytes())
+
+    def to_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        self.write_to(buf)
+        return buf.getvalue()
+
+    @classmethod
+    def read(cls, path: str) -> "TablePostings":
+        with open(path, "rb") as f:
+            return cls.from_buffer(memoryview(f.read()))
+
+    @classmethod
+    def from_buffer(cls, buf: memoryview) -> "TablePostings":
+        """Parse postings serialized by write_to() from the start of buf."""
+        if bytes(buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError("not a postings file")
+        (header_len,) = _HEADER.unpack(buf[len(MAGIC):len(MAGIC) + _HEADER.size])
+        pos = len(MAGIC) + _HEADER.size
+        header = json.loads(bytes(buf[pos:pos + header_len]))
+        pos += header_len
+
+        starts = np.frombuffer(buf, dtype="int64", count=len(header["terms"]) + 1, offset=pos)
+        pos += starts.nbytes
+        columns = []
+        for dtype, count in (("int32", int(starts[-1])), ("float32", int(starts[-1])), ("int32", header["n"])):
+            col = np.frombuffer(buf, dtype=dtype, count=count, offset=pos).copy()
+            pos += col.nbytes
+            columns.append(col)
+        bounds = starts.tolist()
+        terms = {t: (bounds[i], bounds[i + 1]) for i, t in enumerate(header["terms"])}
+        return cls(terms, *columns)
+
+
+class BM25Index:
+    """
+    Okapi BM25 over all tables of a store's ChunkMetadata. Postings are
+    built per table on the write path (an add() indexes only its own new
+    segment) and saved next to the table, so loading a store only reads
+    them; deletions need no index update at all, because scoring reads the
+    metadata's alive mask. Document frequencies and average length are
+    taken over live rows at query time.
+    """
+
+    def __init__(self):
+        self._postings: dict[int, tuple[ChunkTable, TablePostings]] = {}  # id(table) → postings
+        self._lock = threading.Lock()
+
+    def adopt(self, table: ChunkTable, postings: TablePostings):
+        """Register postings built on the write path or read from disk along with table."""
+        with self._lock:
+            self._postings[id(table)] = (table, postings)
+
+    def sync(self, metadata: ChunkMetadata) -> list[TablePostings]:
+        """
+        Postings for each of metadata's tables, dropping the rest. Only tables
+        written before postings were saved have none yet; those are built here.
+        """
+        with self._lock:
+            current = {}
+            for table in metadata.tables:
+                known = self._postings.get(id(table))
+                current[id(table)] = known if known is not None and known[0] is table \
+                    else (table, TablePostings.build(table))
+            self._postings = current
+            return [current[id(t)][1] for t in metadata.tables]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(p.nbytes for _, p in self._postings.values())
+
+    def live_postings(self, metadata: ChunkMetadata) -> TablePostings:
+        """Postings for metadata.live_table(), merged from the per-table ones."""
+        return TablePostings.concat(self.sync(metadata), metadata.live_rows())
+
+    def search(self, metadata: ChunkMetadata, query: str, top_k: int,
+               allowed: Optional[np.ndarray] = None) -> list[tuple[int, float]]:
+        """
+        Best top_k (vector ID, BM25 score) pairs for query, best first.
+        allowed optionally masks global metadata rows (e.g. a material filter).
+        """
+        terms = set(tokenize(query))
+        if not terms or top_k <= 0:
+            return []
+        postings = self.sync(metadata)
+        starts = metadata._starts.tolist()
+        alive = metadata.alive if allowed is None else metadata.alive & allowed
+
+        n_live = int(metadata.alive.sum())
+        if n_live == 0:
+            return []
+        lengths = np.concatenate([p.lengths for p in postings]).astype("float32")
+        avgdl = max(float(lengths[metadata.alive].mean()), 1.0)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avgdl)
+
+        scores = np.zeros(len(alive), dtype="float32")
+        for term in terms:
+            hits = []
+            for p, start in zip(postings, starts):
+                span = p.terms.get(term)
+                if span is not None:
+                    hits.append((p.rows[span[0]:span[1]] + start, p.tfs[span[0]:span[1]]))
+            if not hits:
+                continue
+            rows = np.concatenate([h[0] for h in hits])
+            tfs  = np.concatenate([h[1] for h in hits])
+            df = int(metadata.alive[rows].sum())
+            if df == 0:
+                continue
+            idf = math.log(1 + (n_live - df + 0.5) / (df + 0.5))
+            scores[rows] += idf * tfs * (BM25_K1 + 1) / (tfs + norm[rows])
+
+        scores[~alive] = 0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(metadata.all_ids[r]), float(scores[r])) for r in candidates]
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = 60) -> list[tuple[int, float]]:
+    """Fuse ranked ID lists: each ID scores sum(1 / (k + rank)) over the lists it appears in."""
+    fused: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, vid in enumerate(ranking, start=1):
+            fused[vid] = fused.get(vid, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: -item[1])
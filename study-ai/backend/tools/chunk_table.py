@@ -0,0 +1,284 @@
+"""StudyAI — columnar chunk metadata for FAISSStore parts."""
+import hashlib
+import io
+import json
+import mmap
+import struct
+import unicodedata
+from typing import Iterator, Optional
+
+import numpy as np
+
+MAGIC = b"SAICHK1\n"
+_HEADER = struct.Struct("<Q")  # length of the JSON header that follows MAGIC
+
+# Metadata keys that get their own column instead of living in the JSON payload
+_COLUMN_KEYS = ("material_id", "chunk_index", "_vector_id")
+
+
+def content_hash(text: Optional[str]) -> int:
+    """
+    64-bit hash of normalized chunk text (Unicode NFKC, case-folded,
+    whitespace collapsed), so the same passage extracted from a PDF and a
+    DOCX matches. 0 means "no text" and never matches anything.
+    """
+    if not text:
+        return 0
+    norm = " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+    if not norm:
+        return 0
+    digest = hashlib.blake2b(norm.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class ChunkTable:
+    """
+    Metadata for one store part (base generation or segment).
+
+    vector ID, material, chunk_index and the chunk_text content_hash live in
+    compact numpy columns; every other key (chunk text above all) is a
+    per-row JSON payload that stays on disk behind an mmap and is decoded
+    only for the rows a caller asks for.
+
+    File layout: MAGIC, u64 header length, JSON header, then the ids (int64),
+    material codes (int32, -1 = none), chunk_index (int32, -1 = none),
+    content hashes (uint64, absent in tables predating them), payload
+    offsets (int64, n + 1) and payload bytes sections back to back.
+    """
+
+    def __init__(self, ids, material_codes, chunk_index, materials, offsets, payload, mapping=None, hashes=None):
+        self.ids            = ids
+        self.material_codes = material_codes
+        self.chunk_index    = chunk_index
+        self.hashes         = hashes if hashes is not None else np.zeros(len(ids), dtype="uint64")
+        self.materials: list[str] = materials
+        self.offsets        = offsets
+        self.payload        = payload  # bytes or a memoryview into `mapping`
+        self._mapping       = mapping  # mmap backing payload, kept alive with the table
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Resident size: the columns, plus the payload unless it is mmapped."""
+        cols = self.ids.nbytes + self.material_codes.nbytes + self.chunk_index.nbytes + self.hashes.nbytes
+        cols += self.offsets.nbytes
+        return cols + (0 if isinstance(self._mapping, mmap.mmap) else len(self.payload))
+
+    @classmethod
+    def build(cls, ids: np.ndarray, meta_list: list[dict]) -> "ChunkTable":
+        materials: list[str] = []
+        codes_by_name: dict[str, int] = {}
+        codes  = np.full(len(meta_list), -1, dtype="int32")
+        chunks = np.full(len(meta_list), -1, dtype="int32")
+        hashes = np.array([content_hash(m.get("chunk_text")) for m in meta_list], dtype="uint64")
+        blobs  = []
+        for row, meta in enumerate(meta_list):
+            extra = {k: v for k, v in meta.items() if k not in _COLUMN_KEYS}
+            mid = meta.get("material_id")
+            if isinstance(mid, str):
+                if mid not in codes_by_name:
+                    codes_by_name[mid] = len(materials)
+                    materials.append(mid)
+                codes[row] = codes_by_name[mid]
+            elif mid is not None:
+                extra["material_id"] = mid
+            cidx = meta.get("chunk_index")
+            if isinstance(cidx, int) and 0 <= cidx < 2**31:
+                chunks[row] = cidx
+            elif cidx is not None:
+                extra["chunk_index"] = cidx
+            blobs.append(json.dumps(extra, ensure_ascii=False).encode("utf-8"))
+
+        offsets = np.zeros(len(blobs) + 1, dtype="int64")
+        np.cumsum([len(b) for b in blobs], out=offsets[1:])
+        return cls(np.asarray(ids, dtype="int64"), codes, chunks, materials, offsets, b"".join(blobs), hashes=hashes)
+
+    def take(self, rows: np.ndarray) -> "ChunkTable":
+        """Copy of the given rows, payload bytes included."""
+        blobs = [self.payload[self.offsets[r]:self.offsets[r + 1]] for r in rows.tolist()]
+        offsets = np.zeros(len(blobs) + 1, dtype="int64")
+        np.cumsum([len(b) for b in blobs], out=offsets[1:])
+        return ChunkTable(
+            self.ids[rows], self.material_codes[rows], self.chunk_index[rows],
+            list(self.materials), offsets, b"".join(blobs), hashes=self.hashes[rows],
+        )
+
+    @staticmethod
+    def concat(tables: list["ChunkTable"]) -> "ChunkTable":
+        materials: list[str] = []
+        codes_by_name: dict[str, int] = {}
+        codes, offsets, base = [], [np.zeros(1, dtype="int64")], 0
+        for t in tables:
+            remap = np.empty(len(t.materials) + 1, dtype="int32")
+            remap[-1] = -1  # so code -1 maps to -1
+            for i, name in enumerate(t.materials):
+                if name not in codes_by_name:
+                    codes_by_name[name] = len(materials)
+                    materials.append(name)
+                remap[i] = codes_by_name[name]
+            codes.append(remap[t.material_codes])
+            offsets.append(t.offsets[1:] + base)
+            base += int(t.offsets[-1])
+        empty_i32 = np.empty(0, dtype="int32")
+        return ChunkTable(
+            np.concatenate([t.ids for t in tables] or [np.empty(0, dtype="int64")]),
+            np.concatenate(codes or [empty_i32]),
+            np.concatenate([t.chunk_index for t in tables] or [empty_i32]),
+            materials,
+            np.concatenate(offsets),
+            b"".join(bytes(t.payload[:int(t.offsets[-1])]) for t in tables),
+            hashes=np.concatenate([t.hashes for t in tables] or [np.empty(0, dtype="uint64")]),
+        )
+
+    def row(self, i: int) -> dict:
+        """Decode one row back into the metadata dict it was built from."""
+        meta = json.loads(bytes(self.payload[self.offsets[i]:self.offsets[i + 1]]))
+        code = int(self.material_codes[i])
+        if code >= 0:
+            meta["material_id"] = self.materials[code]
+        cidx = int(self.chunk_index[i])
+        if cidx >= 0:
+            meta["chunk_index"] = cidx
+        meta["_vector_id"] = str(int(self.ids[i]))
+        return meta
+
+    def write_to(self, f):
+        n = len(self.ids)
+        header = json.dumps({"n": n, "materials": self.materials, "hashes": True}).encode("utf-8")
+        f.write(MAGIC)
+        f.write(_HEADER.pack(len(header)))
+        f.write(header)
+        for col in (self.ids, self.material_codes, self.chunk_index, self.hashes, self.offsets):
+            f.write(np.ascontiguousarray(col).tobytes())
+        f.write(self.payload[:int(self.offsets[-1])])
+
+    def to_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        self.write_to(buf)
+        return buf.getvalue()
+
+    @classmethod
+    def read(cls, path: str) -> "ChunkTable":
+        """Map a table file; the columns are copied into memory, the payload stays mapped."""
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(memoryview(mm), mapping=mm)
+
+    @classmethod
+    def from_buffer(cls, buf: memoryview, mapping=None) -> "ChunkTable":
+        """Parse a table serialized by write_to() from the start of buf."""
+        if bytes(buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError("not a chunk table")
+        (header_len,) = _HEADER.unpack(buf[len(MAGIC):len(MAGIC) + _HEADER.size])
+        pos = len(MAGIC) + _HEADER.size
+        header = json.loads(bytes(buf[pos:pos + header_len]))
+        pos += header_len
+
+        n = header["n"]
+        layout = [("int64", n), ("int32", n), ("int32", n)]
+        if header.get("hashes"):
+            layout.append(("uint64", n))
+        columns = []
+        for dtype, count in layout + [("int64", n + 1)]:
+            col = np.frombuffer(buf, dtype=dtype, count=count, offset=pos).copy()
+            pos += col.nbytes
+            columns.append(col)
+        ids, codes, chunks, *hashes, offsets = columns
+        payload = buf[pos:pos + int(offsets[-1])]
+        return cls(ids, codes, chunks, header["materials"], offsets, payload, mapping,
+                   hashes=hashes[0] if hashes else None)
+
+
+class ChunkMetadata:
+    """
+    Dict-like view (vector ID → metadata dict) over all of a store's tables.
+    IDs are ascending across tables, so lookups are a binary search over one
+    concatenated int64 column; deletions only flip a bit in the alive mask.
+    """
+
+    def __init__(self, tables: Optional[list[ChunkTable]] = None):
+        self.tables: list[ChunkTable] = []
+        self.all_ids = np.empty(0, dtype="int64")
+        self.all_hashes = np.empty(0, dtype="uint64")
+        self.alive   = np.empty(0, dtype=bool)
+        self._starts = np.empty(0, dtype="int64")  # first global row of each table
+        for table in tables or []:
+            self.append(table)
+
+    def append(self, table: ChunkTable):
+        self._starts  = np.append(self._starts, len(self.all_ids))
+        self.tables.append(table)
+        self.all_ids = np.concatenate([self.all_ids, table.ids])
+        self.all_hashes = np.concatenate([self.all_hashes, table.hashes])
+        self.alive   = np.concatenate([self.alive, np.ones(len(table), dtype=bool)])
+
+    def _row_of(self, vid: int) -> int:
+        row = int(np.searchsorted(self.all_ids, vid))
+        if row < len(self.all_ids) and self.all_ids[row] == vid and self.alive[row]:
+            return row
+        return -1
+
+    def get(self, vid: int) -> Optional[dict]:
+        row = self._row_of(vid)
+        if row < 0:
+            return None
+        t = int(np.searchsorted(self._starts, row, side="right")) - 1
+        return self.tables[t].row(row - int(self._starts[t]))
+
+    def __getitem__(self, vid: int) -> dict:
+        meta = self.get(vid)
+        if meta is None:
+            raise KeyError(vid)
+        return meta
+
+    def __contains__(self, vid) -> bool:
+        return self._row_of(int(vid)) >= 0
+
+    def __len__(self) -> int:
+        return int(self.alive.sum())
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids().tolist())
+
+    def ids(self) -> np.ndarray:
+        """IDs of all live rows, ascending."""
+        return self.all_ids[self.alive]
+
+    def values(self) -> Iterator[dict]:
+        for vid in self.ids().tolist():
+            yield self[vid]
+
+    def find_hashes(self, hashes: np.ndarray) -> np.ndarray:
+        """ID of a live row with each content hash, or -1 (always -1 for hash 0)."""
+        hashes = np.asarray(hashes, dtype="uint64")
+        live = self.alive & (self.all_hashes != 0)
+        known, known_ids = self.all_hashes[live], self.all_ids[live]
+        order = np.argsort(known, kind="stable")  # stable: the oldest row wins among equals
+        known, known_ids = known[order], known_ids[order]
+        pos = np.minimum(np.searchsorted(known, hashes), max(len(known) - 1, 0))
+        found = (hashes != 0) & (len(known) > 0)
+        if len(known):
+            found &= known[pos] == hashes
+        return np.where(found, known_ids[pos] if len(known) else -1, -1).astype("int64")
+
+    def remove(self, ids: np.ndarray):
+        ids  = np.asarray(ids, dtype="int64")
+        rows = np.searchsorted(self.all_ids, ids)
+        hit  = rows < len(self.all_ids)
+        hit[hit] = self.all_ids[rows[hit]] == ids[hit]
+        self.alive[rows[hit]] = False
+
+    def live_rows(self) -> list[np.ndarray]:
+        """Live row numbers within each table."""
+        return [np.flatnonzero(self.alive[start:start + len(table)])
+                for start, table in zip(self._starts.tolist(), self.tables)]
+
+    def live_table(self) -> ChunkTable:
+        """One table holding only the live rows, for writing a new base."""
+        return ChunkTable.concat([table.take(rows) for table, rows in zip(self.tables, self.live_rows())])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.nbytes for t in self.tables) + self.all_ids.nbytes + self.all_hashes.nbytes + self.alive.nbytes
@@ -0,0 +1,280 @@
+"""StudyAI — micro-batching embedding service on a dedicated worker-process pool."""
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+from tools import model_registry
+
+log = logging.getLogger(__name__)
+
+# How long the first request of a batch waits for company, and the batch size cap
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_MAX_BATCH       = int(os.getenv("EMBED_MAX_BATCH", "64"))
+# Padded input (texts × longest text, in characters) allowed per length bucket
+EMBED_BATCH_CHARS     = int(os.getenv("EMBED_BATCH_CHARS", "48000"))
+# Encoder processes, each with its own model copy; 0 encodes on threads of this process
+EMBED_WORKERS         = int(os.getenv("EMBED_WORKERS", "2"))
+# Requests allowed to wait for a batch before callers are made to wait for room
+EMBED_MAX_QUEUE       = int(os.getenv("EMBED_MAX_QUEUE", "1024"))
+
+
+class EmbeddingPool:
+    """
+    Worker processes that run the model outside this process's GIL, so a
+    large upload being embedded never stalls the event loop or other
+    requests. Processes are spawned (torch and fork don't mix) on first use
+    and load the model in their initializer. workers=0 runs encode on the
+    default thread pool instead. Should a worker die (crash, OOM kill), the
+    broken pool is replaced and the batch retried once.
+    """
+
+    def __init__(self, workers: int, encode: Callable, initializer: Optional[Callable] = None, initargs=()):
+        self.workers     = workers
+        self.encode      = encode
+        self.initializer = initializer
+        self.initargs    = initargs
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()  # guards creating and replacing the executor
+
+    @property
+    def slots(self) -> int:
+        """Batches that can encode at once."""
+        return max(self.workers, 1)
+
+    def executor(self) -> Optional[Executor]:
+        with self._lock:
+            if self.workers > 0 and self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.initializer, initargs=self.initargs,
+                )
+            return self._executor
+
+    async def run(self, texts: list, *args) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        executor = self.executor()
+        try:
+            return await loop.run_in_executor(executor, self.encode, texts, *args)
+        except BrokenProcessPool:
+            log.warning("Embedding worker died; restarting the pool and retrying %d texts", len(texts))
+            self._discard(executor)
+            return await loop.run_in_executor(self.executor(), self.encode, texts, *args)
+
+    def _discard(self, broken: Executor):
+        """Drop a broken executor, unless a concurrent batch already replaced it; the next run starts a new one."""
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class EmbeddingService:
+    """
+    Coalesces concurrent embed requests into batched encode calls.
+    Requests queue up per event loop (at most max_queue, then callers wait
+    for room). A dispatcher task takes the first request, waits for a free
+    encode slot, gives the batch up to window_ms to fill (or max_batch
+    texts), and hands it to the async encode function without waiting for
+    the result, so up to `slots` batches encode at once. While every slot
+    is busy, the next batch keeps filling, so under load batches grow.
+    """
+
+    def __init__(self, window_ms: float, max_batch: int, encode: Callable[[list], Awaitable[np.ndarray]],
+                 slots: int = 1, max_queue: int = 0, dim: int = 384):
+        self.window    = window_ms / 1000
+        self.max_batch = max_batch
+        self.slots     = slots
+        self.max_queue = max_queue
+        self.dim       = dim
+        self._encode   = encode
+        self._queues: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Queue]" = weakref.WeakKeyDictionary()
+        self._workers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Task]" = weakref.WeakKeyDictionary()
+        self._tasks: set = set()  # in-flight dispatches; the loop only holds tasks weakly
+        self.batches = 0  # encode calls made, for tests and metrics
+
+    async def embed(self, text: str) -> np.ndarray:
+        """One dim-sized float32 vector for text."""
+        return (await self.embed_many([text]))[0]
+
+    async def embed_many(self, texts: list) -> np.ndarray:
+        """
+        A float32 (len(texts), dim) array, in order; encoded together with
+        whatever else is queued and returned as a view of the batch's array.
+        """
+        if not texts:
+            return np.empty((0, self.dim), dtype="float32")
+        loop = asyncio.get_running_loop()
+        queue = self._queues.get(loop)
+        if queue is None:
+            queue = self._queues[loop] = asyncio.Queue(self.max_queue)
+        worker = self._workers.get(loop)
+        if worker is None or worker.done():
+            self._workers[loop] = loop.create_task(self._run(queue))
+
+        future = loop.create_future()
+        await queue.put((list(texts), future))
+        return await future
+
+    async def _run(self, queue: asyncio.Queue):
+        slots = asyncio.Semaphore(self.slots)
+        while True:
+            batch = [await queue.get()]
+            await slots.acquire()
+            size = len(batch[0][0])
+            if size < self.max_batch and self.window > 0:
+                await asyncio.sleep(self.window)
+            while size < self.max_batch and not queue.empty():
+                item = queue.get_nowait()
+                batch.append(item)
+                size += len(item[0])
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch, slots))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: list, slots: asyncio.Semaphore):
+        texts = [t for item_texts, _ in batch for t in item_texts]
+        self.batches += 1
+        try:
+            vectors = await self._encode(texts)
+        except Exception as exc:
+            log.exception("Embedding batch of %d texts failed", len(texts))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        finally:
+            slots.release()
+
+        pos = 0
+        for item_texts, future in batch:
+            if not future.done():  # the caller may have been cancelled
+                future.set_result(vectors[pos:pos + len(item_texts)])
+            pos += len(item_texts)
+
+
+def length_batches(texts: list, max_batch: int = EMBED_MAX_BATCH, max_chars: int = EMBED_BATCH_CHARS) -> list[list[int]]:
+    """
+    Positions of texts grouped for encoding, shortest first: every batch pads
+    to similar lengths, holds at most max_batch texts, and keeps texts ×
+    longest text within max_chars, so long chunks go in smaller batches.
+    """
+    batches, batch = [], []
+    for i in sorted(range(len(texts)), key=lambda i: len(texts[i])):
+        if batch and (len(batch) >= max_batch or (len(batch) + 1) * len(texts[i]) > max_chars):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _pool() -> EmbeddingPool:
+    from tools import embedder
+    threads = max(1, (os.cpu_count() or 1) // max(EMBED_WORKERS, 1))
+    return EmbeddingPool(EMBED_WORKERS, embedder.encode_raw, embedder.init_worker, (threads,))
+
+
+embedding_pool = _pool()
+
+
+async def _encode_cached(texts: list, model: str, cache: bool = True) -> np.ndarray:
+    """Cache lookups and stores stay in this process; only misses go to the pool. cache=False skips both."""
+    from tools import embedder
+    if not cache:
+        return await embedding_pool.run(texts, model)
+    loop = asyncio.get_running_loop()
+    keys, found = await loop.run_in_executor(None, embedder.cache_lookup, texts, model)
+    todo = {k: t for k, t in zip(keys, texts) if k not in found}  # unique misses, in order
+    if todo:
+        fresh = dict(zip(todo.keys(), await embedding_pool.run(list(todo.values()), model)))
+        await loop.run_in_executor(None, embedder.cache_store, fresh)
+        found.update(fresh)
+    return embedder.gather(keys, found, model_registry.get(model).dim)
+
+
+_services: dict[tuple[str, bool], EmbeddingService] = {}
+
+
+def service_for(model: Optional[str] = None, cache: bool = True) -> EmbeddingService:
+    """
+    The micro-batching service of one model (default: the active one);
+    batches never mix models, nor cached requests with uncached ones.
+    """
+    spec = model_registry.get(model) if model else model_registry.active()
+    service = _services.get((spec.name, cache))
+    if service is None:
+        service = _services[(spec.name, cache)] = EmbeddingService(
+            EMBED_BATCH_WINDOW_MS, EMBED_MAX_BATCH, partial(_encode_cached, model=spec.name, cache=cache),
+            slots=embedding_pool.slots, max_queue=EMBED_MAX_QUEUE, dim=spec.dim,
+        )
+    return service
+
+
+embedding_service = service_for()
+_warm = threading.Event()
+
+
+async def warmup():
+    """
+    Start the pool (each worker loads the model in its initializer) with
+    one dummy encode per slot, then report ready. Called at app startup.
+    """
+    try:
+        await asyncio.gather(*(embedding_pool.run(["warmup"]) for _ in range(embedding_pool.slots)))
+    except Exception:
+        log.exception("Embedding pool warmup failed; workers will load the model on first use")
+        return
+    _warm.set()
+    log.info("Embedding pool ready (%d workers)", embedding_pool.workers)
+
+
+def is_ready() -> bool:
+    return _warm.is_set()
+
+
+def shutdown():
+    embedding_pool.shutdown()
+
+
+async def embed_text(text: str, model: Optional[str] = None) -> np.ndarray:
+    """Embed one string from async code via the shared micro-batching service."""
+    return await service_for(model).embed(text)
+
+
+async def embed_texts(texts: list, model: Optional[str] = None, cache: bool = True) -> np.ndarray:
+    """
+    Embed a list of strings from async code via the shared micro-batching
+    service. Bulk text that is unlikely to be asked for again (upload chunks,
+    re-embedding) passes cache=False, so it doesn't evict the queries the
+    embedding cache is for.
+    """
+    return await service_for(model, cache).embed_many(texts)
+
+
+async def embed_for_store(store, texts: list, cache: bool = True) -> np.ndarray:
+    """
+    Embed texts with the model store was built with, so they can search it.
+    Should the store be cut over to another model meanwhile (a migration
+    finishing), they are embedded again with the new one.
+    """
+    while True:
+        model = store.model
+        vectors = await embed_texts(texts, model.name, cache)
+        if store.model == model:
+            return vectors
@@ -2,18 +2,167 @@
 
 
 # ─── tools/embedder.py content ─────────────────────────────────────────────
-"""Singleton SentenceTransformer embedder used across all agents."""
-from sentence_transformers import SentenceTransformer
+"""
+Shared SentenceTransformer embedders used across all agents.
 
-# Load once at module import; all-MiniLM-L6-v2 → 384-dim vectors
-_model = SentenceTransformer("all-MiniLM-L6-v2")
+The models (and sentence_transformers / torch themselves) load on first use,
+not at import, so importing routes stays cheap. The API process itself
+only touches the cache: encoding runs in the worker processes of
+tools/embed_service.py, each of which calls init_worker() to load the model.
 
+Which model: EMBEDDING_MODEL picks one from tools/model_registry.py for new
+stores; every store records its own, and queries against it are embedded
+with that one, so a store keeps working while it is migrated to another
+model (see tools/model_migration.py). Functions take an optional model name
+and default to the active model.
 
-def generate_embedding(text: str) -> list:
-    """Encode a single string into a 384-dim float list."""
-    return _model.encode(text, convert_to_numpy=True)[0].tolist()
+EMBEDDER_BACKEND picks PyTorch or an ONNX Runtime export (fp32 or int8, see
+tools/onnx_embedder.py). Every text goes through an EmbeddingCache first
+(memory LRU, then SQLite), so repeated concept names and questions never
+reach the model twice.
+"""
+import logging
+import os
+import threading
+from typing import Optional
 
+import numpy as np
 
-def generate_embeddings(texts: list) -> list:
-    """Batch-encode a list of strings into 384-dim float lists."""
-    return [embedding.tolist() for embedding in _model.encode(texts, convert_to_numpy=True)]
+from tools import model_registry
+from tools.embedding_cache import EmbeddingCache
+
+# The active model: all-MiniLM-L6-v2 → 384-dim vectors unless EMBEDDING_MODEL says otherwise
+MODEL_NAME    = model_registry.active().name
+EMBEDDING_DIM = model_registry.active().dim
+
+# "torch" (SentenceTransformer), "onnx" (ONNX Runtime fp32) or "onnx-int8" (dynamically quantized)
+EMBEDDER_BACKEND   = os.getenv("EMBEDDER_BACKEND", "torch")
+# Where ONNX exports of the model are cached, one subdirectory per model
+EMBEDDER_ONNX_DIR  = os.getenv("EMBEDDER_ONNX_DIR", "./onnx_models")
+
+EMBED_CACHE_ENTRIES = int(os.getenv("EMBED_CACHE_ENTRIES", "20000"))
+# SQLite file shared by all workers; empty keeps only the in-memory tier
+EMBED_CACHE_PATH    = os.getenv("EMBED_CACHE_PATH", "./embedding_cache.sqlite3")
+# Rows the SQLite file keeps, newest first (0 = no limit)
+EMBED_CACHE_DISK_ENTRIES = int(os.getenv("EMBED_CACHE_DISK_ENTRIES", "200000"))
+
+log = logging.getLogger(__name__)
+
+_models: dict = {}  # model name → loaded model
+_model_lock = threading.Lock()
+_ready = threading.Event()
+_threads = 0  # intra-op threads per encode in a pool worker, set by init_worker (0 = the runtime default)
+_cache = EmbeddingCache(EMBED_CACHE_ENTRIES, EMBED_CACHE_PATH or None, EMBED_CACHE_DISK_ENTRIES)
+
+
+def cache_model_key(name: Optional[str] = None) -> str:
+    """
+    What a model's vectors are cached under. int8 vectors differ slightly
+    from fp32 ones, so each backend caches its own; first versions keep the
+    bare name their entries were written under before versions existed.
+    """
+    model = model_registry.get(name or MODEL_NAME)
+    key = model.name if model.version == 1 else model.key
+    return key if EMBEDDER_BACKEND == "torch" else f"{key}:{EMBEDDER_BACKEND}"
+
+
+def get_model(name: Optional[str] = None):
+    """The shared model for name (default: the active one), loaded once by whichever thread asks first."""
+    name = name or MODEL_NAME
+    model = _models.get(name)
+    if model is None:
+        with _model_lock:
+            model = _models.get(name)
+            if model is None:
+                model = _models[name] = _load_model(name)
+    return model
+
+
+def _load_model(name: str):
+    if EMBEDDER_BACKEND in ("onnx", "onnx-int8"):
+        try:
+            from tools.onnx_embedder import load
+            return load(name, EMBEDDER_BACKEND, EMBEDDER_ONNX_DIR, _threads or None)
+        except Exception:
+            log.exception("Embedder backend %s unavailable for %s, falling back to torch", EMBEDDER_BACKEND, name)
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name)
+
+
+def warmup():
+    """Load the active model and run one dummy encode, so the first real request pays for neither."""
+    try:
+        encode_raw(["warmup"])
+    except Exception:
+        log.exception("Embedder warmup failed; the model will load on first use")
+        return
+    _ready.set()
+    log.info("Embedder %s ready", MODEL_NAME)
+
+
+def is_ready() -> bool:
+    """True once warmup() has completed."""
+    return _ready.is_set()
+
+
+def cache_stats() -> dict:
+    """Hit/miss counters of the embedding cache since process start."""
+    return _cache.stats()
+
+
+def cache_lookup(texts: list, model: Optional[str] = None) -> tuple[list, dict]:
+    """Cache keys for texts under model and the cached vectors among them."""
+    prefix = cache_model_key(model)
+    keys = [EmbeddingCache.key(prefix, t) for t in texts]
+    return keys, _cache.get_many(keys)
+
+
+def cache_store(fresh: dict):
+    _cache.put_many(fresh)
+
+
+def encode_raw(texts: list, model: Optional[str] = None) -> np.ndarray:
+    """Run the model on texts, bypassing the cache (what embedding pool workers execute)."""
+    spec = model_registry.get(model or MODEL_NAME)
+    vectors = np.asarray(get_model(spec.name).encode(texts, convert_to_numpy=True), dtype="float32")
+    if vectors.ndim != 2 or vectors.shape[1] != spec.dim:
+        raise ValueError(f"{spec.name} produced {vectors.shape[-1]}-dim vectors, the registry says {spec.dim}")
+    return vectors
+
+
+def gather(keys: list, found: dict, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """The vectors of keys as one contiguous float32 (len(keys), dim) array."""
+    out = np.empty((len(keys), dim), dtype="float32")
+    for row, k in enumerate(keys):
+        out[row] = found[k]
+    return out
+
+
+def init_worker(threads: int = 0):
+    """Embedding pool process initializer: size torch's (or ONNX Runtime's) thread pool and load the active model."""
+    global _threads
+    _threads = threads
+    if threads and EMBEDDER_BACKEND == "torch":
+        import torch
+        torch.set_num_threads(threads)
+    warmup()
+
+
+def generate_embedding(text: str, model: Optional[str] = None) -> np.ndarray:
+    """Encode a single string into one float32 vector (384-dim for the default model)."""
+    return generate_embeddings([text], model)[0]
+
+
+def generate_embeddings(texts: list, model: Optional[str] = None) -> np.ndarray:
+    """
+    Batch-encode a list of strings into a float32 (len(texts), dim) array in
+    this process; only cache misses are encoded. Async code uses
+    tools/embed_service.py. Convert with .tolist() only when building JSON.
+    """
+    keys, found = cache_lookup(texts, model)
+    todo = {k: t for k, t in zip(keys, texts) if k not in found}  # unique misses, in order
+    if todo:
+        fresh = dict(zip(todo.keys(), encode_raw(list(todo.values()), model)))
+        cache_store(fresh)
+        found.update(fresh)
+    return gather(keys, found, model_registry.get(model or MODEL_NAME).dim)
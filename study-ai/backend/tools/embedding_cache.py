@@ -0,0 +1,116 @@
+"""StudyAI — two-tier (memory LRU + SQLite) cache of text embeddings."""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by sha1(model name, text). Lookups go to an in-memory
+    LRU of up to max_entries vectors first, then to a SQLite file shared by
+    all worker processes; disk hits are promoted into memory. Vectors are
+    stored as raw float32 bytes. path=None keeps only the memory tier.
+    The file keeps about the disk_entries most recently inserted rows
+    (0 = no limit); older ones are deleted as new ones come in.
+    """
+
+    _BATCH = 500  # keys per SELECT ... IN (...), under SQLite's parameter limit
+
+    def __init__(self, max_entries: int, path: Optional[str] = None, disk_entries: int = 0):
+        self.max_entries  = max_entries
+        self.disk_entries = disk_entries
+        self.path = path
+        self._memory: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.memory_hits = 0
+        self.disk_hits   = 0
+        self.misses      = 0
+
+    @staticmethod
+    def key(model: str, text: str) -> bytes:
+        return hashlib.sha1(f"{model}\0{text}".encode("utf-8")).digest()
+
+    def _conn(self) -> Optional[sqlite3.Connection]:
+        if self.path and self._db is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+                db.commit()
+                self._db = db
+            except sqlite3.Error:
+                log.exception("Embedding cache %s unavailable, using memory only", self.path)
+                self.path = None
+        return self._db
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, np.ndarray]:
+        """Cached vectors for whichever of keys are present."""
+        found: dict[bytes, np.ndarray] = {}
+        with self._lock:
+            for k in keys:
+                vec = self._memory.get(k)
+                if vec is not None:
+                    self._memory.move_to_end(k)
+                    found[k] = vec
+            self.memory_hits += len(found)
+
+            missing = list(dict.fromkeys(k for k in keys if k not in found))
+            db = self._conn() if missing else None
+            if db is not None:
+                for i in range(0, len(missing), self._BATCH):
+                    batch = missing[i:i + self._BATCH]
+                    rows = db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch,
+                    ).fetchall()
+                    for k, blob in rows:
+                        vec = np.frombuffer(blob, dtype="float32")
+                        found[bytes(k)] = vec
+                        self._remember(bytes(k), vec)
+                        self.disk_hits += 1
+            self.misses += sum(1 for k in dict.fromkeys(keys) if k not in found)
+        return found
+
+    def put_many(self, items: dict[bytes, np.ndarray]):
+        with self._lock:
+            for k, vec in items.items():
+                self._remember(k, np.asarray(vec, dtype="float32"))
+            db = self._conn()
+            if db is not None and items:
+                db.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(k, np.asarray(v, dtype="float32").tobytes()) for k, v in items.items()],
+                )
+                if self.disk_entries:
+                    # rowids only grow, so the oldest rows are those more than disk_entries below the newest
+                    db.execute(
+                        "DELETE FROM embeddings WHERE rowid <= (SELECT MAX(rowid) FROM embeddings) - ?",
+                        (self.disk_entries,),
+                    )
+                db.commit()
+
+    def _remember(self, k: bytes, vec: np.ndarray):
+        self._memory[k] = vec
+        self._memory.move_to_end(k)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits":    self.memory_hits,
+                "disk_hits":      self.disk_hits,
+                "misses":         self.misses,
+                "hit_rate":       round((lookups - self.misses) / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
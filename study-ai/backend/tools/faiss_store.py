@@ -1,141 +1,1796 @@
 """StudyAI — FAISS vector store, persisted per user to disk."""
+import asyncio
+import hashlib
 import json
+import logging
+import math
+import mmap
 import os
-import uuid
+import queue
+import re
+import struct
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Optional
 
 import faiss
 import numpy as np
 
-FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "./faiss_indexes")
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process locks apply
+    fcntl = None
 
+from tools.bm25 import BM25Index, TablePostings, reciprocal_rank_fusion
+from tools.chunk_table import ChunkMetadata, ChunkTable, content_hash
+from tools.model_registry import LEGACY_MODEL, EmbeddingModel, active as active_model
 
-class FAISSStore:
+FAISS_INDEX_PATH     = os.getenv("FAISS_INDEX_PATH", "./faiss_indexes")
+FAISS_CACHE_MB       = int(os.getenv("FAISS_CACHE_MB", "512"))
+FAISS_MERGE_SEGMENTS = int(os.getenv("FAISS_MERGE_SEGMENTS", "8"))
+# "kind:min_vectors" steps — a store is promoted to the last kind whose threshold it has reached
+FAISS_INDEX_LADDER   = os.getenv("FAISS_INDEX_LADDER", "flat:0,ivf_flat:20000,ivf_pq:200000")
+FAISS_NPROBE         = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH      = int(os.getenv("FAISS_EF_SEARCH", "64"))
+# "cosine" (normalized inner product, what MiniLM is trained for) or "l2"
+FAISS_METRIC         = os.getenv("FAISS_METRIC", "cosine")
+# Index vector codec: "none" (float32), "fp16" or "sq8" (8-bit scalar quantization), optionally
+# after a PCA reduction, e.g. "pca128,sq8". Raw vectors on disk always stay float32.
+FAISS_CODEC          = os.getenv("FAISS_CODEC", "none")
+# Stores up to this many vectors live packed in their shard's pack file instead of their own files
+FAISS_PACK_MAX_VECTORS = int(os.getenv("FAISS_PACK_MAX_VECTORS", "2000"))
+# Background threads that merge segments, reclaim deleted rows and retrain indexes
+FAISS_COMPACTION_WORKERS = int(os.getenv("FAISS_COMPACTION_WORKERS", "1"))
+# Unreferenced store files younger than this may still be in flight in another worker
+FAISS_GC_GRACE_SECONDS   = int(os.getenv("FAISS_GC_GRACE_SECONDS", "3600"))
+
+log = logging.getLogger(__name__)
+
+
+# ─── Crash-safe file helpers ─────────────────────────────────────────────────
+
+def _tmp_path(path: str) -> str:
+    """Temp name unique per process and thread, so concurrent writers never share one."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _atomic_write(path: str, write_fn):
+    """Write via a temp file in the same directory, fsync, then os.replace into place."""
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "wb") as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _write_npy(path: str, arr: np.ndarray):
+    _atomic_write(path, lambda f: np.save(f, np.ascontiguousarray(arr, dtype="float32")))
+
+
+def _write_json(path: str, obj):
+    _atomic_write(path, lambda f: f.write(json.dumps(obj, ensure_ascii=False).encode("utf-8")))
+
+
+def _write_index(path: str, index):
+    _atomic_write(path, lambda f: f.write(faiss.serialize_index(index).tobytes()))
+
+
+def _read_json(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # still mapped (Windows) or already gone — next merge retries
+
+
+# ─── Write locks ─────────────────────────────────────────────────────────────
+
+class _FileLock:
+    """
+    Exclusive advisory lock on one byte of a shard's lock file (fcntl.lockf),
+    shared with other worker processes. POSIX record locks belong to the
+    process, not the thread, so threads are kept apart by an RLock per
+    (file, byte); and a lock file is opened once and never closed, because
+    closing any descriptor of it would drop every lock we hold on it.
+    """
+
+    def __init__(self, path: str, offset: int):
+        self.offset = offset
+        self._fd    = _lock_fd(path) if fcntl is not None else None
+        self._rlock = threading.RLock()
+        self._depth = 0
+
+    def __enter__(self) -> "_FileLock":
+        self._rlock.acquire()
+        if self._depth == 0 and self._fd is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self.offset)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self.offset)
+        self._rlock.release()
+
+
+_lock_fds: dict[str, int] = {}
+_file_locks: "weakref.WeakValueDictionary[tuple, _FileLock]" = weakref.WeakValueDictionary()
+_file_locks_guard = threading.Lock()
+
+
+def _lock_fd(path: str) -> int:
+    fd = _lock_fds.get(path)
+    if fd is None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = _lock_fds[path] = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    return fd
+
+
+def _file_lock(path: str, offset: int) -> _FileLock:
+    with _file_locks_guard:
+        lock = _file_locks.get((path, offset))
+        if lock is None:
+            lock = _file_locks[(path, offset)] = _FileLock(path, offset)
+        return lock
+
+
+class _ReadWriteLock:
+    """
+    Many readers or one writer over a store's in-memory index, vectors and
+    metadata. A waiting writer holds off new readers, so a steady stream of
+    searches can't starve an upload. Both sides nest on one thread, and the
+    thread holding the write side may also read.
+    """
+
+    def __init__(self):
+        self._cond    = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._waiting = 0  # writers queued for the write side
+        self._writer: Optional[int] = None  # thread ident holding the write side
+        self._local   = threading.local()
+
+    @contextmanager
+    def reading(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        with self._cond:
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+
+_async_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def user_write_lock(user_id: str) -> asyncio.Lock:
+    """
+    Per-user asyncio lock for request handlers: concurrent uploads of one
+    user queue here instead of each parking an executor thread on the store lock.
+    """
+    lock = _async_locks.get(user_id)
+    if lock is None:
+        lock = _async_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+# ─── Tenant packs ────────────────────────────────────────────────────────────
+
+def _user_hash(user_id: str) -> str:
+    return hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+
+
+def _shard_dir(user_id: str) -> str:
+    """Users are spread over 256 subdirectories by a hash of their ID."""
+    return os.path.join(FAISS_INDEX_PATH, _user_hash(user_id)[:2])
+
+
+def _user_lock(user_id: str) -> _FileLock:
+    """
+    A user's write lock: one byte of their shard's lock file, so locking
+    adds no per-user files. (Byte 0 is the pack lock; hash collisions only
+    mean two users share a lock.)
+    """
+    path = os.path.join(_shard_dir(user_id), "locks")
+    return _file_lock(path, 1 + int(_user_hash(user_id)[2:10], 16) % 65536)
+
+
+class _PackShard:
+    """
+    The small stores of every user in one shard directory, packed into one
+    append-only file. pack.toc.json is the offset table (user_id → [offset,
+    length]); rewriting a store appends a new blob and repoints its entry,
+    and the file is repacked once more than half of it is dead.
+    The table is cached and re-read only when the file changes, so loading
+    a packed store costs one mmap of the pack file and no copies.
+    """
+
+    def __init__(self, path: str):
+        self.path     = path
+        self.toc_path = os.path.join(path, "pack.toc.json")
+        self._toc: dict = {}
+        self._stamp: Optional[tuple] = None
+        self._lock = _file_lock(os.path.join(path, "locks"), 0)  # guards the offset table across workers
+
+    @staticmethod
+    def _empty_toc() -> dict:
+        return {"file": None, "seq": 0, "dead": 0, "entries": {}}
+
+    def _read_toc(self, fresh: bool = False) -> dict:
+        try:
+            st = os.stat(self.toc_path)
+        except FileNotFoundError:
+            return self._empty_toc()
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if fresh or stamp != self._stamp:
+            self._toc, self._stamp = _read_json(self.toc_path), stamp
+        return self._toc
+
+    def entry(self, user_id: str) -> Optional[tuple]:
+        """Where a user's blob currently lives; changes with every rewrite."""
+        toc = self._read_toc()
+        entry = toc["entries"].get(user_id)
+        return (toc["file"], *entry) if entry else None
+
+    def read(self, user_id: str) -> Optional[memoryview]:
+        """A user's blob as a read-only view into the mapped pack file, or None."""
+        for fresh in (False, True):  # retry once if a repack moved the blob under us
+            toc = self._read_toc(fresh)
+            entry = toc["entries"].get(user_id)
+            if entry is None:
+                return None
+            offset, length = entry
+            try:
+                with open(os.path.join(self.path, toc["file"]), "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if len(mm) >= offset + length:
+                    return memoryview(mm)[offset:offset + length]
+            except FileNotFoundError:
+                pass
+        raise OSError(f"Pack entry for {user_id} in {self.path} is unreadable")
+
+    def write(self, user_id: str, blob: bytes):
+        with self._lock:
+            toc = json.loads(json.dumps(self._read_toc(fresh=True)))  # private copy to edit
+            if toc["file"] is None:
+                toc["seq"] += 1
+                toc["file"] = f"pack.{toc['seq']:06d}.bin"
+            with open(os.path.join(self.path, toc["file"]), "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+            old = toc["entries"].get(user_id)
+            toc["dead"] += old[1] if old else 0
+            toc["entries"][user_id] = [offset, len(blob)]
+            self._publish(toc)
+
+    def remove(self, user_id: str):
+        with self._lock:
+            toc = json.loads(json.dumps(self._read_toc(fresh=True)))
+            old = toc["entries"].pop(user_id, None)
+            if old is None:
+                return
+            toc["dead"] += old[1]
+            self._publish(toc)
+
+    def _publish(self, toc: dict):
+        """Swap in the new offset table, repacking first if the file is mostly dead."""
+        old_file = None
+        size = os.path.getsize(os.path.join(self.path, toc["file"]))
+        if toc["dead"] * 2 > size:
+            old_file = toc["file"]
+            toc = self._repack(toc)
+        _write_json(self.toc_path, toc)
+        self._read_toc(fresh=True)
+        if old_file:
+            _remove_quietly(os.path.join(self.path, old_file))
+
+    def _repack(self, toc: dict) -> dict:
+        seq = toc["seq"] + 1
+        new_file = f"pack.{seq:06d}.bin"
+        entries = {}
+
+        def copy_live(out):
+            with open(os.path.join(self.path, toc["file"]), "rb") as src:
+                for user_id, (offset, length) in toc["entries"].items():
+                    src.seek(offset)
+                    entries[user_id] = [out.tell(), length]
+                    out.write(src.read(length))
+
+        _atomic_write(os.path.join(self.path, new_file), copy_live)
+        return {"file": new_file, "seq": seq, "dead": 0, "entries": entries}
+
+
+_shards: dict[str, _PackShard] = {}
+_shards_lock = threading.Lock()
+
+
+def _pack_shard(user_id: str) -> _PackShard:
+    path = _shard_dir(user_id)
+    with _shards_lock:
+        shard = _shards.get(path)
+        if shard is None:
+            shard = _shards[path] = _PackShard(path)
+        return shard
+
+
+# ─── Index policy ────────────────────────────────────────────────────────────
+
+INDEX_KINDS = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+
+def _parse_ladder(spec: str) -> list[tuple[int, str]]:
+    steps = []
+    for step in spec.split(","):
+        kind, _, threshold = step.strip().partition(":")
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"Unknown FAISS index kind '{kind}' in FAISS_INDEX_LADDER")
+        steps.append((int(threshold or 0), kind))
+    return sorted(steps)
+
+
+def _target_kind(ntotal: int) -> str:
+    """Index kind the ladder prescribes for a store holding ntotal vectors."""
+    kind = "flat"
+    for threshold, step_kind in _parse_ladder(FAISS_INDEX_LADDER):
+        if ntotal >= threshold:
+            kind = step_kind
+    return kind
+
+
+def _fit_kind(kind: str, n: int) -> str:
+    """The kind to actually build for n vectors: IVF needs enough points to train its centroids."""
+    if kind == "ivf_pq" and n < 256:  # 8-bit PQ needs one training point per centroid
+        kind = "ivf_flat"
+    if kind in ("ivf_flat", "ivf_pq") and n < 39:
+        kind = "flat"
+    return kind
+
+
+def _prepare(vectors: np.ndarray, metric: str) -> np.ndarray:
+    """
+    Vectors as the index expects them: float32, contiguous, unit-length under
+    cosine. Only cosine copies (normalization is in place); float32 arrays
+    pass through as-is otherwise.
+    """
+    if metric != "cosine":
+        return np.ascontiguousarray(vectors, dtype="float32")
+    arr = np.array(vectors, dtype="float32", order="C", copy=True)
+    faiss.normalize_L2(arr)
+    return arr
+
+
+def _similarity(dist: float, metric: str) -> float:
     """
-    Per-user FAISS flat L2 index with JSON metadata sidecar.
-    Vectors are 384-dim (all-MiniLM-L6-v2).
-    Files: {user_id}.index  and  {user_id}.json
+    Calibrated score shared by every consumer: cosine similarity in [-1, 1].
+    L2 indexes return squared distances, and for unit vectors
+    (MiniLM output is normalized) ||a - b||² = 2 - 2·cos(a, b).
     """
+    return dist if metric == "cosine" else 1.0 - dist / 2.0
+
+
+# Trained codecs (sq8 ranges, PCA basis) need this many vectors; smaller stores fall back
+CODEC_MIN_VECTORS = 256
+
+
+def _parse_codec(spec: str) -> tuple[int, str]:
+    """"pca128,sq8" → (128, "sq8"); a PCA dimension of 0 means no reduction."""
+    pca_dim, quant = 0, "none"
+    for part in spec.split(","):
+        part = part.strip()
+        if part.startswith("pca") and part[3:].isdigit():
+            pca_dim = int(part[3:])
+        elif part in ("none", "fp16", "sq8"):
+            quant = part
+        else:
+            raise ValueError(f"Unknown FAISS codec '{part}' in FAISS_CODEC")
+    return pca_dim, quant
+
+
+def _format_codec(pca_dim: int, quant: str) -> str:
+    return f"pca{pca_dim},{quant}" if pca_dim else quant
+
+
+def _fit_codec(codec: str, n: int) -> str:
+    """The codec to actually use for n vectors: trained parts are dropped below CODEC_MIN_VECTORS."""
+    pca_dim, quant = _parse_codec(codec)
+    if n < CODEC_MIN_VECTORS:
+        pca_dim = 0
+        quant = "fp16" if quant == "sq8" else quant
+    return _format_codec(pca_dim, quant)
+
+
+def _pca_transform(vectors: np.ndarray, out_dim: int):
+    """
+    Projection onto the top singular vectors of the uncentered data, then
+    re-normalization. Unlike faiss.PCAMatrix this keeps inner products (and
+    so cosine scores) meaningful instead of measuring around the mean.
+    """
+    sample = vectors[np.random.default_rng(0).permutation(len(vectors))[:10000]]
+    _, _, vt = np.linalg.svd(sample, full_matrices=False)
+    proj = faiss.LinearTransform(vectors.shape[1], out_dim, False)
+    faiss.copy_array_to_vector(np.ascontiguousarray(vt[:out_dim], dtype="float32").ravel(), proj.A)
+    proj.is_trained = True
+    return proj, faiss.NormalizationTransform(out_dim, 2.0)
+
+
+def _build_index(
+    kind: str, dim: int, vectors: np.ndarray, ids: np.ndarray, metric: str = "l2", codec: str = "none",
+):
+    """
+    Train (if needed) and fill an ID-mapped index of the given kind, metric
+    and vector codec from raw vectors. Falls back to a simpler kind or codec
+    when there are too few vectors to train on. Returns (index, actual_kind, actual_codec).
+    """
+    vectors = _prepare(vectors, metric)
+    n = len(vectors)
+    kind  = _fit_kind(kind, n)
+    codec = _fit_codec(codec, n)
+    pca_dim, quant = _parse_codec(codec)
+    dim_in = pca_dim or dim
+
+    # IVF stores external IDs natively; flat and HNSW need an IDMap2 wrapper.
+    # (Wrapping IVF would break remove_ids: IDMap2 assumes the inner index renumbers.)
+    nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+    codes = {"none": "Flat", "fp16": "SQfp16", "sq8": "SQ8"}[quant]
+    factory = {
+        "flat":     f"IDMap2,{codes}",
+        "ivf_flat": f"IVF{nlist},{codes}",
+        "ivf_pq":   f"IVF{nlist},PQ{dim_in // 8}",  # already compressed; only PCA applies
+        "hnsw":     "IDMap2,HNSW32" + ("" if quant == "none" else f"_{codes}"),
+    }[kind]
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+    index = faiss.index_factory(dim_in, factory, faiss_metric)
+    if pca_dim:
+        proj, norm = _pca_transform(vectors, pca_dim)
+        index = faiss.IndexPreTransform(index)
+        index.prepend_transform(norm)
+        index.prepend_transform(proj)
+    if not index.is_trained:
+        index.train(vectors)  # type: ignore
+    if n:
+        index.add_with_ids(vectors, ids)  # type: ignore
+    return index, kind, codec
+
+
+def _bytes_per_vector(index) -> int:
+    """Resident bytes one vector costs in a (possibly wrapped) index: its code plus ID / graph overhead."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap2):
+        return _bytes_per_vector(index.index) + 16  # id_map entry plus reverse-map slot
+    if isinstance(index, faiss.IndexPreTransform):
+        return _bytes_per_vector(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        return _bytes_per_vector(index.storage) + index.hnsw.nb_neighbors(0) * 4
+    if isinstance(index, faiss.IndexIVF):
+        return index.code_size + 8
+    return getattr(index, "code_size", index.d * 4)
+
+
+def _is_mapped(arr) -> bool:
+    """True when an array's memory belongs to a file mapping (np.load mmap or a pack view)."""
+    base = arr
+    while base is not None and not isinstance(base, mmap.mmap):
+        base = base.base if isinstance(base, np.ndarray) else getattr(base, "obj", None)
+    return base is not None
+
+
+def _id_runs(ids: np.ndarray) -> list[list[int]]:
+    """Sorted int64 IDs as [first, end) ranges of consecutive values."""
+    if len(ids) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    return [[int(run[0]), int(run[-1]) + 1] for run in np.split(ids, breaks)]
+
+
+class ModelChanged(RuntimeError):
+    """Vectors from one embedding model were offered to a store that has moved on to another."""
+
+
+class FAISSStore:
+    """
+    Per-user FAISS index persisted as append-only files.
+    Vectors come from the embedding model recorded in the manifest (see
+    tools/model_registry.py; 384-dim all-MiniLM-L6-v2 for stores predating
+    it) and are stored as float32 .npy matrices opened with mmap. Chunk metadata is columnar (see tools/chunk_table.py):
+    IDs, material and chunk_index are small arrays, chunk text stays on disk
+    and is decoded only for the hits a search returns.
+
+    Every chunk gets a stable int64 ID (its FAISS external ID), handed out in
+    contiguous ranges per add(). The manifest keeps a material_id → ID-range
+    map, so deleting a material is a remove_ids() of exactly its vectors plus
+    a tombstone entry; the rows are physically dropped at the next merge.
+    A chunk whose text is already indexed is not added again: its material
+    just gets a reference to the existing vector ("shared" in the manifest),
+    which stays until every material referencing it is deleted.
+
+    Files live in a shard subdirectory picked by a hash of the user ID.
+    Stores of up to FAISS_PACK_MAX_VECTORS flat-indexed vectors are kept as
+    one blob (manifest, vectors, chunk table) in the shard's pack file, see
+    _PackShard. Larger stores get their own files, all listed in
+    {user_id}.manifest.json:
+      {user_id}.g{N}.index / .npy / .meta / .bm25 — base generation (full checkpoint)
+      {user_id}.s{N}.npy / .meta / .bm25          — one segment per add()
+    Once FAISS_MERGE_SEGMENTS segments pile up, or most rows are tombstoned,
+    a background compaction (see compact()) folds them into a new base.
+
+    Chunk text is also indexed for BM25 keyword search (tools/bm25.py),
+    which hybrid_search() fuses with the vector hits. The postings are built
+    when a part is written and saved with it (.bm25 files, or in the blob).
+
+    Raw vectors are kept as produced by the embedder; under FAISS_METRIC=cosine
+    the index holds unit-normalized copies and searches by inner product.
+    A store written under another metric keeps serving its old index (scores
+    are calibrated per metric, see _similarity) while the background
+    compactor rebuilds it under FAISS_METRIC.
+
+    FAISS_CODEC compresses the index itself (float16, 8-bit scalar
+    quantization, optional PCA); the codec in use is recorded in the manifest
+    next to the index kind, and a store whose codec no longer matches the
+    setting is rebuilt in the background like a ladder promotion.
 
-    DIM = 384
+    Moving a store to another model re-embeds its chunks in the background
+    (tools/model_migration.py) while searches keep using the old vectors;
+    finish_migration() then swaps in the new generation under the write locks.
+
+    Small stores search an exact flat index. As a store grows past the
+    FAISS_INDEX_LADDER thresholds it is retrained as IVF-Flat / IVF-PQ (or
+    HNSW) by the same background compactor, while searches keep using the
+    old index.
+
+    Writes hold the store's RLock plus an advisory lock (_user_lock), so
+    writers in other worker processes queue up too. get_store() hands one
+    instance to every request, so searches share the read side of a
+    read/write lock, and a write takes its write side only to swap in or
+    change the in-memory index, metadata and manifest: its files are
+    written before, and the manifest published after. Every file lands via
+    a temp file and os.replace, so readers never see a half-written one; a
+    copy that another worker has written past is reloaded before it writes
+    (and by get_store() before it is handed out).
+    """
 
     def __init__(self, user_id: str):
-        os.makedirs(FAISS_INDEX_PATH, exist_ok=True)
-        self.user_id    = user_id
-        self.index_path = os.path.join(FAISS_INDEX_PATH, f"{user_id}.index")
-        self.meta_path  = os.path.join(FAISS_INDEX_PATH, f"{user_id}.json")
-        self.index      = None
-        self.metadata: list[dict] = []  # parallel list to FAISS vectors
+        self.user_id       = user_id
+        self.shard_path    = _shard_dir(user_id)
+        os.makedirs(self.shard_path, exist_ok=True)
+        self.manifest_path = self._path("manifest.json")
+        self.index         = None
+        self.metadata = ChunkMetadata()  # vector ID → chunk metadata, one table per part
+        self._parts: list[np.ndarray] = []  # base + segment matrices, row-aligned with metadata
+        self._manifest: dict = self._empty_manifest()
+        self._lock = threading.RLock()  # guards index swaps against concurrent writes
+        self._rw = _ReadWriteLock()  # searches share it; anything changing the in-memory state holds it alone
+        self._flock = _user_lock(user_id)  # the same across workers
+        self._write_depth = 0
+        self._stamp: Optional[tuple] = None  # _disk_stamp() as of this copy's last load or write
+        self._compact_lock = threading.Lock()  # one compaction per store at a time
+        self.lexical = BM25Index()  # keyword postings, kept in step with metadata's tables
+
+    @staticmethod
+    def _empty_manifest() -> dict:
+        return {
+            "generation": 0,
+            "index_kind": "flat",
+            "codec":      _fit_codec(FAISS_CODEC, 0),
+            "metric":     FAISS_METRIC,
+            "base":       None,
+            "segments":   [],     # [{"name": "s000001", "first_id": 0}, ...]
+            "next_seq":   1,
+            "next_id":    0,
+            "materials":  {},     # material_id → [[first_id, end_id), ...]
+            "deleted":    [],     # tombstoned [first_id, end_id) ranges not yet merged away
+            "shared":     {},     # vector ID → [{"material_id", "chunk_index", "page"}, ...] of further
+                                  # materials whose identical chunk it stands for, and where it sits in each
+            "packed":     True,   # new stores start out in their shard's pack file
+            "model":      active_model().to_manifest(),  # name, dim and version of the embedding model
+        }
+
+    def _path(self, suffix: str) -> str:
+        return os.path.join(self.shard_path, f"{self.user_id}.{suffix}")
+
+    def _legacy_path(self, suffix: str) -> str:
+        """Pre-sharding single-file stores sat directly in FAISS_INDEX_PATH."""
+        return os.path.join(FAISS_INDEX_PATH, f"{self.user_id}.{suffix}")
+
+    def _new_index(self):
+        empty = np.empty((0, self.dim), dtype="float32")
+        return _build_index("flat", self.dim, empty, np.empty(0, dtype="int64"), self.metric, self.codec)[0]
+
+    @property
+    def index_kind(self) -> str:
+        return self._manifest.get("index_kind", "flat")
+
+    @property
+    def codec(self) -> str:
+        return self._manifest.get("codec", "none")  # stores predating codecs are float32
+
+    @property
+    def metric(self) -> str:
+        return self._manifest.get("metric", "l2")  # stores predating the setting are L2
+
+    @property
+    def model(self) -> EmbeddingModel:
+        return EmbeddingModel.from_manifest(self._manifest.get("model"))
 
-    def _new_index(self) -> faiss.IndexFlatL2:
-        return faiss.IndexFlatL2(self.DIM)
+    @property
+    def dim(self) -> int:
+        return self.model.dim
+
+    @property
+    def packed(self) -> bool:
+        return self._manifest.get("packed", False)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """All raw vectors on disk, including tombstoned rows not yet merged away."""
+        if not self._parts:
+            return np.empty((0, self.dim), dtype="float32")
+        if len(self._parts) == 1:
+            return self._parts[0]
+        return np.concatenate(self._parts)
+
+    def _disk_stamp(self) -> tuple:
+        """Changes whenever any worker publishes a write to this store."""
+        try:
+            st = os.stat(self.manifest_path)
+            own = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            own = None
+        return _pack_shard(self.user_id).entry(self.user_id), own
+
+    def is_stale(self) -> bool:
+        return self._stamp != self._disk_stamp()
+
+    def refresh(self):
+        """Reload if another worker has written to the store since this copy saw it."""
+        with self._lock:
+            if self.index is None or self.is_stale():
+                self._reload()
+
+    def _ensure_loaded(self):
+        """Load a store that was created but never loaded, before a search takes the read side."""
+        if self.index is None:
+            with self._lock:
+                if self.index is None:
+                    self._reload()
+
+    def _reload(self):
+        """Load into a fresh instance and swap its state in, so concurrent searches never see a half-loaded store."""
+        fresh = FAISSStore(self.user_id).load()
+        with self._rw.writing():
+            self.metadata, self._parts = fresh.metadata, fresh._parts
+            self._manifest, self.index = fresh._manifest, fresh.index
+            self._stamp, self.lexical = fresh._stamp, fresh.lexical
+
+    @contextmanager
+    def _writing(self):
+        """
+        Hold the store for a write: the in-process lock plus the cross-worker
+        file lock. Searches keep running meanwhile; the write takes the write
+        side of self._rw only around its in-memory changes. On entry a stale
+        copy is reloaded, so no other worker's write gets overwritten; on
+        exit the new disk stamp is recorded.
+        """
+        with self._lock, self._flock:
+            self._write_depth += 1
+            try:
+                if self._write_depth == 1 and (self.index is None or self.is_stale()):
+                    self._reload()
+                yield
+            finally:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    self._stamp = self._disk_stamp()
 
     def load(self) -> "FAISSStore":
-        """Load index and metadata from disk, or create an empty new one."""
-        if os.path.exists(self.index_path):
-            self.index = faiss.read_index(self.index_path)
-        else:
+        """
+        Load the store from its pack blob, or its base generation plus segments,
+        or create an empty new store. Should a crash have left both a blob and
+        own files behind, the newer generation wins.
+        """
+        for attempt in range(3):
+            try:
+                return self._load_once()
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                # A writer in another worker swapped generations mid-read; its manifest is complete now
+                log.info("FAISSStore %s: files changed during load, retrying", self.user_id)
+        return self
+
+    def _load_once(self) -> "FAISSStore":
+        self.metadata = ChunkMetadata()
+        self._parts   = []
+        self.lexical  = BM25Index()
+        self._stamp   = self._disk_stamp()
+
+        blob = _pack_shard(self.user_id).read(self.user_id)
+        own  = _read_json(self.manifest_path) if os.path.exists(self.manifest_path) else None
+        if blob is not None:
+            manifest, vectors, table, postings = self._decode_blob(blob)
+            if own is None or own["generation"] < manifest["generation"]:
+                self._manifest = manifest
+                self.index, _, _ = _build_index(
+                    self.index_kind, self.dim, vectors, table.ids, self.metric, self.codec,
+                )
+                self._parts = [vectors]
+                self.metadata.append(table)
+                if postings is not None:
+                    self.lexical.adopt(table, postings)
+                return self
+
+        if own is None:
+            self._manifest = self._empty_manifest()
+            if os.path.exists(self._legacy_path("json")):
+                self._manifest["model"] = LEGACY_MODEL.to_manifest()  # what the single-file stores were built with
             self.index = self._new_index()
+            if os.path.exists(self._legacy_path("json")):
+                self._migrate_legacy()
+            return self
 
-        if os.path.exists(self.meta_path):
-            with open(self.meta_path, "r", encoding="utf-8") as f:
-                self.metadata = json.load(f)
-        else:
-            self.metadata = []
+        self._manifest = own
+        self.index = self._new_index()
+        base = self._manifest.get("base")
+        if base:
+            self.index = faiss.read_index(self._path(f"{base}.index"))
+            self._parts.append(np.load(self._path(f"{base}.npy"), mmap_mode="r"))
+            self._append_table(base)
+
+        for seg in self._manifest["segments"]:
+            arr = np.load(self._path(f"{seg['name']}.npy"), mmap_mode="r")
+            self.index.add_with_ids(_prepare(arr, self.metric), self._append_table(seg["name"]).ids)  # type: ignore
+            self._parts.append(arr)
 
+        if self._manifest["deleted"]:
+            self._remove_ranges(self._manifest["deleted"])
         return self
 
+    def _append_table(self, name: str) -> ChunkTable:
+        """Map part name's chunk table into metadata, along with its saved postings."""
+        table = ChunkTable.read(self._path(f"{name}.meta"))
+        self.metadata.append(table)
+        try:
+            self.lexical.adopt(table, TablePostings.read(self._path(f"{name}.bm25")))
+        except FileNotFoundError:
+            pass  # written before postings were saved: built on first use, saved at the next merge
+        return table
+
+    def _migrate_legacy(self):
+        """
+        Import an old single-file store ({user_id}.index / .json, optionally .npy)
+        as the first base generation. Very old sidecars kept one 'embedding' list
+        per metadata entry; otherwise the vectors come from the flat index itself.
+        """
+        legacy_index = self._legacy_path("index")
+        legacy_vecs  = self._legacy_path("npy")
+        legacy_meta  = _read_json(self._legacy_path("json"))
+
+        embedded = [m.pop("embedding", None) for m in legacy_meta]
+        if os.path.exists(legacy_vecs):
+            vectors = np.load(legacy_vecs)
+        elif legacy_meta and all(e is not None for e in embedded):
+            vectors = np.asarray(embedded, dtype="float32").reshape(-1, self.dim)
+        elif os.path.exists(legacy_index):
+            vectors = faiss.read_index(legacy_index).reconstruct_n(0, len(legacy_meta))
+        else:
+            vectors = np.empty((0, self.dim), dtype="float32")
+
+        ids = self._allocate_ids(legacy_meta)
+        self.index.add_with_ids(_prepare(vectors, self.metric), ids)  # type: ignore
+        self._parts   = [vectors]
+        self.metadata = ChunkMetadata([ChunkTable.build(ids, legacy_meta)])
+        self.save()
+
+        for suffix in ("index", "json", "npy"):
+            _remove_quietly(self._legacy_path(suffix))
+
+    def _allocate_ids(self, meta_list: list[dict]) -> np.ndarray:
+        """Hand out the next contiguous block of vector IDs and record it per material."""
+        first = self._manifest["next_id"]
+        ids = np.arange(first, first + len(meta_list), dtype="int64")
+        self._manifest["next_id"] = first + len(meta_list)
+
+        materials = self._manifest["materials"]
+        for vid, meta in zip(ids.tolist(), meta_list):
+            meta["_vector_id"] = str(vid)
+            mid = meta.get("material_id")
+            if mid is None:
+                continue
+            ranges = materials.setdefault(mid, [])
+            if ranges and ranges[-1][1] == vid:
+                ranges[-1][1] = vid + 1  # extend the current run
+            else:
+                ranges.append([vid, vid + 1])
+        return ids
+
+    def _remove_ranges(self, ranges: list[list[int]]):
+        """Drop the given [first, end) ID ranges from the live index and metadata."""
+        assert self.index is not None
+        ids = np.concatenate([np.arange(lo, hi, dtype="int64") for lo, hi in ranges])
+        try:
+            self.index.remove_ids(faiss.IDSelectorBatch(ids))
+        except RuntimeError:
+            pass  # HNSW can't delete; search skips IDs without metadata until the next rebuild
+        self.metadata.remove(ids)
+
+    def _live_rows(self) -> tuple[np.ndarray, np.ndarray]:
+        """Raw vectors and IDs of every non-deleted chunk, gathered from the mmapped parts."""
+        if not self._parts:
+            return np.empty((0, self.dim), dtype="float32"), np.empty(0, dtype="int64")
+        keep = self.metadata.alive
+        return np.ascontiguousarray(self.vectors[keep], dtype="float32"), self.metadata.all_ids[keep]
+
+    def rebuild_index(self, kind: Optional[str] = None, codec: Optional[str] = None):
+        """
+        Build a fresh index of the given kind (default: whatever the ladder
+        prescribes) and codec (default: FAISS_CODEC) from the raw vectors and
+        swap it in, as a compaction (see compact()).
+        """
+        self.compact(kind or _target_kind(len(self.metadata)), codec or FAISS_CODEC)
+
+    def _maybe_promote(self):
+        """
+        Queue a background rebuild when the store has outgrown its index kind
+        or codec, or predates FAISS_METRIC. Kinds are compared as they would
+        be built for the store's size, so one too small to train the
+        prescribed kind isn't rebuilt into the same one after every add.
+        """
+        kind  = _fit_kind(_target_kind(len(self.metadata)), len(self.metadata))
+        codec = _fit_codec(FAISS_CODEC, len(self.metadata))
+        if kind != self.index_kind or codec != self.codec or self.metric != FAISS_METRIC:
+            if self.metric != FAISS_METRIC:
+                log.info("FAISSStore %s: queueing index rebuild from %s to %s", self.user_id, self.metric, FAISS_METRIC)
+            _compactor.submit(self, rebuild=(kind, codec))
+
+    # ─── Compaction ──────────────────────────────────────────────────────────
+
+    def compact(self, kind: Optional[str] = None, codec: Optional[str] = None) -> bool:
+        """
+        Fold segments and tombstoned rows into a new base generation, and
+        retrain the index when a kind or codec is given (under FAISS_METRIC,
+        from the raw vectors, which are never normalized on disk). The new generation
+        is built off to the side without the write locks: searches keep using
+        the current index and writes keep landing as segments and tombstones,
+        which are carried over at the swap. Returns False if the store was
+        checkpointed by someone else meanwhile and the build was discarded.
+        """
+        with self._compact_lock:
+            snap = self._compact_snapshot(kind, codec)
+            if snap is None:
+                return True
+            built = self._compact_build(snap)
+            return self._compact_swap(snap, built)
+
+    def _compact_snapshot(self, kind: Optional[str], codec: Optional[str]) -> Optional[dict]:
+        """Capture what the new generation will hold; None if there was nothing to do or it was done inline."""
+        with self._writing():
+            assert self.index is not None
+            rebuild = kind is not None
+            kind   = kind or self.index_kind
+            codec  = codec or self.codec
+            metric = FAISS_METRIC if rebuild else self.metric
+            vectors, ids = self._live_rows()
+
+            if kind == "flat" and len(ids) <= FAISS_PACK_MAX_VECTORS:
+                # Headed for the pack file: a small blob rewrite, not worth a side build
+                if rebuild:
+                    index, kind, codec = _build_index(kind, self.dim, vectors, ids, metric, codec)
+                    with self._rw.writing():
+                        self.index = index
+                        self._manifest.update(index_kind=kind, codec=codec, metric=metric)
+                self._save()
+                return None
+            if not (rebuild or self.packed or self._manifest["segments"] or self._manifest["deleted"]):
+                return None
+
+            return {
+                "kind": kind, "codec": codec, "metric": metric, "old_metric": self.metric, "model": self.model,
+                "vectors": vectors, "ids": ids, "table": self.metadata.live_table(),
+                "postings": self.lexical.sync(self.metadata), "live_rows": self.metadata.live_rows(),
+                # HNSW can't drop deleted vectors, so its graph is always rebuilt
+                "index": None if rebuild or kind == "hnsw" else faiss.serialize_index(self.index),
+                "name": f"g{self._manifest['generation'] + 1:06d}-{os.urandom(3).hex()}",
+                "parts": len(self._parts),
+                "packed": self.packed,
+                "stamp": self._stamp,
+                "base": self._manifest.get("base"),
+                "segments": [seg["name"] for seg in self._manifest["segments"]],
+                "deleted": [list(r) for r in self._manifest["deleted"]],
+            }
+
+    def _compact_build(self, snap: dict):
+        """Write the new generation's files; runs without any store lock held."""
+        name = snap["name"]
+        if snap["index"] is not None:
+            index = None  # unchanged kind: the live index already matches the new base
+            _atomic_write(self._path(f"{name}.index"), lambda f: f.write(snap["index"].tobytes()))
+        else:
+            index, snap["kind"], snap["codec"] = _build_index(
+                snap["kind"], snap["model"].dim, snap["vectors"], snap["ids"], snap["metric"], snap["codec"],
+            )
+            _write_index(self._path(f"{name}.index"), index)
+        _write_npy(self._path(f"{name}.npy"), snap["vectors"])
+        _atomic_write(self._path(f"{name}.meta"), snap["table"].write_to)
+        snap["postings"] = TablePostings.concat(snap["postings"], snap["live_rows"])
+        _atomic_write(self._path(f"{name}.bm25"), snap["postings"].write_to)
+        return index
+
+    def _compact_swap(self, snap: dict, index) -> bool:
+        """Publish the new generation, carrying over writes made since the snapshot, and drop the old files."""
+        name = snap["name"]
+        new_files = [self._path(f"{name}.{ext}") for ext in ("index", "npy", "meta", "bm25")]
+        with self._writing():  # may reload first if another worker wrote meanwhile
+            manifest = self._manifest
+            segments = [seg["name"] for seg in manifest["segments"]]
+            deleted  = manifest["deleted"]
+            if (
+                manifest.get("base") != snap["base"]
+                or self.packed != snap["packed"]
+                or (self.packed and self._stamp != snap["stamp"])
+                or segments[:len(snap["segments"])] != snap["segments"]
+                or deleted[:len(snap["deleted"])] != snap["deleted"]
+                or self.metric != snap["old_metric"]
+                or self.model != snap["model"]
+            ):
+                log.info("FAISSStore %s: checkpointed during compaction, discarding %s", self.user_id, name)
+                for path in new_files:
+                    _remove_quietly(path)
+                return False
+
+            old_files    = self._referenced_files()
+            new_segments = manifest["segments"][len(snap["segments"]):]
+            new_deleted  = deleted[len(snap["deleted"]):]
+            metadata = ChunkMetadata([ChunkTable.read(new_files[2]), *self.metadata.tables[snap["parts"]:]])
+            parts    = [np.load(new_files[1], mmap_mode="r"), *self._parts[snap["parts"]:]]
+            gone = np.concatenate([np.arange(lo, hi, dtype="int64") for lo, hi in new_deleted] or
+                                  [np.empty(0, dtype="int64")])
+            metadata.remove(gone)
+
+            if index is not None:  # a new index: replay the writes it missed
+                new_rows = len(snap["ids"])
+                if len(parts) > 1:
+                    index.add_with_ids(  # type: ignore
+                        _prepare(np.concatenate(parts[1:]), snap["metric"]), metadata.all_ids[new_rows:],
+                    )
+                if len(gone) and snap["kind"] != "hnsw":
+                    index.remove_ids(faiss.IDSelectorBatch(gone))
+
+            manifest = dict(
+                manifest, generation=manifest["generation"] + 1, base=name, segments=new_segments,
+                deleted=new_deleted, index_kind=snap["kind"], codec=snap["codec"], metric=snap["metric"], packed=False,
+            )
+            _write_json(self.manifest_path, manifest)
+            with self._rw.writing():
+                if index is not None:
+                    self.index = index
+                self._parts, self.metadata, self._manifest = parts, metadata, manifest
+                self.lexical.adopt(metadata.tables[0], snap["postings"])
+                self.lexical.sync(metadata)  # drops the merged tables' postings
+            if snap["packed"]:
+                _pack_shard(self.user_id).remove(self.user_id)
+            keep = set(self._referenced_files())
+            for path in old_files:
+                if path not in keep:
+                    _remove_quietly(path)
+            self._collect_garbage()
+        _cache.put(self)
+        log.info("FAISSStore %s: compacted into %s (%s/%s, %d vectors)",
+                 self.user_id, name, snap["kind"], snap["codec"], len(self.metadata))
+        return True
+
+    def _collect_garbage(self):
+        """
+        Delete this user's generation, segment and temp files that no manifest
+        references: leftovers of crashed writers or discarded compactions.
+        Files younger than FAISS_GC_GRACE_SECONDS are spared, since another
+        worker may still be writing them.
+        """
+        keep = set(self._referenced_files())
+        prefix = f"{self.user_id}."
+        cutoff = time.time() - FAISS_GC_GRACE_SECONDS
+        for entry in os.scandir(self.shard_path):
+            if not entry.name.startswith(prefix) or entry.path in keep:
+                continue
+            if not _GC_PATTERN.match(entry.name[len(prefix):]):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    _remove_quietly(entry.path)
+            except FileNotFoundError:
+                pass
+
+    # ─── Model migration ─────────────────────────────────────────────────────
+
+    def migration_snapshot(self) -> ChunkTable:
+        """The live chunks as of now, to re-embed off the locks (tables never change once built)."""
+        with self._writing():
+            return self.metadata.live_table()
+
+    def migration_delta(self, done: np.ndarray) -> ChunkTable:
+        """Live chunks whose IDs are not in done, i.e. added since the snapshot."""
+        with self._writing():
+            live = self.metadata.live_table()
+        return live.take(np.flatnonzero(~np.isin(live.ids, done)))
+
+    def migration_index(self, model: EmbeddingModel, vectors: np.ndarray, ids: np.ndarray) -> tuple:
+        """
+        The index for re-embedded vectors, built without the locks: the kind
+        and codec the ladder prescribes, under FAISS_METRIC.
+        Returns (index, kind, codec, rows it holds) for finish_migration().
+        """
+        kind, codec = _target_kind(len(ids)), FAISS_CODEC
+        index, kind, codec = _build_index(kind, model.dim, vectors, ids, FAISS_METRIC, codec)
+        return index, kind, codec, len(ids)
+
+    def finish_migration(self, model: EmbeddingModel, vectors: np.ndarray, ids: np.ndarray, built: tuple) -> bool:
+        """
+        Cut the store over to model. vectors are the re-embedded chunks with
+        the given IDs (ascending); built is migration_index() over a prefix of
+        them. The rest are added, chunks deleted meanwhile dropped, and the
+        result checkpointed as a new generation. Returns False, changing
+        nothing, if chunks added meanwhile are still missing from ids.
+        """
+        index, kind, codec, indexed = built
+        with self._writing():
+            if self.model == model:
+                return True  # another worker finished first
+            live = self.metadata.live_table()
+            pos = np.searchsorted(ids, live.ids)
+            if np.any(pos >= len(ids)) or not np.array_equal(ids[np.minimum(pos, len(ids) - 1)], live.ids):
+                return False
+
+            if len(ids) > indexed:
+                index.add_with_ids(_prepare(vectors[indexed:], FAISS_METRIC), ids[indexed:])  # type: ignore
+            gone = np.setdiff1d(ids, live.ids)
+            if len(gone):
+                try:
+                    index.remove_ids(faiss.IDSelectorBatch(gone))
+                except RuntimeError:
+                    pass  # HNSW: _save() rebuilds it, as its size no longer matches
+                vectors = vectors[pos]
+
+            postings = self.lexical.live_postings(self.metadata)
+            with self._rw.writing():
+                self._manifest.update(model=model.to_manifest(), index_kind=kind, codec=codec, metric=FAISS_METRIC)
+                self.lexical.adopt(live, postings)
+                self.index, self._parts, self.metadata = index, [vectors], ChunkMetadata([live])
+            self._save()
+        _cache.put(self)
+        log.info("FAISSStore %s: migrated %d vectors to %s", self.user_id, len(self.metadata), model.key)
+        return True
+
     def save(self):
-        """Persist index and metadata to disk."""
-        faiss.write_index(self.index, self.index_path)
-        with open(self.meta_path, "w", encoding="utf-8") as f:
-            json.dump(self.metadata, f, ensure_ascii=False)
+        """Checkpoint the store under the write locks, see _save()."""
+        with self._writing():
+            self._save()
 
-    def add(self, embeddings: list[list[float]], meta_list: list[dict]) -> list[str]:
+    def _save(self):
         """
-        Add batch of embedding vectors with associated metadata.
-        Returns list of newly assigned vector IDs (str UUIDs stored in meta).
+        Write a full checkpoint and drop all segments and tombstoned rows:
+        into the shard's pack file while the store is small enough, else as a
+        new base generation of its own. Readers only follow the manifest or
+        the pack offset table, which are swapped last, so a crash mid-write
+        leaves the previous generation intact. Searches keep using the
+        in-memory copy until the new one is swapped in after the writes.
         """
-        if self.index is None:
-            self.load()
+        assert self.index is not None
+        old_files  = self._referenced_files()
+        was_packed = self.packed
+        gen   = self._manifest["generation"] + 1
+        index = self.index
 
-        arr = np.array(embeddings, dtype="float32")
-        if self.index is not None:
-            self.index.add(arr)  # type: ignore
+        vectors, ids = self._live_rows()
+        table = self.metadata.live_table()
+        postings = self.lexical.live_postings(self.metadata)
+        if self.index_kind == "flat" and len(ids) <= FAISS_PACK_MAX_VECTORS:
+            manifest = dict(self._manifest, generation=gen, base=None, segments=[], deleted=[], packed=True)
+            shard = _pack_shard(self.user_id)
+            shard.write(self.user_id, self._encode_blob(manifest, vectors, table, postings))
+            _, vectors, table, _ = self._decode_blob(shard.read(self.user_id))  # keep only the mapped copy
+            old_files.append(self.manifest_path)
+        else:
+            if index.ntotal != len(ids):  # HNSW still holds deleted vectors
+                index, _, _ = _build_index(self.index_kind, self.dim, vectors, ids, self.metric, self.codec)
+
+            base = f"g{gen:06d}"
+            _write_index(self._path(f"{base}.index"), index)
+            _write_npy(self._path(f"{base}.npy"), vectors)
+            _atomic_write(self._path(f"{base}.meta"), table.write_to)
+            _atomic_write(self._path(f"{base}.bm25"), postings.write_to)
+
+            manifest = dict(self._manifest, generation=gen, base=base, segments=[], deleted=[], packed=False)
+            _write_json(self.manifest_path, manifest)
+            vectors = np.load(self._path(f"{base}.npy"), mmap_mode="r")
+            table   = ChunkTable.read(self._path(f"{base}.meta"))
+
+        with self._rw.writing():
+            self.index, self._manifest = index, manifest
+            self._parts   = [vectors]
+            self.metadata = ChunkMetadata([table])
+            self.lexical.adopt(table, postings)
+            self.lexical.sync(self.metadata)  # drops the old parts' postings
+        if was_packed and not manifest["packed"]:
+            _pack_shard(self.user_id).remove(self.user_id)
+
+        for path in old_files:
+            _remove_quietly(path)
+
+    _BLOB_MAGIC = b"SAIPACK1"
+
+    @classmethod
+    def _encode_blob(cls, manifest: dict, vectors: np.ndarray, table: ChunkTable, postings: TablePostings) -> bytes:
+        """
+        A whole small store as one pack entry: magic, u64 header length,
+        JSON header, vectors, chunk table, BM25 postings.
+        """
+        table_bytes = table.to_bytes()
+        body = np.ascontiguousarray(vectors, dtype="float32").tobytes() + table_bytes + postings.to_bytes()
+        header = json.dumps({
+            "manifest": manifest, "rows": len(vectors), "table_bytes": len(table_bytes),
+            "crc": zlib.crc32(body),
+        }).encode("utf-8")
+        return cls._BLOB_MAGIC + struct.pack("<Q", len(header)) + header + body
+
+    @classmethod
+    def _blob_header(cls, blob: memoryview, user_id: str) -> tuple[dict, memoryview]:
+        """A pack entry's JSON header and the (unchecked) body after it."""
+        magic_len = len(cls._BLOB_MAGIC)
+        if bytes(blob[:magic_len]) != cls._BLOB_MAGIC:
+            raise ValueError(f"Corrupt pack entry for {user_id}")
+        (header_len,) = struct.unpack_from("<Q", blob, magic_len)
+        start = magic_len + 8
+        return json.loads(bytes(blob[start:start + header_len])), blob[start + header_len:]
+
+    def _decode_blob(self, blob: memoryview) -> tuple[dict, np.ndarray, ChunkTable, Optional[TablePostings]]:
+        """
+        Zero-copy views of a pack entry: the vectors and chunk payload stay in
+        the file mapping. Entries written before postings were packed have none.
+        """
+        header, body = self._blob_header(blob, self.user_id)
+        if zlib.crc32(body) != header["crc"]:
+            raise ValueError(f"Checksum mismatch in pack entry for {self.user_id}")
+        rows    = header["rows"]
+        dim     = EmbeddingModel.from_manifest(header["manifest"].get("model")).dim
+        vectors = np.frombuffer(body, dtype="float32", count=rows * dim).reshape(rows, dim)
+        table   = ChunkTable.from_buffer(body[rows * dim * 4:], mapping=blob.obj)
+        postings = None
+        if "table_bytes" in header:
+            postings = TablePostings.from_buffer(body[rows * dim * 4 + header["table_bytes"]:])
+        return header["manifest"], vectors, table, postings
+
+    def _referenced_files(self) -> list[str]:
+        files = []
+        if self._manifest.get("base"):
+            base = self._manifest["base"]
+            files += [self._path(f"{base}.{ext}") for ext in ("index", "npy", "meta", "bm25")]
+        for seg in self._manifest["segments"]:
+            files += [self._path(f"{seg['name']}.{ext}") for ext in ("npy", "meta", "bm25")]
+        return files
+
+    def _append_segment(self, arr: np.ndarray, table: ChunkTable):
+        """
+        Persist only the new vectors, metadata and BM25 postings, swap them
+        into the index and metadata, then publish them via the manifest.
+        """
+        postings = TablePostings.build(table)
+        prepared = _prepare(arr, self.metric)
+        if self.packed:  # a pack entry is rewritten whole; save() also moves the store out once it grows
+            arr = np.array(arr, dtype="float32")  # own copy: arr may be the caller's buffer
+            with self._rw.writing():
+                self.index.add_with_ids(prepared, table.ids)  # type: ignore
+                self._parts.append(arr)
+                self.metadata.append(table)
+                self.lexical.adopt(table, postings)
+            self._save()
+            return
+
+        seq = self._manifest["next_seq"]
+        seg = f"s{seq:06d}"
+        _write_npy(self._path(f"{seg}.npy"), arr)
+        _atomic_write(self._path(f"{seg}.meta"), table.write_to)
+        _atomic_write(self._path(f"{seg}.bm25"), postings.write_to)
+        arr   = np.load(self._path(f"{seg}.npy"), mmap_mode="r")
+        table = ChunkTable.read(self._path(f"{seg}.meta"))
+
+        with self._rw.writing():
+            self.index.add_with_ids(prepared, table.ids)  # type: ignore
+            self._manifest["segments"].append({"name": seg, "first_id": int(table.ids[0])})
+            self._manifest["next_seq"] = seq + 1
+            self._parts.append(arr)
+            self.metadata.append(table)
+            self.lexical.adopt(table, postings)
+        _write_json(self.manifest_path, self._manifest)
+        if len(self._manifest["segments"]) >= FAISS_MERGE_SEGMENTS:
+            _compactor.submit(self)
+
+    def memory_usage(self) -> int:
+        """Approximate resident bytes: the encoded index, metadata columns and BM25 postings (mapped files are not counted)."""
+        with self._rw.reading():
+            index_bytes = self.index.ntotal * _bytes_per_vector(self.index) if self.index is not None else 0
+            vec_bytes = sum(p.nbytes for p in self._parts if not _is_mapped(p))
+            return index_bytes + vec_bytes + self.metadata.nbytes + self.lexical.nbytes
+
+    def add(self, embeddings: np.ndarray, meta_list: list[dict], model: Optional[EmbeddingModel] = None) -> list[str]:
+        """
+        Add batch of embedding vectors with associated metadata. A float32
+        (n, dim) array is used without copying; lists are still accepted.
+        model names the embedding model that produced them; if the store has
+        been migrated to another one meanwhile, ModelChanged is raised.
+        A chunk whose normalized chunk_text is already indexed (see
+        content_hash) gets no new vector: the existing one is referenced
+        for its material instead. Returns the vector ID of every chunk
+        (stringified int64, also stored in meta), shared ones included.
+        """
+        if not meta_list:
+            return []
 
-        ids = []
         for meta in meta_list:
-            vid = str(uuid.uuid4())
-            meta["_vector_id"] = vid
-            self.metadata.append(meta)
-            ids.append(vid)
+            meta.pop("embedding", None)  # vectors live in the .npy matrices, never in the sidecar
+        hashes = np.array([content_hash(m.get("chunk_text")) for m in meta_list], dtype="uint64")
+        with self._writing():
+            assert self.index is not None
+            if model is not None and model != self.model:
+                raise ModelChanged(f"Store {self.user_id} now uses {self.model.key}, not {model.key}")
+            arr = self._check_dim(embeddings)
+            existing = self.metadata.find_hashes(hashes)
+            fresh, first_of = [], {}
+            for row, (h, vid) in enumerate(zip(hashes.tolist(), existing.tolist())):
+                if vid < 0 and (h == 0 or h not in first_of):
+                    first_of.setdefault(h, row)
+                    fresh.append(row)
 
-        self.save()
-        return ids
+            if fresh:
+                fresh_meta = [meta_list[row] for row in fresh]
+                with self._rw.writing():
+                    ids = self._allocate_ids(fresh_meta)
+                vectors = arr if len(fresh) == len(arr) else arr[fresh]
+                self._append_segment(vectors, ChunkTable.build(ids, fresh_meta))
+
+            if len(fresh) < len(meta_list):
+                fresh_rows = set(fresh)
+                with self._rw.writing():
+                    for row, (h, vid) in enumerate(zip(hashes.tolist(), existing.tolist())):
+                        if row in fresh_rows:
+                            continue
+                        if vid < 0:  # repeated within this batch
+                            vid = int(meta_list[first_of[h]]["_vector_id"])
+                        meta_list[row]["_vector_id"] = str(vid)
+                        self._add_reference(meta_list[row], vid)
+                log.info("FAISSStore %s: %d of %d chunks already indexed, reused their vectors",
+                         self.user_id, len(meta_list) - len(fresh), len(meta_list))
+                self._write_manifest()
+        _cache.put(self)
+        self._maybe_promote()
+        return [m["_vector_id"] for m in meta_list]
+
+    def _check_dim(self, vectors) -> np.ndarray:
+        """vectors as a float32 (n, dim) array (no copy if it already is one), or ModelChanged."""
+        arr = np.asarray(vectors, dtype="float32")
+        if arr.size == 0:
+            return arr.reshape(0, self.dim)
+        if arr.shape[-1] != self.dim:
+            raise ModelChanged(f"{arr.shape[-1]}-dim vectors for store {self.user_id}, which uses {self.model.key}")
+        return arr.reshape(-1, self.dim)
+
+    def _add_reference(self, meta: dict, vid: int):
+        """Let meta's material filters and deletion cover an existing vector, remembering the chunk's place in it."""
+        material_id = meta.get("material_id")
+        if material_id is None:
+            return
+        ranges = self._manifest["materials"].setdefault(material_id, [])
+        if any(lo <= vid < hi for lo, hi in ranges):
+            return
+        ranges.append([vid, vid + 1])
+        ref = {"material_id": material_id, **{k: meta[k] for k in _PLACE_KEYS if k in meta}}
+        self._manifest.setdefault("shared", {}).setdefault(str(vid), []).append(ref)
+
+    def _write_manifest(self):
+        """Persist a manifest-only change (references, tombstones)."""
+        if self.packed:  # the manifest lives inside the pack entry: rewrite the small blob
+            self._save()
+        else:
+            _write_json(self.manifest_path, self._manifest)
+
+    def find_duplicates(self, texts: list[str]) -> dict[int, np.ndarray]:
+        """
+        Raw vectors of chunks already indexed with the same normalized text,
+        keyed by position in texts, so callers can skip embedding them.
+        """
+        hashes = np.array([content_hash(t) for t in texts], dtype="uint64")
+        self._ensure_loaded()
+        with self._rw.reading():
+            metadata, parts = self.metadata, self._parts
+            found = metadata.find_hashes(hashes)
+            return {
+                pos: self._raw_vector(metadata, parts, vid)
+                for pos, vid in enumerate(found.tolist()) if vid >= 0
+            }
 
     def search(
         self,
-        query_embedding: list[float],
+        query_embedding: np.ndarray,
         top_k: int = 5,
         exclude_material: Optional[str] = None,
+        material_id: Optional[str] = None,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        min_score: Optional[float] = None,
     ) -> list[dict]:
         """
-        Search for nearest neighbours, optionally excluding chunks
-        from a specific material (to avoid self-retrieval).
-        Returns list of metadata dicts with added 'score' key.
+        Search for nearest neighbours, optionally restricted to one material
+        or excluding one (to avoid self-retrieval). Filters are pushed into
+        FAISS as ID selectors built from the material ID ranges, so filtered
+        searches return up to top_k hits without over-fetching.
+        nprobe (IVF) and ef_search (HNSW) trade recall for speed on ANN
+        indexes and default to FAISS_NPROBE / FAISS_EF_SEARCH.
+        Returns list of metadata dicts with added 'score' key (cosine
+        similarity, see _similarity); hits below min_score are cut off.
         """
-        if self.index is None:
-            self.load()
-        
+        return self.search_many(
+            np.asarray(query_embedding, dtype="float32").reshape(1, -1), top_k=top_k,
+            exclude_material=exclude_material, material_id=material_id, nprobe=nprobe, ef_search=ef_search, min_score=min_score,
+        )[0]
+
+    def search_many(
+        self,
+        query_embeddings,
+        top_k: int = 5,
+        exclude_material: Optional[str] = None,
+        material_id: Optional[str] = None,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        min_score: Optional[float] = None,
+    ) -> list[list[dict]]:
+        """
+        Batched search(): runs every query in one FAISS call with the filters
+        built once for the whole batch. Returns one result list per query, in order.
+        Holds the read side of the store lock throughout, so writes wait.
+        """
+        self._ensure_loaded()
+        with self._rw.reading():
+            return self._search_many(query_embeddings, top_k, exclude_material, material_id,
+                                     nprobe, ef_search, min_score)
+
+    def _search_many(self, query_embeddings, top_k, exclude_material, material_id,
+                     nprobe, ef_search, min_score) -> list[list[dict]]:
         assert self.index is not None, "Index should be loaded"
-        
-        if self.index.ntotal == 0:
-            return []
 
-        query = np.array([query_embedding], dtype="float32")
-        # Retrieve extra results so we can filter without running short
-        k = min(top_k + 20, self.index.ntotal)
-        distances, indices = self.index.search(query, k)  # type: ignore
+        query = _prepare(self._check_dim(query_embeddings), self.metric)
+        materials = self._manifest["materials"]
+        if material_id is not None:
+            k = min(top_k, sum(hi - lo for lo, hi in materials.get(material_id, [])))
+        else:
+            k = min(top_k, len(self.metadata))
+        if k <= 0 or len(query) == 0:
+            return [[] for _ in range(len(query))]
+
+        sel = self._id_selector(material_id, exclude_material)
+        params = self._search_params(k, nprobe, ef_search, sel)
+        distances, indices = self.index.search(query, k, params=params)  # type: ignore
+
+        # Chunk text is decoded here, for the final top-k hits only
+        grouped = []
+        for row_dist, row_idx in zip(distances, indices):
+            results = []
+            for dist, idx in zip(row_dist.tolist(), row_idx.tolist()):
+                if idx < 0 or idx not in self.metadata:  # padding, or deleted but still in HNSW
+                    continue
+                score = _similarity(dist, self.metric)
+                if min_score is not None and score < min_score:
+                    break  # hits come best-first, so the rest are below the cutoff too
+                meta = self.metadata[idx]  # a fresh dict, safe for callers to mutate
+                self._resolve_material(meta, material_id)
+                meta["score"] = score
+                results.append(meta)
+            grouped.append(results)
+        return grouped
+
+    def lexical_search(
+        self,
+        query: str,
+        top_k: int = 5,
+        exclude_material: Optional[str] = None,
+        material_id: Optional[str] = None,
+    ) -> list[dict]:
+        """
+        BM25 keyword search over chunk_text, with the same material filters
+        as search(). Returns metadata dicts with an added 'bm25' key, best first.
+        """
+        self._ensure_loaded()
+        with self._rw.reading():
+            metadata = self.metadata
+            allowed = self._material_mask(metadata, material_id, exclude_material)
+            results = []
+            for vid, bm25 in self.lexical.search(metadata, query, top_k, allowed):
+                meta = metadata.get(vid)
+                if meta is not None:
+                    self._resolve_material(meta, material_id)
+                    meta["bm25"] = bm25
+                    results.append(meta)
+            return results
+
+    def hybrid_search(
+        self,
+        query: str,
+        query_embedding: np.ndarray,
+        top_k: int = 5,
+        exclude_material: Optional[str] = None,
+        material_id: Optional[str] = None,
+        candidates: Optional[int] = None,
+        min_score: Optional[float] = None,
+        rrf_k: int = 60,
+    ) -> list[dict]:
+        """
+        Vector and BM25 search fused by reciprocal rank fusion, so exact terms
+        (formula names, acronyms) surface even when the embedding misses them.
+        Each list contributes its best `candidates` hits (default 4 × top_k).
+        Every hit carries 'score' (cosine similarity, computed from the raw
+        vector for keyword-only hits) and 'rrf_score'; keyword matches also
+        'bm25'. min_score only cuts hits without a keyword match.
+        """
+        candidates = candidates or max(4 * top_k, 20)
+        self._ensure_loaded()
+        with self._rw.reading():  # both lists and the keyword-only cosines from one version of the store
+            return self._hybrid_search(query, query_embedding, top_k, exclude_material, material_id,
+                                       candidates, min_score, rrf_k)
+
+    def _hybrid_search(self, query, query_embedding, top_k, exclude_material, material_id,
+                       candidates, min_score, rrf_k) -> list[dict]:
+        filters = {"exclude_material": exclude_material, "material_id": material_id}
+        vector_hits  = self.search(query_embedding, top_k=candidates, **filters)
+        lexical_hits = self.lexical_search(query, top_k=candidates, **filters)
+
+        hits = {int(h["_vector_id"]): h for h in vector_hits}
+        for h in lexical_hits:
+            vid = int(h["_vector_id"])
+            if vid in hits:
+                hits[vid]["bm25"] = h["bm25"]
+            else:
+                hits[vid] = h
+        fused = reciprocal_rank_fusion(
+            [[int(h["_vector_id"]) for h in vector_hits], [int(h["_vector_id"]) for h in lexical_hits]], k=rrf_k,
+        )
 
+        query_vec = np.asarray(query_embedding, dtype="float32").reshape(self.dim)
         results = []
-        for dist, idx in zip(distances[0], indices[0]):
-            if idx < 0 or idx >= len(self.metadata):
+        for vid, rrf_score in fused:
+            meta = hits[vid]
+            if "score" not in meta:
+                meta["score"] = self._cosine(vid, query_vec)
+            if min_score is not None and meta["score"] < min_score and "bm25" not in meta:
                 continue
-            meta = self.metadata[idx].copy()
-            if exclude_material and meta.get("material_id") == exclude_material:
-                continue
-            meta["score"] = float(1 / (1 + dist))  # convert L2 distance to similarity
+            meta["rrf_score"] = rrf_score
             results.append(meta)
-            if len(results) >= top_k:
+            if len(results) == top_k:
                 break
-
         return results
 
+    def _cosine(self, vid: int, query_vec: np.ndarray) -> float:
+        """Cosine similarity between the query and one stored chunk's raw vector."""
+        vec = self._raw_vector(self.metadata, self._parts, vid)
+        if vec is None:
+            return 0.0
+        denom = float(np.linalg.norm(vec) * np.linalg.norm(query_vec))
+        return float(vec @ query_vec) / denom if denom else 0.0
+
+    @staticmethod
+    def _raw_vector(metadata: ChunkMetadata, parts: list[np.ndarray], vid: int) -> Optional[np.ndarray]:
+        """A live chunk's vector as produced by the embedder, or None if it is gone."""
+        row = metadata._row_of(vid)
+        if row < 0:
+            return None
+        t = int(np.searchsorted(metadata._starts, row, side="right")) - 1
+        return np.asarray(parts[t][row - int(metadata._starts[t])], dtype="float32")
+
+    def _material_mask(self, metadata: ChunkMetadata, material_id: Optional[str],
+                       exclude_material: Optional[str]) -> Optional[np.ndarray]:
+        """Row mask over metadata for the include/exclude material filters, or None when unfiltered."""
+        if material_id is None and not exclude_material:
+            return None
+        materials = self._manifest["materials"]
+
+        def covered(ranges):
+            mask = np.zeros(len(metadata.all_ids), dtype=bool)
+            for lo, hi in ranges:
+                mask[np.searchsorted(metadata.all_ids, lo):np.searchsorted(metadata.all_ids, hi)] = True
+            return mask
+
+        mask = covered(materials.get(material_id, [])) if material_id is not None \
+            else np.ones(len(metadata.all_ids), dtype=bool)
+        if exclude_material:
+            mask &= ~covered(materials.get(exclude_material, []))
+        return mask
+
+    @staticmethod
+    def _ranges_selector(ranges: list[list[int]]):
+        if len(ranges) == 1:
+            return faiss.IDSelectorRange(ranges[0][0], ranges[0][1])
+        return faiss.IDSelectorBatch(np.concatenate([np.arange(lo, hi, dtype="int64") for lo, hi in ranges]))
+
+    def _id_selector(self, material_id: Optional[str], exclude_material: Optional[str]):
+        """FAISS IDSelector for the include/exclude material filters, or None when unfiltered."""
+        materials = self._manifest["materials"]
+        sel = self._ranges_selector(materials[material_id]) if material_id is not None else None
+
+        excluded = list(materials.get(exclude_material, [])) if exclude_material else []
+        if self.index_kind == "hnsw":
+            excluded += self._manifest["deleted"]  # still physically in the graph
+        if excluded:
+            not_sel = faiss.IDSelectorNot(self._ranges_selector(excluded))
+            sel = not_sel if sel is None else faiss.IDSelectorAnd(sel, not_sel)
+        return sel
+
+    def _search_params(self, k: int, nprobe: Optional[int], ef_search: Optional[int], sel=None):
+        kind = self.index_kind
+        if kind in ("ivf_flat", "ivf_pq"):
+            return faiss.SearchParametersIVF(sel=sel, nprobe=nprobe or FAISS_NPROBE)
+        if kind == "hnsw":
+            return faiss.SearchParametersHNSW(sel=sel, efSearch=max(ef_search or FAISS_EF_SEARCH, k))
+        return faiss.SearchParameters(sel=sel) if sel is not None else None
+
     def delete_by_material(self, material_id: str):
         """
-        Remove all vectors belonging to a material by rebuilding the index
-        without those entries (FAISS IndexFlatL2 doesn't support in-place delete).
+        Remove a material's vectors in place via its recorded ID ranges.
+        Only a tombstone is persisted; the rows leave the files at the next
+        compaction, which is queued once most on-disk rows are dead.
         """
-        if self.index is None:
-            self.load()
-
-        keep_meta = [m for m in self.metadata if m.get("material_id") != material_id]
-        removed   = len(self.metadata) - len(keep_meta)
-
-        if removed == 0:
-            return  # nothing to do
-
-        # Rebuild index from kept vectors
-        new_index = self._new_index()
-        if keep_meta:
-            # We need to re-encode to rebuild; store original vectors by re-embedding
-            # Since we don't store raw vectors, we rebuild from embeddings in metadata
-            # (embeddings saved in meta during add)
-            vecs = [m["embedding"] for m in keep_meta if "embedding" in m]
-            if vecs:
-                arr = np.array(vecs, dtype="float32")
-                new_index.add(arr)  # type: ignore
-
-        self.index    = new_index
-        self.metadata = keep_meta
-        self.save()
+        with self._writing():
+            with self._rw.writing():
+                ranges = self._manifest["materials"].pop(material_id, None)
+                if not ranges:
+                    return  # nothing to do
+
+                ranges = self._unshared(ranges, material_id)
+                if ranges:
+                    self._remove_ranges(ranges)
+                    self._manifest["deleted"].extend(ranges)
+            self._write_manifest()
+            dead = sum(hi - lo for lo, hi in self._manifest["deleted"])
+            if not self.packed and dead * 2 > sum(len(p) for p in self._parts):
+                _compactor.submit(self)
+        _cache.put(self)
+
+    def _unshared(self, ranges: list[list[int]], material_id: str) -> list[list[int]]:
+        """
+        The part of a deleted material's ranges no other material still
+        references, as ranges; shared vectors stay for their other materials.
+        """
+        shared = self._manifest.get("shared") or {}
+        if not shared:
+            return ranges
+        for vid in list(shared):
+            refs = [r for r in shared[vid] if _ref_material(r) != material_id]
+            if refs:
+                shared[vid] = refs
+            else:
+                del shared[vid]
+
+        ids = np.unique(np.concatenate([np.arange(lo, hi, dtype="int64") for lo, hi in ranges]))
+        others = sorted(r for rs in self._manifest["materials"].values() for r in rs)
+        if others:
+            los = np.array([lo for lo, _ in others], dtype="int64")
+            his = np.maximum.accumulate(np.array([hi for _, hi in others], dtype="int64"))
+            at = np.searchsorted(los, ids, side="right") - 1
+            covered = (at >= 0) & (ids < his[np.maximum(at, 0)])
+            ids = ids[~covered]
+        return _id_runs(ids)
+
+    def _resolve_material(self, meta: dict, material_id: Optional[str]):
+        """
+        A shared chunk is reported under the filtered material, or a live one
+        if its own is gone, with its chunk_index and page in that material.
+        References predating per-reference places drop the fields instead.
+        """
+        if meta.get("material_id") == material_id:
+            return
+        refs = (self._manifest.get("shared") or {}).get(meta["_vector_id"]) or []
+        if material_id is not None:
+            ref = next((r for r in refs if _ref_material(r) == material_id), material_id)
+        elif meta.get("material_id") not in self._manifest["materials"] and refs:
+            ref = refs[0]
+        else:
+            return
+        for key in _PLACE_KEYS:
+            meta.pop(key, None)
+        if isinstance(ref, dict):
+            meta.update(ref)
+        else:
+            meta["material_id"] = ref
+
+
+# Where a chunk sits in its material; kept per reference for shared vectors
+_PLACE_KEYS = ("chunk_index", "page")
+
+
+def _ref_material(ref) -> str:
+    """Material of a "shared" entry: a {"material_id", ...} dict, or a bare ID in older manifests."""
+    return ref["material_id"] if isinstance(ref, dict) else ref
+
+
+# ─── Background compaction ───────────────────────────────────────────────────
+
+# Store files GC may reclaim: generations, segments and temp files (names after "{user_id}.")
+_GC_PATTERN = re.compile(r"(g|s)\d{6}(-[0-9a-f]+)?\.(index|npy|meta|bm25)(\.\d+\.\d+\.tmp)?$")
+
+
+class _Compactor:
+    """
+    Worker threads running FAISSStore.compact() off the request path:
+    segment merges, reclaiming deleted rows, and ladder / codec rebuilds.
+    Requests for a user that is already queued are coalesced into one.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._pending: dict[str, tuple[FAISSStore, Optional[tuple[str, str]]]] = {}
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, store: FAISSStore, rebuild: Optional[tuple[str, str]] = None):
+        """Queue a compaction; rebuild=(kind, codec) also retrains the index."""
+        with self._lock:
+            queued = self._pending.get(store.user_id)
+            self._pending[store.user_id] = (store, rebuild or (queued[1] if queued else None))
+            if queued is not None:
+                return
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name="faiss-compactor", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(store.user_id)
+
+    def _run(self):
+        while True:
+            user_id = self._queue.get()
+            try:
+                with self._lock:
+                    store, rebuild = self._pending.pop(user_id)
+                store.compact(*(rebuild or ()))
+            except Exception:
+                log.exception("FAISSStore %s: compaction failed", user_id)
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Block until every queued compaction has finished."""
+        self._queue.join()
+
+
+_compactor = _Compactor(FAISS_COMPACTION_WORKERS)
+
+
+# ─── Process-wide store cache ────────────────────────────────────────────────
+
+class _StoreCache:
+    """
+    LRU of loaded FAISSStore instances keyed by user_id, bounded by an
+    approximate memory budget. Writers re-register themselves via put() so
+    the cache always holds the freshest copy of a user's index, and a copy
+    another worker process has written past is refreshed on the way out.
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._stores: OrderedDict[str, FAISSStore] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> FAISSStore:
+        with self._lock:
+            store = self._stores.get(user_id)
+            if store is not None:
+                self._stores.move_to_end(user_id)
+        if store is not None:
+            if store.is_stale():  # two stat() calls; a reload only when someone else wrote
+                store.refresh()
+            return store
+
+        # Load outside the lock so one slow disk read doesn't block other users
+        store = FAISSStore(user_id).load()
+        size = store.memory_usage()
+        with self._lock:
+            cached = self._stores.get(user_id)
+            if cached is not None:  # another caller won the race
+                self._stores.move_to_end(user_id)
+                return cached
+            self._insert(store, size)
+        store._maybe_promote()  # e.g. the ladder changed since this store was last written
+        return store
+
+    def put(self, store: FAISSStore):
+        size = store.memory_usage()  # outside the lock: it waits for writes to the store in flight
+        with self._lock:
+            self._insert(store, size)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._stores.pop(user_id, None)
+            self._sizes.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._stores.clear()
+            self._sizes.clear()
+
+    def _insert(self, store: FAISSStore, size: int):
+        self._stores[store.user_id] = store
+        self._stores.move_to_end(store.user_id)
+        self._sizes[store.user_id] = size
+        # Evict least-recently-used users, but never the one just inserted
+        while sum(self._sizes.values()) > self.budget_bytes and len(self._stores) > 1:
+            old_id, _ = self._stores.popitem(last=False)
+            self._sizes.pop(old_id, None)
+
+
+_cache = _StoreCache(FAISS_CACHE_MB * 1024 * 1024)
+
+
+def get_store(user_id: str) -> FAISSStore:
+    """Return the shared, already-loaded FAISSStore for a user."""
+    return _cache.get(user_id)
+
+
+def stored_model(user_id: str) -> Optional[EmbeddingModel]:
+    """
+    The embedding model a user's store on disk was built with, read from its
+    manifest alone (no vectors are loaded); None if the user has no store.
+    """
+    blob = _pack_shard(user_id).read(user_id)
+    packed = FAISSStore._blob_header(blob, user_id)[0]["manifest"] if blob is not None else None
+    own_path = os.path.join(_shard_dir(user_id), f"{user_id}.manifest.json")
+    own = _read_json(own_path) if os.path.exists(own_path) else None
+    if packed is not None and (own is None or own["generation"] < packed["generation"]):
+        return EmbeddingModel.from_manifest(packed.get("model"))
+    if own is not None:
+        return EmbeddingModel.from_manifest(own.get("model"))
+    if os.path.exists(os.path.join(FAISS_INDEX_PATH, f"{user_id}.json")):
+        return LEGACY_MODEL
+    return None
@@ -0,0 +1,116 @@
+"""StudyAI — background re-embedding of vector stores onto the active embedding model."""
+import asyncio
+import logging
+import os
+from typing import Iterable, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-worker guard, every worker may migrate
+    fcntl = None
+
+from tools import model_registry
+from tools.chunk_table import ChunkTable
+from tools.embed_service import embed_texts, length_batches
+from tools.faiss_store import FAISS_INDEX_PATH, get_store, stored_model
+from tools.model_registry import EmbeddingModel
+
+log = logging.getLogger(__name__)
+
+# Chunks read and length-bucketed at a time while re-embedding a store
+EMBED_MIGRATION_WINDOW = int(os.getenv("EMBED_MIGRATION_WINDOW", "1024"))
+# Attempts to catch up with uploads that land during a migration before giving up until the next run
+MIGRATION_CATCHUP_ROUNDS = 5
+
+_status = {"model": model_registry.active().key, "running": False, "stores": 0, "migrated": 0, "failed": 0}
+
+
+def migration_status() -> dict:
+    """Progress of the current (or last) migration run, for /health."""
+    return dict(_status)
+
+
+async def _encode(table: ChunkTable, model: EmbeddingModel) -> np.ndarray:
+    """Re-embed a table's chunk texts, one length bucket in flight at a time so live requests keep a worker."""
+    out = np.empty((len(table), model.dim), dtype="float32")
+    for start in range(0, len(table), EMBED_MIGRATION_WINDOW):
+        texts = [str(table.row(i).get("chunk_text") or "")
+                 for i in range(start, min(start + EMBED_MIGRATION_WINDOW, len(table)))]
+        for batch in length_batches(texts):
+            out[start + np.asarray(batch)] = await embed_texts([texts[i] for i in batch], model.name, cache=False)
+    return out
+
+
+async def migrate_store(user_id: str, model: Optional[EmbeddingModel] = None) -> bool:
+    """
+    Move user_id's store to model (default: the active one). Its chunks are
+    re-embedded and a new index is built while searches and uploads keep
+    using the old vectors; chunks uploaded meanwhile are re-embedded too,
+    then the store is cut over in one write. Returns True if it was migrated.
+    """
+    model = model or model_registry.active()
+    loop = asyncio.get_running_loop()
+    current = await loop.run_in_executor(None, stored_model, user_id)
+    if current is None or current == model:
+        return False
+
+    log.info("Migrating store %s from %s to %s", user_id, current.key, model.key)
+    store = await loop.run_in_executor(None, get_store, user_id)
+    table = await loop.run_in_executor(None, store.migration_snapshot)
+    ids, vectors = table.ids.copy(), await _encode(table, model)
+    built = await loop.run_in_executor(None, store.migration_index, model, vectors, ids)
+
+    for _ in range(MIGRATION_CATCHUP_ROUNDS):
+        delta = await loop.run_in_executor(None, store.migration_delta, ids)
+        if len(delta):
+            ids = np.concatenate([ids, delta.ids])
+            vectors = np.concatenate([vectors, await _encode(delta, model)])
+        if await loop.run_in_executor(None, store.finish_migration, model, vectors, ids, built):
+            return True
+    log.warning("Store %s kept changing during its migration to %s; retrying on the next run", user_id, model.key)
+    return False
+
+
+async def migrate_stores(user_ids: Iterable[str], model: Optional[EmbeddingModel] = None) -> int:
+    """
+    Migrate each of the given users' stores in turn. Only one worker process
+    runs this at a time (the others return 0 at once), and one failed store
+    doesn't stop the rest. Returns the number of stores migrated.
+    """
+    model = model or model_registry.active()
+    lock_fd = _try_lock()
+    if lock_fd is False:
+        return 0
+    _status.update(model=model.key, running=True, stores=0, migrated=0, failed=0)
+    try:
+        for user_id in user_ids:
+            _status["stores"] += 1
+            try:
+                if await migrate_store(user_id, model):
+                    _status["migrated"] += 1
+            except Exception:
+                _status["failed"] += 1
+                log.exception("Migrating store %s to %s failed", user_id, model.key)
+    finally:
+        _status["running"] = False
+        if lock_fd is not None:
+            os.close(lock_fd)  # releases the lock
+    if _status["migrated"]:
+        log.info("Migrated %d of %d stores to %s", _status["migrated"], _status["stores"], model.key)
+    return _status["migrated"]
+
+
+def _try_lock():
+    """An fd holding the migration lock, None without fcntl, or False if another worker holds it."""
+    if fcntl is None:
+        return None
+    os.makedirs(FAISS_INDEX_PATH, exist_ok=True)
+    fd = os.open(os.path.join(FAISS_INDEX_PATH, "migration.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    return fd
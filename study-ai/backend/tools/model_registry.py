@@ -0,0 +1,68 @@
+"""StudyAI — registry of the embedding models a vector store can be built with."""
+import os
+from typing import NamedTuple, Optional
+
+
+class EmbeddingModel(NamedTuple):
+    """
+    A sentence-transformers model and the vectors it produces. version is
+    bumped whenever the same name starts producing different vectors (new
+    weights, pooling, normalization), so stores and caches built with the
+    old ones are told apart.
+    """
+    name: str
+    dim: int
+    version: int = 1
+
+    @property
+    def key(self) -> str:
+        """Identifies the vectors, e.g. in embedding cache keys."""
+        return f"{self.name}@v{self.version}"
+
+    def to_manifest(self) -> dict:
+        return self._asdict()
+
+    @classmethod
+    def from_manifest(cls, entry: Optional[dict]) -> "EmbeddingModel":
+        """The model a store manifest records; stores predating the registry used LEGACY_MODEL."""
+        return cls(**entry) if entry else LEGACY_MODEL
+
+
+MODELS: dict[str, EmbeddingModel] = {m.name: m for m in (
+    EmbeddingModel("all-MiniLM-L6-v2", 384),
+    EmbeddingModel("all-MiniLM-L12-v2", 384),
+    EmbeddingModel("paraphrase-MiniLM-L3-v2", 384),  # half the layers of L6: cheaper, a little less accurate
+    EmbeddingModel("all-mpnet-base-v2", 768),
+)}
+
+# What every store was built with before models were recorded per store
+LEGACY_MODEL = MODELS["all-MiniLM-L6-v2"]
+
+# Model new stores are built with and existing ones are migrated to
+EMBEDDING_MODEL        = os.getenv("EMBEDDING_MODEL", LEGACY_MODEL.name)
+# Further models as comma-separated "name:dim[:version]" entries
+EMBEDDING_MODELS_EXTRA = os.getenv("EMBEDDING_MODELS_EXTRA", "")
+
+
+def _register_extra(spec: str):
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        name, _, rest = entry.partition(":")
+        dim, _, version = rest.partition(":")
+        if not name or not dim.isdigit() or not (version or "1").isdigit():
+            raise ValueError(f"Bad embedding model entry '{entry}' in EMBEDDING_MODELS_EXTRA")
+        MODELS[name] = EmbeddingModel(name, int(dim), int(version or 1))
+
+
+_register_extra(EMBEDDING_MODELS_EXTRA)
+
+
+def get(name: str) -> EmbeddingModel:
+    model = MODELS.get(name)
+    if model is None:
+        raise ValueError(f"Unknown embedding model '{name}'; add it to EMBEDDING_MODELS_EXTRA as name:dim")
+    return model
+
+
+def active() -> EmbeddingModel:
+    """The model selected by EMBEDDING_MODEL."""
+    return get(EMBEDDING_MODEL)
@@ -0,0 +1,197 @@
+"""StudyAI — ONNX Runtime (fp32 / dynamic int8) backend for the embedder."""
+import inspect
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-worker guard, workers may export concurrently
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# Texts used to check an export against the PyTorch model it came from
+PARITY_TEXTS = [
+    "Machine learning is a subset of artificial intelligence.",
+    "The Krebs cycle produces NADH and FADH2 in the mitochondria.",
+    "Bernoulli's equation relates pressure, velocity and height in a flowing fluid.",
+    "TCP",
+]
+# Minimum cosine similarity between an export's vectors and PyTorch's
+PARITY_MIN_COSINE = {"onnx": 0.9999, "onnx-int8": 0.98}
+
+
+def export_dir(cache_dir: str, model_name: str) -> str:
+    return os.path.join(cache_dir, model_name.replace("/", "__"))
+
+
+@contextmanager
+def _export_lock(out_dir: str):
+    """Exclusive lock on out_dir's export, shared by every embedding worker process."""
+    os.makedirs(out_dir, exist_ok=True)
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(os.path.join(out_dir, "export.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # releases the lock
+
+
+@contextmanager
+def _staged(out_dir: str, name: str):
+    """A uniquely named temp path in out_dir, moved to out_dir/name if the block succeeds and removed if not."""
+    fd, tmp = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=out_dir)
+    os.close(fd)
+    try:
+        yield tmp
+        os.replace(tmp, os.path.join(out_dir, name))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def export(model_name: str, out_dir: str):
+    """
+    Export the SentenceTransformer's transformer to out_dir/model.onnx, plus
+    a dynamically int8-quantized model.int8.onnx, the tokenizer files and the
+    pooling settings. Pooling and normalization run in NumPy at encode time.
+    Callers hold _export_lock(out_dir).
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    st = SentenceTransformer(model_name, device="cpu")
+    transformer, tokenizer = st[0].auto_model.eval(), st.tokenizer
+    pooling = st[1] if len(st) > 1 else None
+    os.makedirs(out_dir, exist_ok=True)
+
+    sample = tokenizer(["export sample", "a longer export sample text"], padding=True, return_tensors="pt")
+    names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    dynamic = {n: {0: "batch", 1: "seq"} for n in names + ["last_hidden_state"]}
+    extra = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    fp32_path = os.path.join(out_dir, "model.onnx")
+    with _staged(out_dir, "model.onnx") as tmp, torch.no_grad():
+        torch.onnx.export(
+            transformer, tuple(sample[n] for n in names), tmp,
+            input_names=names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic, opset_version=17, **extra,
+        )
+
+    with _staged(out_dir, "model.int8.onnx") as tmp:
+        quantize_dynamic(fp32_path, tmp, weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(out_dir)
+    config = {
+        "model":          model_name,
+        "inputs":         names,
+        "max_seq_length": st.max_seq_length,
+        "pooling":        "cls" if pooling is not None and getattr(pooling, "pooling_mode_cls_token", False) else "mean",
+        "normalize":      any(type(m).__name__ == "Normalize" for m in st),
+    }
+    with _staged(out_dir, "export.json") as tmp:  # written last: its presence means the export is complete
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+    log.info("Exported %s to ONNX in %s", model_name, out_dir)
+
+
+class OnnxEncoder:
+    """
+    Drop-in for SentenceTransformer.encode() on an exported model: tokenize,
+    run the ONNX graph, then mean (or CLS) pooling and L2 normalization as
+    the original pipeline does. Needs onnxruntime and transformers' tokenizer,
+    not torch.
+    """
+
+    def __init__(self, model_dir: str, quantized: bool = False, threads: Optional[int] = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, "export.json"), encoding="utf-8") as f:
+            self.config = json.load(f)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        model_file = "model.int8.onnx" if quantized else "model.onnx"
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, model_file), options, providers=["CPUExecutionProvider"],
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = self.config["max_seq_length"]
+
+    def encode(self, texts, batch_size: int = 32, convert_to_numpy: bool = True, **_) -> np.ndarray:
+        if isinstance(texts, str):
+            return self.encode([texts], batch_size)[0]
+        out = []
+        for i in range(0, len(texts), batch_size):
+            batch = self.tokenizer(
+                list(texts[i:i + batch_size]), padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors="np",
+            )
+            feeds = {n: batch[n].astype("int64") for n in self.config["inputs"]}
+            (hidden,) = self.session.run(["last_hidden_state"], feeds)
+            out.append(self._pool(hidden, feeds["attention_mask"]))
+        if not out:
+            return np.empty((0, 0), dtype="float32")
+        return np.concatenate(out)
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.config["pooling"] == "cls":
+            pooled = hidden[:, 0]
+        else:
+            weights = mask[..., None].astype("float32")
+            pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+        if self.config["normalize"]:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype("float32")
+
+
+def parity_check(encoder, reference, backend: str, texts: Optional[list] = None) -> float:
+    """
+    Lowest cosine similarity between encoder's and reference's (the PyTorch
+    model's) vectors over texts; raises ValueError below PARITY_MIN_COSINE.
+    """
+    texts = texts or PARITY_TEXTS
+    a = np.asarray(encoder.encode(texts), dtype="float32")
+    b = np.asarray(reference.encode(texts, convert_to_numpy=True), dtype="float32")
+    cos = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    worst = float(cos.min())
+    if worst < PARITY_MIN_COSINE[backend]:
+        raise ValueError(f"{backend} export diverges from PyTorch: min cosine {worst:.4f}")
+    return worst
+
+
+def load(model_name: str, backend: str, cache_dir: str, threads: Optional[int] = None) -> OnnxEncoder:
+    """
+    The ONNX encoder for backend ("onnx" or "onnx-int8") running on threads
+    intra-op threads, exporting and parity-checking against PyTorch first if
+    no export is cached yet. Only one worker process exports; the others
+    wait for it and load the result.
+    """
+    model_dir = export_dir(cache_dir, model_name)
+    marker = os.path.join(model_dir, "export.json")
+    quantized = backend == "onnx-int8"
+    if not os.path.exists(marker):
+        with _export_lock(model_dir):
+            if not os.path.exists(marker):  # not exported by another worker while this one waited
+                export(model_name, model_dir)
+                encoder = OnnxEncoder(model_dir, quantized, threads)
+                from sentence_transformers import SentenceTransformer
+                try:
+                    worst = parity_check(encoder, SentenceTransformer(model_name, device="cpu"), backend)
+                except ValueError:
+                    os.remove(marker)  # re-export next time
+                    raise
+                log.info("%s export of %s matches PyTorch (min cosine %.5f)", backend, model_name, worst)
+                return encoder
+    return OnnxEncoder(model_dir, quantized, threads)
@@ -0,0 +1,50 @@
+"""Performance Benchmarks: Embedder Backends
+
+Throughput of the PyTorch SentenceTransformer vs ONNX Runtime fp32 / int8
+exports of all-MiniLM-L6-v2 on CPU, with their parity against PyTorch.
+"""
+
+import pytest
+import numpy as np
+import tempfile
+import time
+from pathlib import Path
+import sys
+
+# Add backend to path
+backend_path = Path(__file__).parent.parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+
+@pytest.mark.benchmark
+@pytest.mark.slow
+class TestEmbedderBackends:
+    """Benchmark chunk-encoding throughput per EMBEDDER_BACKEND."""
+
+    def test_backend_throughput_report(self):
+        """Chunks/sec and min cosine vs PyTorch for torch, onnx and onnx-int8."""
+        pytest.importorskip("onnxruntime")
+        from sentence_transformers import SentenceTransformer
+        from tools import onnx_embedder  # type: ignore
+
+        rng = np.random.default_rng(0)
+        words = "cell energy protein membrane enzyme reaction pressure velocity network packet".split()
+        chunks = [" ".join(rng.choice(words, size=rng.integers(20, 250))) for _ in range(256)]
+
+        reference = SentenceTransformer("all-MiniLM-L6-v2", device="cpu")
+        with tempfile.TemporaryDirectory() as cache_dir:
+            encoders = {
+                "torch":     reference,
+                "onnx":      onnx_embedder.load("all-MiniLM-L6-v2", "onnx", cache_dir),
+                "onnx-int8": onnx_embedder.load("all-MiniLM-L6-v2", "onnx-int8", cache_dir),
+            }
+            print(f"\n{'backend':<10} {'chunks/s':>9} {'speedup':>8} {'min cos':>8}")
+            baseline = None
+            for name, encoder in encoders.items():
+                encoder.encode(chunks[:8])  # warm up
+                start = time.perf_counter()
+                encoder.encode(chunks, batch_size=32)
+                rate = len(chunks) / (time.perf_counter() - start)
+                baseline = baseline or rate
+                cos = 1.0 if name == "torch" else onnx_embedder.parity_check(encoder, reference, name, chunks[:32])
+                print(f"{name:<10} {rate:>9.1f} {rate / baseline:>7.2f}x {cos:>8.4f}")
@@ -150,6 +150,52 @@ class TestFAISSVsAlternatives:
         assert total_mb < 1000, "Should fit in < 1GB for 500k vectors"
 
 
+@pytest.mark.benchmark
+class TestCodecRecallVsMemory:
+    """Recall vs resident memory of FAISSStore's vector codecs against exact flat search."""
+
+    def test_codec_report(self):
+        """Report: recall@10 and bytes/vector per FAISS_CODEC setting."""
+        from tools.faiss_store import _build_index, _bytes_per_vector  # type: ignore
+
+        dimension = 384
+        num_vectors = 20000
+        num_queries = 200
+        k = 10
+
+        # Clustered unit vectors with a low intrinsic dimension, closer to
+        # sentence embeddings than uniform noise
+        rng = np.random.default_rng(42)
+        basis = rng.normal(size=(96, dimension))
+        centers = rng.normal(size=(200, 96))
+        latent = centers[rng.integers(0, 200, num_vectors)] + 0.7 * rng.normal(size=(num_vectors, 96))
+        vectors = latent @ basis + 0.5 * rng.normal(size=(num_vectors, dimension))
+        vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype('float32')
+        queries = vectors[rng.choice(num_vectors, num_queries, replace=False)] + 0.05 * rng.normal(size=(num_queries, dimension))
+        queries = queries.astype('float32')
+        ids = np.arange(num_vectors, dtype='int64')
+
+        exact, _, _ = _build_index("flat", dimension, vectors, ids, "cosine", "none")
+        _, truth = exact.search(queries / np.linalg.norm(queries, axis=1, keepdims=True), k)
+
+        print(f"\nCodec recall@{k} vs exact flat search ({num_vectors:,} vectors, {dimension}-dim):")
+        print(f"  {'codec':<14}{'bytes/vec':>10}{'memory':>9}{'recall':>9}")
+        report = {}
+        for codec in ("none", "fp16", "sq8", "pca128,fp16", "pca128,sq8", "pca64,sq8"):
+            index, _, _ = _build_index("flat", dimension, vectors, ids, "cosine", codec)
+            normed = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+            _, found = index.search(normed, k)
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+            per_vector = _bytes_per_vector(index)
+            report[codec] = (per_vector, recall)
+            print(f"  {codec:<14}{per_vector:>10}{per_vector / report['none'][0]:>8.0%}{recall:>9.3f}")
+
+        assert report["none"][1] == pytest.approx(1.0)
+        assert report["fp16"][1] > 0.99
+        assert report["sq8"][1] > 0.9
+        assert report["sq8"][0] * 3.5 < report["none"][0], "8-bit codes should cut memory ~4x"
+
+
 @pytest.mark.benchmark
 class TestVectorDBCostComparison:
     """Cost analysis: FAISS vs cloud vector DBs."""
@@ -14,6 +14,9 @@ from faker import Faker
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
 
+# Keep the embedding cache in memory: the default SQLite file would land in the working directory
+os.environ["EMBED_CACHE_PATH"] = ""
+
 # Add backend to path for imports
 backend_path = Path(__file__).parent.parent / "backend"
 sys.path.insert(0, str(backend_path))
@@ -127,6 +130,7 @@ def mock_faiss_store():
         {"text": "Sample chunk 1", "material_id": "123", "score": 0.95},
         {"text": "Sample chunk 2", "material_id": "123", "score": 0.85}
     ]
+    mock_store.hybrid_search.return_value = mock_store.search.return_value
     return mock_store
 
 
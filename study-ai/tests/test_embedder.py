@@ -7,6 +7,7 @@ including performance comparisons vs OpenAI embeddings.
 import pytest
 import time
 import numpy as np
+import os
 from pathlib import Path
 import sys
 
@@ -174,3 +175,366 @@ class TestEmbedderVsOpenAI:
         """
         # This would test actual retrieval quality if OpenAI API available
         pass
+
+
+class TestLazyLoading:
+    """Model loading is deferred to first use and warmed up explicitly."""
+
+    class _FakeModel:
+        def __init__(self):
+            self.calls = 0
+
+        def encode(self, texts, convert_to_numpy=True):
+            self.calls += 1
+            return np.ones((len(texts), 384), dtype="float32")
+
+    def test_import_does_not_load_model(self):
+        """Importing the module (and the routes that use it) leaves the model unloaded."""
+        import subprocess
+        code = ("import sys; sys.path.insert(0, %r); import tools.embedder as e; "
+                "assert not e._models and 'sentence_transformers' not in sys.modules"
+                % str(Path(__file__).parent.parent / "backend"))
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+    def test_warmup_marks_ready(self, monkeypatch):
+        """warmup() runs one encode on the shared model and flips the readiness flag."""
+        import threading
+        import tools.embedder as embedder  # type: ignore
+        fake = self._FakeModel()
+        monkeypatch.setattr(embedder, "_models", {embedder.MODEL_NAME: fake})
+        monkeypatch.setattr(embedder, "_ready", threading.Event())
+        monkeypatch.setattr(embedder, "_cache", embedder.EmbeddingCache(10))
+
+        assert not embedder.is_ready()
+        embedder.warmup()
+        assert embedder.is_ready() and fake.calls == 1
+        assert len(embedder.generate_embedding("x")) == 384
+
+
+class TestEmbeddingCache:
+    """generate_embedding(s) go through the memory LRU and the SQLite tier before the model."""
+
+    def test_repeat_texts_skip_the_model(self, monkeypatch, tmp_path):
+        """Repeats are memory hits, a fresh process finds them on disk, and counters add up."""
+        import tools.embedder as embedder  # type: ignore
+        from tools.embedding_cache import EmbeddingCache  # type: ignore
+        fake = TestLazyLoading._FakeModel()
+        monkeypatch.setattr(embedder, "_models", {embedder.MODEL_NAME: fake})
+        db_path = str(tmp_path / "cache.sqlite3")
+        monkeypatch.setattr(embedder, "_cache", EmbeddingCache(2, db_path))
+
+        first = embedder.generate_embeddings(["entropy", "enthalpy", "entropy"])
+        assert fake.calls == 1 and np.array_equal(first[0], first[2])
+        assert first.dtype == np.float32 and first.shape == (3, 384) and first.flags.c_contiguous
+        embedder.generate_embedding("entropy")
+        assert fake.calls == 1
+        assert embedder.cache_stats()["memory_hits"] == 1
+
+        # A new cache on the same file (another worker, or after a restart) hits the disk tier
+        monkeypatch.setattr(embedder, "_cache", EmbeddingCache(2, db_path))
+        np.testing.assert_array_equal(embedder.generate_embeddings(["enthalpy", "entropy"]), first[1:])
+        stats = embedder.cache_stats()
+        assert fake.calls == 1 and stats["disk_hits"] == 2 and stats["misses"] == 0
+
+    def test_lru_evicts_oldest(self):
+        """The memory tier keeps at most max_entries vectors, dropping the least recently used."""
+        from tools.embedding_cache import EmbeddingCache  # type: ignore
+        cache = EmbeddingCache(2)
+        keys = [EmbeddingCache.key("m", t) for t in "abc"]
+        cache.put_many({keys[0]: np.zeros(384), keys[1]: np.ones(384)})
+        cache.get_many([keys[0]])
+        cache.put_many({keys[2]: np.ones(384)})
+        assert set(cache.get_many(keys)) == {keys[0], keys[2]}
+
+    def test_disk_tier_keeps_newest_rows(self, tmp_path):
+        """The SQLite file is trimmed to disk_entries rows, deleting the oldest inserts."""
+        from tools.embedding_cache import EmbeddingCache  # type: ignore
+        db_path = str(tmp_path / "cache.sqlite3")
+        cache = EmbeddingCache(1, db_path, disk_entries=3)
+        keys = [EmbeddingCache.key("m", t) for t in "abcde"]
+        for k in keys:
+            cache.put_many({k: np.ones(384)})
+
+        fresh = EmbeddingCache(1, db_path, disk_entries=3)  # memory tier empty: only disk hits count
+        assert set(fresh.get_many(keys)) == set(keys[2:])
+
+    def test_uncached_encodes_skip_both_tiers(self, monkeypatch):
+        """cache=False (bulk upload and migration text) neither reads nor fills the cache."""
+        import asyncio
+        import tools.embedder as embedder  # type: ignore
+        import tools.embed_service as embed_service  # type: ignore
+        from tools.embedding_cache import EmbeddingCache  # type: ignore
+        fake = TestLazyLoading._FakeModel()
+        monkeypatch.setattr(embedder, "_models", {embedder.MODEL_NAME: fake})
+        monkeypatch.setattr(embedder, "_cache", EmbeddingCache(10))
+        monkeypatch.setattr(embed_service, "embedding_pool",
+                            embed_service.EmbeddingPool(0, embedder.encode_raw))
+
+        async def embed():
+            await embed_service.embed_texts(["bulk chunk"], embedder.MODEL_NAME, cache=False)
+            await embed_service.embed_texts(["bulk chunk"], embedder.MODEL_NAME, cache=False)
+
+        asyncio.run(embed())
+        assert fake.calls == 2 and embedder.cache_stats()["memory_entries"] == 0
+
+
+class TestEmbeddingService:
+    """Concurrent embed requests are coalesced into few batched encode calls."""
+
+    def test_concurrent_requests_share_batches(self):
+        """50 concurrent single-text requests need a handful of encodes, each caller getting its own vector."""
+        import asyncio
+        from tools.embed_service import EmbeddingService  # type: ignore
+        sizes = []
+
+        async def encode(texts):
+            sizes.append(len(texts))
+            await asyncio.sleep(0.01)  # a forward pass takes a while, so the next batch fills meanwhile
+            return [[float(t.split()[-1])] * 384 for t in texts]
+
+        service = EmbeddingService(window_ms=5, max_batch=16, encode=encode)
+
+        async def run():
+            return await asyncio.gather(*(service.embed(f"question {i}") for i in range(50)),
+                                        service.embed_many(["a 100", "b 101"]))
+
+        results = asyncio.run(run())
+        assert [r[0] for r in results[:50]] == [float(i) for i in range(50)]
+        assert [v[0] for v in results[50]] == [100.0, 101.0]
+        assert sum(sizes) == 52 and max(sizes) <= 17 and len(sizes) <= 5
+
+    def test_encode_errors_reach_every_caller(self):
+        """A failed batch fails each waiting request instead of hanging it."""
+        import asyncio
+        from tools.embed_service import EmbeddingService  # type: ignore
+
+        async def encode(texts):
+            raise RuntimeError("model unavailable")
+
+        service = EmbeddingService(window_ms=1, max_batch=8, encode=encode)
+
+        async def run():
+            return await asyncio.gather(service.embed("x"), service.embed("y"), return_exceptions=True)
+
+        assert all(isinstance(r, RuntimeError) for r in asyncio.run(run()))
+
+    def test_dispatches_are_held_until_done(self):
+        """In-flight batches are referenced by the service, so garbage collection can't drop them."""
+        import asyncio
+        import gc
+        from tools.embed_service import EmbeddingService  # type: ignore
+        seen = []
+
+        async def encode(texts):
+            gc.collect()
+            seen.append(len(service._tasks))
+            return np.ones((len(texts), 384), dtype="float32")
+
+        service = EmbeddingService(window_ms=1, max_batch=8, encode=encode)
+        vector = asyncio.run(service.embed("x"))
+
+        assert vector.shape == (384,)
+        assert seen == [1] and not service._tasks
+
+    def test_small_request_overtakes_a_large_batch(self):
+        """With two slots, a query is answered while a big upload batch is still encoding."""
+        import asyncio
+        from tools.embed_service import EmbeddingService  # type: ignore
+        finished = []
+
+        async def encode(texts):
+            await asyncio.sleep(0.01 * len(texts))
+            finished.append(len(texts))
+            return [[0.0] * 384 for _ in texts]
+
+        service = EmbeddingService(window_ms=1, max_batch=64, encode=encode, slots=2)
+
+        async def run():
+            upload = asyncio.ensure_future(service.embed_many([f"chunk {i}" for i in range(64)]))
+            await asyncio.sleep(0.005)
+            await service.embed("what is TCP?")
+            assert not upload.done()
+            await upload
+
+        asyncio.run(run())
+        assert finished == [1, 64]
+
+    def test_length_batches_bucket_similar_lengths(self):
+        """Batches run shortest to longest and shrink as texts get longer."""
+        from tools.embed_service import length_batches  # type: ignore
+        texts = ["x" * n for n in (900, 10, 500, 20, 1500, 30, 800, 40)]
+        batches = length_batches(texts, max_batch=3, max_chars=2000)
+        assert sorted(i for b in batches for i in b) == list(range(len(texts)))
+        lengths = [[len(texts[i]) for i in b] for b in batches]
+        assert [n for b in lengths for n in b] == sorted(len(t) for t in texts)
+        assert all(len(b) <= 3 and len(b) * max(b) <= 2000 or len(b) == 1 for b in lengths)
+        assert lengths[-1] == [1500]
+
+
+def _encode_in_worker(texts):
+    return np.full((len(texts), 384), os.getpid(), dtype="float32")
+
+
+def _die_once_in_worker(texts, marker):
+    """Kill the worker process on the first call (as an OOM kill would), encode on later ones."""
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return _encode_in_worker(texts)
+
+
+class TestEmbeddingPool:
+    """Encoding runs in separate worker processes, off the API process's GIL."""
+
+    def test_encode_runs_in_worker_process(self):
+        import asyncio
+        from tools.embed_service import EmbeddingPool  # type: ignore
+        pool = EmbeddingPool(2, _encode_in_worker)
+        try:
+            vectors = asyncio.run(pool.run(["a", "b"]))
+        finally:
+            pool.shutdown()
+        assert vectors.shape == (2, 384)
+        assert int(vectors[0, 0]) != os.getpid()
+
+    def test_dead_worker_is_replaced(self, tmp_path):
+        """A worker dying breaks the process pool; it is rebuilt and the batch retried, not failed for good."""
+        import asyncio
+        from tools.embed_service import EmbeddingPool  # type: ignore
+        pool = EmbeddingPool(1, _die_once_in_worker)
+        marker = str(tmp_path / "died")
+        try:
+            first = pool.executor()
+            vectors = asyncio.run(pool.run(["a", "b"], marker))
+            assert vectors.shape == (2, 384) and pool.executor() is not first
+            assert asyncio.run(pool.run(["c"], marker)).shape == (1, 384)
+        finally:
+            pool.shutdown()
+
+    def test_zero_workers_encode_in_process(self):
+        import asyncio
+        from tools.embed_service import EmbeddingPool  # type: ignore
+        pool = EmbeddingPool(0, _encode_in_worker)
+        assert pool.executor() is None and pool.slots == 1
+        assert int(asyncio.run(pool.run(["a"]))[0, 0]) == os.getpid()
+
+
+class TestEmbedNode:
+    """Uploads are encoded in length buckets and streamed into the index batch by batch."""
+
+    @pytest.fixture(autouse=True)
+    def store_dir(self, monkeypatch, tmp_path):
+        """Stores go to a temporary FAISS_INDEX_PATH, not ./faiss_indexes."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_INDEX_PATH", str(tmp_path))
+        faiss_store_module._cache.clear()
+        yield tmp_path
+        faiss_store_module._compactor.join()
+        faiss_store_module._cache.clear()
+
+    @staticmethod
+    def _state(user_id, chunks):
+        return {"user_id": user_id, "material_id": "mat-1", "chunks": chunks, "progress_queue": None}
+
+    @staticmethod
+    def _fake_embed(calls, fail_on=None):
+        async def embed_texts(texts, model=None, cache=True):
+            assert not cache, "upload chunks went through the embedding cache"
+            calls.append([len(t) for t in texts])
+            if fail_on is not None and len(calls) == fail_on:
+                raise RuntimeError("worker died")
+            return [np.random.default_rng(len(t)).random(384).tolist() for t in texts]
+        return embed_texts
+
+    def test_chunks_stream_into_the_index(self, monkeypatch):
+        import asyncio
+        import agents.graph as graph  # type: ignore
+        import tools.embed_service as embed_service  # type: ignore
+        from tools.faiss_store import get_store  # type: ignore
+        calls = []
+        monkeypatch.setattr(embed_service, "embed_texts", self._fake_embed(calls))
+        monkeypatch.setattr(graph, "EMBED_INDEX_FLUSH", 5)
+        monkeypatch.setattr(embed_service.length_batches, "__defaults__", (4, 48000))
+
+        user_id = "stream_user"
+        chunks = [f"chunk {i} " + "word " * (i * 7 % 23) for i in range(18)] + ["a long closing summary " * 12]
+        chunks.append(chunks[5])  # a repeat is encoded once
+        state = asyncio.run(graph.embed_node(self._state(user_id, chunks)))
+
+        assert sum(len(c) for c in calls) == 19 and max(len(c) for c in calls) <= 4
+        assert all(c == sorted(c) for c in calls)
+        assert all(vid is not None for vid in state["faiss_ids"]) and state["faiss_ids"][5] == state["faiss_ids"][-1]
+        assert state["embeddings"].shape == (graph.QUERY_CHUNKS, 384)  # only the rows retrieve_node searches with
+        store = get_store(user_id)
+        hit = store.search(state["embeddings"][3], top_k=1)[0]
+        assert hit["chunk_text"] == chunks[3] and hit["chunk_index"] == 3
+
+    def test_failed_upload_leaves_nothing_indexed(self, monkeypatch):
+        import asyncio
+        import agents.graph as graph  # type: ignore
+        import tools.embed_service as embed_service  # type: ignore
+        from tools.faiss_store import get_store  # type: ignore
+        monkeypatch.setattr(embed_service, "embed_texts", self._fake_embed([], fail_on=3))
+        monkeypatch.setattr(graph, "EMBED_INDEX_FLUSH", 2)
+        monkeypatch.setattr(embed_service.length_batches, "__defaults__", (2, 48000))
+
+        user_id = "rollback_user"
+        chunks = [f"section {i} " + "text " * i for i in range(8)]
+        with pytest.raises(RuntimeError):
+            asyncio.run(graph.embed_node(self._state(user_id, chunks)))
+        assert len(get_store(user_id).metadata) == 0
+
+
+class TestOnnxBackend:
+    """The ONNX Runtime backend reproduces the SentenceTransformer pipeline."""
+
+    def test_pooling_matches_sentence_transformers(self):
+        """Mean pooling ignores padding and vectors come out unit-length, as in all-MiniLM-L6-v2."""
+        from tools.onnx_embedder import OnnxEncoder  # type: ignore
+        encoder = OnnxEncoder.__new__(OnnxEncoder)
+        encoder.config = {"pooling": "mean", "normalize": True}
+        hidden = np.random.rand(2, 4, 384).astype('float32')
+        mask = np.array([[1, 1, 1, 1], [1, 1, 0, 0]])
+
+        pooled = encoder._pool(hidden, mask)
+        expected = hidden[1, :2].mean(axis=0)
+        np.testing.assert_allclose(pooled[1], expected / np.linalg.norm(expected), rtol=1e-5)
+        np.testing.assert_allclose(np.linalg.norm(pooled, axis=1), 1.0, rtol=1e-5)
+
+    @pytest.mark.parametrize("backend", ["onnx", "onnx-int8"])
+    def test_parity_with_pytorch(self, backend, tmp_path):
+        """An export's vectors match the PyTorch model's within the backend's tolerance."""
+        pytest.importorskip("onnxruntime")
+        from tools import onnx_embedder  # type: ignore
+        encoder = onnx_embedder.load("all-MiniLM-L6-v2", backend, str(tmp_path))  # exports + parity-checks
+        assert encoder.encode(["hello"]).shape == (1, 384)
+
+    def test_concurrent_loads_export_once(self, tmp_path, monkeypatch):
+        """Workers starting together export the model once; the rest wait and load it, with their thread count."""
+        import threading
+        import sentence_transformers
+        from tools import onnx_embedder  # type: ignore
+        exports, loaded = [], []
+
+        def fake_export(model_name, out_dir):
+            exports.append(model_name)
+            time.sleep(0.2)  # long enough for the other workers to arrive
+            with onnx_embedder._staged(out_dir, "export.json") as tmp:
+                Path(tmp).write_text("{}")
+
+        class FakeEncoder:
+            def __init__(self, model_dir, quantized=False, threads=None):
+                loaded.append(threads)
+
+        monkeypatch.setattr(onnx_embedder, "export", fake_export)
+        monkeypatch.setattr(onnx_embedder, "OnnxEncoder", FakeEncoder)
+        monkeypatch.setattr(onnx_embedder, "parity_check", lambda *a: 1.0)
+        monkeypatch.setattr(sentence_transformers, "SentenceTransformer", lambda *a, **k: None)
+        workers = [threading.Thread(target=onnx_embedder.load, args=("m", "onnx", str(tmp_path), 2)) for _ in range(3)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        assert exports == ["m"] and loaded == [2, 2, 2]
+        assert sorted(os.listdir(onnx_embedder.export_dir(str(tmp_path), "m"))) == ["export.json", "export.lock"]
@@ -17,7 +17,27 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 backend_path = Path(__file__).parent.parent.parent / "backend"
 sys.path.insert(0, str(backend_path))
 
-from tools.faiss_store import FAISSStore  # type: ignore
+from tools.chunk_table import ChunkTable  # type: ignore
+from tools.faiss_store import FAISSStore, get_store  # type: ignore
+
+
+@pytest.fixture(autouse=True)
+def store_dir(monkeypatch, temp_faiss_dir):
+    """Every test keeps its stores in a temporary FAISS_INDEX_PATH and starts with an empty store cache."""
+    import tools.faiss_store as faiss_store_module  # type: ignore
+    monkeypatch.setattr(faiss_store_module, "FAISS_INDEX_PATH", str(temp_faiss_dir))
+    faiss_store_module._cache.clear()
+    yield temp_faiss_dir
+    faiss_store_module._compactor.join()  # before the directory goes away
+    faiss_store_module._cache.clear()
+
+
+def _upload_batches(user_id: str, worker: int):
+    """Process target for the multi-worker locking test: five separate uploads."""
+    store = FAISSStore(user_id=user_id).load()
+    for b in range(5):
+        store.add(np.random.rand(4, 384).astype('float32'),
+                  [{"text": f"P{worker} B{b}", "material_id": f"mat_{worker}_{b}"} for _ in range(4)])
 
 
 class TestFAISSStore:
@@ -31,7 +51,7 @@ class TestFAISSStore:
         store.load()
         return store
     
-    def test_create_index(self, faiss_store, temp_faiss_dir):
+    def test_create_index(self, faiss_store):
         """Test creating a new FAISS index."""
         embeddings = np.random.rand(10, 384).astype('float32')
         metadata = [{"text": f"Chunk {i}", "material_id": "mat_1"} for i in range(10)]
@@ -144,6 +164,639 @@ class TestFAISSStore:
         results = store2.search(embeddings[10], top_k=1)
         assert len(results) > 0, "Should return search results"
     
+    def test_vectors_kept_out_of_metadata(self, monkeypatch):
+        """Raw vectors go to mmapped .npy matrices, not the chunk tables."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", 0)
+
+        store = FAISSStore(user_id="mmap_user").load()
+        embeddings = np.random.rand(20, 384).astype('float32')
+        store.add(embeddings, [{"chunk_text": f"Chunk {i}", "embedding": [0.0]} for i in range(20)])
+        store.save()
+
+        base = json.loads(Path(store.manifest_path).read_text())["base"]
+        table = ChunkTable.read(store._path(f"{base}.meta"))
+        assert all("embedding" not in table.row(i) for i in range(len(table)))
+
+        reloaded = FAISSStore(user_id="mmap_user").load()
+        assert isinstance(reloaded.vectors, np.memmap)
+        np.testing.assert_array_equal(np.asarray(reloaded.vectors), embeddings)
+
+    def test_columnar_metadata(self, monkeypatch):
+        """IDs, material and chunk_index are columns; chunk text is decoded only for returned hits."""
+        store = FAISSStore(user_id="col_user").load()
+        embeddings = np.random.rand(30, 384).astype('float32')
+        store.add(embeddings, [
+            {"chunk_text": f"Chunk {i}", "material_id": f"mat_{i % 3}", "chunk_index": i, "page": i // 10}
+            for i in range(30)
+        ])
+        store.save()
+
+        reloaded = FAISSStore(user_id="col_user").load()
+        table = reloaded.metadata.tables[0]
+        assert table.materials == ["mat_0", "mat_1", "mat_2"]
+        np.testing.assert_array_equal(table.chunk_index, np.arange(30))
+        assert table.nbytes < 30 * 64  # chunk text stays in the mapped file
+
+        decoded = []
+        original_row = ChunkTable.row
+        monkeypatch.setattr(ChunkTable, "row", lambda self, i: decoded.append(i) or original_row(self, i))
+        hits = reloaded.search(embeddings[7], top_k=3, material_id="mat_1")
+        assert len(decoded) == len(hits) == 3
+        assert hits[0] == {
+            "chunk_text": "Chunk 7", "material_id": "mat_1", "chunk_index": 7, "page": 0,
+            "_vector_id": "7", "score": pytest.approx(1.0, abs=1e-5),
+        }
+
+        hits[0]["chunk_text"] = "mutated"  # results are fresh dicts
+        assert reloaded.metadata[7]["chunk_text"] == "Chunk 7"
+
+    def test_append_only_segments_and_merge(self, monkeypatch):
+        """Each add() writes only its own segment; segments are merged into a new base."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_MERGE_SEGMENTS", 3)
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", 0)
+
+        store = FAISSStore(user_id="seg_user").load()
+        batches = [np.random.rand(4, 384).astype('float32') for _ in range(4)]
+        store.add(batches[0], [{"text": f"A{i}"} for i in range(4)])  # too big for the pack: first base
+        first_base = json.loads(Path(store.manifest_path).read_text())["base"]
+        store.add(batches[1], [{"text": f"B{i}"} for i in range(4)])
+        store.add(batches[2], [{"text": f"C{i}"} for i in range(4)])
+
+        manifest = json.loads(Path(store.manifest_path).read_text())
+        assert manifest["base"] == first_base
+        assert len(manifest["segments"]) == 2
+        seg_rows = np.load(store._path(f"{manifest['segments'][1]['name']}.npy"))
+        np.testing.assert_array_equal(seg_rows, batches[2])
+
+        reloaded = FAISSStore(user_id="seg_user").load()
+        assert reloaded.index.ntotal == 12
+        assert reloaded.search(batches[2][2], top_k=1)[0]["text"] == "C2"
+
+        # Third segment hits the merge threshold; the compactor folds everything into a new base
+        store.add(batches[3], [{"text": f"D{i}"} for i in range(4)])
+        faiss_store_module._compactor.join()
+        manifest = json.loads(Path(store.manifest_path).read_text())
+        assert manifest["base"] != first_base and manifest["segments"] == []
+        assert sorted(p.name for p in Path(store.shard_path).iterdir() if ".s0" in p.name) == []
+
+        merged = FAISSStore(user_id="seg_user").load()
+        assert merged.index.ntotal == 16
+        np.testing.assert_array_equal(np.asarray(merged.vectors), np.concatenate(batches))
+        assert [m["text"] for m in merged.metadata.values()][-1] == "D3"
+
+    def test_compaction_keeps_concurrent_writes(self, monkeypatch):
+        """Writes landing while a compaction builds are carried over at the swap, and old files are collected."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_MERGE_SEGMENTS", 100)
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", 0)
+
+        store = FAISSStore(user_id="compact_user").load()
+        embeddings = np.random.rand(50, 384).astype('float32')
+        for n in range(4):
+            store.add(embeddings[n * 10:(n + 1) * 10],
+                      [{"text": f"Chunk {i}", "material_id": f"mat_{n}"} for i in range(n * 10, (n + 1) * 10)])
+        store.delete_by_material("mat_0")
+        old_files = store._referenced_files()
+
+        # Build the new generation, then write to the store before it is swapped in
+        snap = store._compact_snapshot(None, None)
+        built = store._compact_build(snap)
+        store.add(embeddings[40:], [{"text": f"Chunk {i}", "material_id": "mat_4"} for i in range(40, 50)])
+        store.delete_by_material("mat_1")
+        assert store.search(embeddings[45], top_k=1)[0]["text"] == "Chunk 45"
+        assert store._compact_swap(snap, built)
+
+        manifest = json.loads(Path(store.manifest_path).read_text())
+        assert manifest["base"] == snap["name"]
+        assert len(manifest["segments"]) == 1 and manifest["deleted"] == [[10, 20]]
+        assert not any(Path(p).exists() for p in old_files[3:])
+
+        for copy in (store, FAISSStore(user_id="compact_user").load()):
+            assert copy.index.ntotal == 30
+            assert sorted(copy.metadata.ids().tolist()) == list(range(20, 50))
+            assert copy.search(embeddings[45], top_k=1)[0]["text"] == "Chunk 45"
+            assert copy.search(embeddings[25], top_k=1)[0]["_vector_id"] == "25"
+
+        # A checkpoint written meanwhile makes the compaction discard its build
+        snap = store._compact_snapshot(None, None)
+        built = store._compact_build(snap)
+        store.save()
+        assert not store._compact_swap(snap, built)
+        assert not Path(store._path(f"{snap['name']}.npy")).exists()
+
+        # Leftovers no manifest references are collected once past the grace period
+        stray = Path(store._path("g000099-abcdef.npy"))
+        stray.write_bytes(b"")
+        monkeypatch.setattr(faiss_store_module, "FAISS_GC_GRACE_SECONDS", -1)
+        store._collect_garbage()
+        assert not stray.exists() and Path(store.manifest_path).exists()
+
+    def test_legacy_sidecar_migration(self, store_dir):
+        """Old sidecars with inline 'embedding' lists are migrated on load."""
+        import faiss
+
+        embeddings = np.random.rand(5, 384).astype('float32')
+        index = faiss.IndexFlatL2(384)
+        index.add(embeddings)  # type: ignore
+        faiss.write_index(index, str(store_dir / "legacy.index"))
+        legacy_meta = [
+            {"material_id": "mat_1", "chunk_text": f"Chunk {i}", "embedding": embeddings[i].tolist()}
+            for i in range(5)
+        ]
+        (store_dir / "legacy.json").write_text(json.dumps(legacy_meta))
+
+        store = FAISSStore(user_id="legacy").load()
+        assert store.packed and FAISSStore(user_id="legacy").load().index.ntotal == 5
+        assert not (store_dir / "legacy.json").exists()
+        assert all("embedding" not in m for m in store.metadata.values())
+        np.testing.assert_allclose(np.asarray(store.vectors), embeddings, rtol=1e-6)
+
+    def test_delete_by_material(self, monkeypatch):
+        """Deleting a material removes exactly its IDs in place and survives a reload."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", 0)
+
+        store = FAISSStore(user_id="delete_user").load()
+        embeddings = np.random.rand(40, 384).astype('float32')
+        for n in range(4):
+            store.add(embeddings[n * 10:(n + 1) * 10],
+                      [{"text": f"Chunk {i}", "material_id": f"mat_{n}"} for i in range(n * 10, (n + 1) * 10)])
+
+        store.delete_by_material("mat_0")
+
+        assert store.index.ntotal == 30
+        assert all(m["material_id"] != "mat_0" for m in store.metadata.values())
+        assert store.search(embeddings[11], top_k=1)[0]["text"] == "Chunk 11"
+        assert store.search(embeddings[3], top_k=1)[0]["material_id"] != "mat_0"
+
+        # Only a tombstone was written; the reloaded store still hides the rows
+        reloaded = FAISSStore(user_id="delete_user").load()
+        assert reloaded.index.ntotal == 30
+        assert "mat_0" not in reloaded._manifest["materials"]
+
+        # A merge drops the tombstoned rows from disk but keeps IDs stable
+        reloaded.save()
+        assert len(reloaded.vectors) == 30
+        assert reloaded.search(embeddings[25], top_k=1)[0]["_vector_id"] == "25"
+
+    def test_tenant_packing(self, monkeypatch, store_dir):
+        """Small stores share their shard's pack file; large ones move out to their own files."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", 20)
+        monkeypatch.setattr(faiss_store_module, "_shard_dir", lambda user_id: str(store_dir / "00"))
+
+        embeddings = np.random.rand(5, 10, 384).astype('float32')
+        for u in range(5):
+            store = FAISSStore(user_id=f"small_{u}").load()
+            store.add(embeddings[u], [{"text": f"U{u} C{i}", "material_id": "mat"} for i in range(10)])
+            assert store.packed
+
+        shard = store_dir / "00"
+        assert sorted(p.name for p in shard.iterdir() if p.name != "locks") == ["pack.000001.bin", "pack.toc.json"]
+        for u in range(5):
+            reloaded = FAISSStore(user_id=f"small_{u}").load()
+            assert reloaded.search(embeddings[u][4], top_k=1)[0]["text"] == f"U{u} C4"
+
+        # Growing past the limit moves a store out of the pack into its own generation
+        grown = FAISSStore(user_id="small_0").load()
+        grown.add(np.random.rand(15, 384).astype('float32'), [{"text": "more"} for _ in range(15)])
+        assert not grown.packed and Path(grown.manifest_path).exists()
+        assert FAISSStore(user_id="small_0").load().index.ntotal == 25
+
+        # Rewritten entries leave dead bytes behind until the pack is repacked
+        for u in range(1, 5):
+            FAISSStore(user_id=f"small_{u}").load().delete_by_material("mat")
+        toc = json.loads((shard / "pack.toc.json").read_text())
+        assert toc["file"] != "pack.000001.bin" and not (shard / "pack.000001.bin").exists()
+        assert FAISSStore(user_id="small_3").load().index.ntotal == 0
+        assert FAISSStore(user_id="small_0").load().search(embeddings[0][2], top_k=1)[0]["text"] == "U0 C2"
+
+    @pytest.mark.parametrize("codec", ["fp16", "sq8", "pca64,sq8"])
+    def test_vector_codecs(self, monkeypatch, codec):
+        """Compressed codecs are recorded in the manifest, cut index memory and still find the right chunk."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_CODEC", codec)
+
+        # Low-rank vectors, so PCA has structure to keep
+        embeddings = (np.random.rand(300, 32) @ np.random.rand(32, 384)).astype('float32')
+        store = FAISSStore(user_id="codec_user").load()
+        assert store.codec == "fp16"  # sq8 / PCA need training data first
+        store.add(embeddings, [{"text": f"Chunk {i}"} for i in range(300)])
+        faiss_store_module._compactor.join()
+
+        reloaded = FAISSStore(user_id="codec_user").load()
+        assert reloaded.codec == codec
+        assert reloaded.search(embeddings[42], top_k=1)[0]["text"] == "Chunk 42"
+        assert faiss_store_module._bytes_per_vector(reloaded.index) * 1.9 < 384 * 4
+
+        # Changing the setting rebuilds the store in the background
+        monkeypatch.setattr(faiss_store_module, "FAISS_CODEC", "none")
+        reloaded._maybe_promote()
+        faiss_store_module._compactor.join()
+        assert FAISSStore(user_id="codec_user").load().codec == "none"
+
+    def test_cosine_scores_and_min_score_cutoff(self, faiss_store):
+        """Scores are cosine similarities regardless of vector norm, and min_score cuts off weak hits."""
+        base = np.random.rand(384).astype('float32')
+        other = np.random.rand(384).astype('float32') - 0.5
+        faiss_store.add(np.stack([base * 10, other]), [{"text": "Scaled"}, {"text": "Other"}])
+
+        results = faiss_store.search(base, top_k=2)
+        assert faiss_store.metric == "cosine"
+        assert results[0]["text"] == "Scaled"
+        assert results[0]["score"] == pytest.approx(1.0, abs=1e-5)
+
+        expected = float(np.dot(base, other) / (np.linalg.norm(base) * np.linalg.norm(other)))
+        assert results[1]["score"] == pytest.approx(expected, abs=1e-5)
+        assert [r["text"] for r in faiss_store.search(base, top_k=2, min_score=0.9)] == ["Scaled"]
+
+    @pytest.mark.parametrize("pack_max", [2000, 0])  # packed blob and own files
+    def test_metric_migration(self, monkeypatch, pack_max):
+        """A store written under L2 keeps serving while it is rebuilt as cosine in the background."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", pack_max)
+        monkeypatch.setattr(faiss_store_module, "FAISS_METRIC", "l2")
+
+        embeddings = np.random.rand(50, 384).astype('float32')
+        store = FAISSStore(user_id="metric_user").load()
+        store.add(embeddings, [{"text": f"Chunk {i}"} for i in range(50)])
+        assert store.metric == "l2"
+
+        monkeypatch.setattr(faiss_store_module, "FAISS_METRIC", "cosine")
+        loaded = FAISSStore(user_id="metric_user").load()
+        assert loaded.metric == "l2"  # loading never rebuilds inline
+        assert loaded.search(embeddings[9], top_k=1)[0]["text"] == "Chunk 9"
+
+        faiss_store_module._cache.invalidate("metric_user")  # as in a freshly started worker
+        migrated = get_store("metric_user")  # first load queues the rebuild
+        faiss_store_module._compactor.join()
+        assert migrated.metric == "cosine"
+        assert FAISSStore(user_id="metric_user").load().metric == "cosine"
+        assert migrated.index.metric_type == faiss_store_module.faiss.METRIC_INNER_PRODUCT
+        assert migrated.search(embeddings[9], top_k=1)[0]["text"] == "Chunk 9"
+        np.testing.assert_array_equal(np.asarray(migrated.vectors), embeddings)
+
+    def test_search_many_matches_single_searches(self, faiss_store):
+        """Batched search returns one group per query, identical to per-query search()."""
+        embeddings = np.random.rand(100, 384).astype('float32')
+        faiss_store.add(embeddings, [{"text": f"Chunk {i}", "material_id": f"mat_{i % 2}"} for i in range(100)])
+
+        queries = embeddings[[4, 17, 42]]
+        grouped = faiss_store.search_many(queries, top_k=3, exclude_material="mat_1")
+
+        assert len(grouped) == 3
+        for query, group in zip(queries, grouped):
+            assert group == faiss_store.search(query, top_k=3, exclude_material="mat_1")
+        assert grouped[0][0]["text"] == "Chunk 4"
+        assert grouped[2][0]["text"] == "Chunk 42"
+        assert all(r["material_id"] == "mat_0" for g in grouped for r in g)
+        assert faiss_store.search_many(np.empty((0, 384), dtype='float32'), top_k=3) == []
+
+    @pytest.mark.parametrize("kind", ["flat", "ivf_flat", "hnsw"])
+    def test_filter_pushdown(self, faiss_store, kind):
+        """Include/exclude filters return exactly top_k hits even when the excluded material dominates."""
+        rng = np.random.default_rng(0)
+        center = rng.random(384).astype('float32')
+        # 200 near-duplicates of the query in mat_near, 200 unrelated vectors in mat_far
+        near = center + 0.001 * rng.random((200, 384)).astype('float32')
+        far  = rng.random((200, 384)).astype('float32')
+        faiss_store.add(near, [{"text": f"Near {i}", "material_id": "mat_near"} for i in range(200)])
+        faiss_store.add(far,  [{"text": f"Far {i}", "material_id": "mat_far"} for i in range(200)])
+        if kind != "flat":
+            faiss_store.rebuild_index(kind)
+
+        excluded = faiss_store.search(center, top_k=10, exclude_material="mat_near", nprobe=64, ef_search=256)
+        assert len(excluded) == 10
+        assert all(r["material_id"] == "mat_far" for r in excluded)
+
+        only = faiss_store.search(far[3], top_k=5, material_id="mat_far", nprobe=64, ef_search=256)
+        assert len(only) == 5
+        assert all(r["material_id"] == "mat_far" for r in only)
+        assert only[0]["text"] == "Far 3"
+
+        assert faiss_store.search(center, top_k=5, material_id="mat_missing") == []
+
+    @pytest.mark.parametrize("kind", [
+        "ivf_flat",
+        pytest.param("ivf_pq", marks=pytest.mark.slow),  # 48 × 256-centroid PQ training
+        "hnsw",
+    ])
+    def test_ann_index_kinds(self, faiss_store, kind):
+        """Every ANN kind can be built from the raw vectors and still finds exact matches."""
+        embeddings = np.random.rand(2000, 384).astype('float32')
+        faiss_store.add(embeddings, [{"text": f"Chunk {i}", "material_id": f"mat_{i % 4}"} for i in range(2000)])
+
+        faiss_store.rebuild_index(kind)
+
+        assert faiss_store.index_kind == kind
+        assert faiss_store.index.ntotal == 2000
+        results = faiss_store.search(embeddings[7], top_k=3, nprobe=64, ef_search=128)
+        assert results[0]["text"] == "Chunk 7"
+
+        faiss_store.delete_by_material("mat_3")
+        results = faiss_store.search(embeddings[7], top_k=20, nprobe=64, ef_search=128)
+        assert all(r["material_id"] != "mat_3" for r in results)
+
+        reloaded = FAISSStore(user_id=faiss_store.user_id).load()
+        assert reloaded.index_kind == kind
+        assert reloaded.search(embeddings[8], top_k=1, nprobe=64)[0]["text"] == "Chunk 8"
+
+    def test_background_promotion(self, monkeypatch, faiss_store):
+        """Crossing a ladder threshold retrains the index on the background compactor."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_INDEX_LADDER", "flat:0,ivf_flat:500")
+
+        embeddings = np.random.rand(600, 384).astype('float32')
+        faiss_store.add(embeddings[:400], [{"text": f"Chunk {i}"} for i in range(400)])
+        assert faiss_store.index_kind == "flat"
+
+        faiss_store.add(embeddings[400:], [{"text": f"Chunk {i}"} for i in range(400, 600)])
+        faiss_store_module._compactor.join()
+
+        assert faiss_store.index_kind == "ivf_flat"
+        assert faiss_store.index.ntotal == 600
+        assert faiss_store.search(embeddings[450], top_k=1, nprobe=32)[0]["text"] == "Chunk 450"
+
+    def test_no_promotion_below_training_size(self, monkeypatch, faiss_store):
+        """A store too small to train the prescribed kind isn't queued for a rebuild after every add."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_INDEX_LADDER", "flat:0,ivf_pq:10")
+        submitted = []
+        monkeypatch.setattr(faiss_store_module._compactor, "submit", lambda *args, **kwargs: submitted.append(args))
+
+        for b in range(3):
+            faiss_store.add(np.random.rand(10, 384).astype('float32'), [{"text": f"B{b} {i}"} for i in range(10)])
+        assert faiss_store.index_kind == "flat" and submitted == []
+
+        faiss_store.add(np.random.rand(10, 384).astype('float32'), [{"text": f"B3 {i}"} for i in range(10)])
+        assert len(submitted) == 1  # 40 vectors: enough for IVF-Flat, still not for PQ
+
+    def test_lexical_search_tracks_adds_and_deletes(self, faiss_store):
+        """BM25 finds exact terms, indexes each add() and drops deleted materials without a rebuild."""
+        faiss_store.add(np.random.rand(3, 384).astype('float32'), [
+            {"chunk_text": "The Krebs cycle produces NADH and FADH2.", "material_id": "bio"},
+            {"chunk_text": "Glycolysis splits glucose into pyruvate.", "material_id": "bio"},
+            {"chunk_text": "TCP uses a three-way handshake.", "material_id": "net"},
+        ])
+        assert faiss_store.lexical_search("what does the krebs cycle make?", top_k=1)[0]["chunk_text"].startswith("The Krebs")
+        assert faiss_store.lexical_search("TCP handshake", top_k=3, exclude_material="net") == []
+
+        faiss_store.add(np.random.rand(1, 384).astype('float32'),
+                        [{"chunk_text": "UDP sends datagrams without any handshake, unlike TCP.", "material_id": "net2"}])
+        hits = faiss_store.lexical_search("TCP handshake", top_k=3)
+        assert [h["material_id"] for h in hits] == ["net", "net2"] and hits[0]["bm25"] > hits[1]["bm25"]
+
+        faiss_store.delete_by_material("net")
+        assert [h["material_id"] for h in faiss_store.lexical_search("TCP handshake", top_k=3)] == ["net2"]
+
+    @pytest.mark.parametrize("pack_max", [2000, 0])  # packed blob and own files
+    def test_lexical_postings_are_saved_with_each_part(self, monkeypatch, pack_max):
+        """A reloaded store answers keyword queries from saved postings, never re-tokenizing chunks."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", pack_max)
+        store = FAISSStore(user_id="bm25_user").load()
+        store.add(np.random.rand(2, 384).astype('float32'), [
+            {"chunk_text": "The Krebs cycle produces NADH.", "material_id": "bio"},
+            {"chunk_text": "TCP uses a three-way handshake.", "material_id": "net"},
+        ])
+        store.add(np.random.rand(1, 384).astype('float32'),
+                  [{"chunk_text": "UDP has no handshake, unlike TCP.", "material_id": "net2"}])
+        store.delete_by_material("net")
+        expected = [(h["material_id"], h["bm25"]) for h in store.lexical_search("TCP handshake", top_k=3)]
+
+        def no_build(*args, **kwargs):
+            raise AssertionError("postings rebuilt on the read path")
+
+        monkeypatch.setattr(faiss_store_module.TablePostings, "build", no_build)
+        faiss_store_module._cache.invalidate("bm25_user")
+        for reloaded in (FAISSStore(user_id="bm25_user").load(), get_store("bm25_user")):
+            hits = reloaded.lexical_search("TCP handshake", top_k=3)
+            assert [(h["material_id"], pytest.approx(h["bm25"])) for h in hits] == expected == [("net2", expected[0][1])]
+
+        store.compact()  # merged postings of the live rows, still without tokenizing
+        faiss_store_module._cache.invalidate("bm25_user")
+        assert [h["material_id"] for h in get_store("bm25_user").lexical_search("krebs", top_k=3)] == ["bio"]
+
+    def test_hybrid_search_fuses_keyword_hits(self, faiss_store):
+        """An exact-term chunk the embedding ranks low still makes the fused top-k, with a cosine score."""
+        query = np.random.rand(384).astype('float32')
+        embeddings = np.stack([query + np.random.rand(384).astype('float32') * 0.1 for _ in range(20)]
+                              + [-query])
+        texts = [f"Generic note {i} about studying" for i in range(20)] + ["Bernoulli's equation relates pressure and speed"]
+        faiss_store.add(embeddings, [{"chunk_text": t, "material_id": "m"} for t in texts])
+
+        assert all("Bernoulli" not in h["chunk_text"] for h in faiss_store.search(query, top_k=3))
+        fused = faiss_store.hybrid_search("Bernoulli equation", query, top_k=3, min_score=0.5)
+        assert len(fused) == 3 and any("Bernoulli" in h["chunk_text"] for h in fused)
+        keyword_hit = next(h for h in fused if "bm25" in h)
+        assert keyword_hit["score"] < 0 and keyword_hit["rrf_score"] > 0
+
+    def test_duplicate_chunks_share_one_vector(self, faiss_store):
+        """Re-uploaded text reuses the existing vector under both materials, until both are deleted."""
+        slides = ["Ohm's law: V = I R.", "Kirchhoff's current law sums currents at a node."]
+        vecs = np.random.rand(3, 384).astype('float32')
+        faiss_store.add(vecs[:2], [{"chunk_text": t, "material_id": "pdf"} for t in slides])
+
+        reupload = ["  ohm's LAW:  v = i r. ", "A corrected note on Thevenin.", "A corrected note on Thevenin."]
+        known = faiss_store.find_duplicates(reupload)
+        assert list(known) == [0]
+        np.testing.assert_allclose(known[0], vecs[0])
+
+        ids = faiss_store.add([known[0], vecs[2], vecs[2]],
+                              [{"chunk_text": t, "material_id": "docx"} for t in reupload])
+        assert ids[0] == "0" and ids[1] == ids[2]
+        assert faiss_store.index.ntotal == 3
+        hit = faiss_store.search(vecs[0], top_k=1, material_id="docx")[0]
+        assert hit["_vector_id"] == "0" and hit["material_id"] == "docx"
+
+        faiss_store.delete_by_material("pdf")
+        assert faiss_store.index.ntotal == 2
+        reloaded = FAISSStore(user_id=faiss_store.user_id).load()
+        assert reloaded.search(vecs[0], top_k=1)[0]["material_id"] == "docx"
+
+        reloaded.delete_by_material("docx")
+        assert reloaded.index.ntotal == 0 and reloaded._manifest["shared"] == {}
+
+    def test_shared_chunks_cite_their_place_in_each_material(self, faiss_store):
+        """A shared chunk reported under another material carries that material's chunk_index and page."""
+        vec = np.random.rand(1, 384).astype('float32')
+        faiss_store.add(vec, [{"chunk_text": "Ohm's law: V = I R.", "material_id": "pdf", "chunk_index": 0, "page": 1}])
+        faiss_store.add(vec, [{"chunk_text": "Ohm's law: V = I R.", "material_id": "docx", "chunk_index": 7, "page": 4}])
+
+        hit = faiss_store.search(vec[0], top_k=1, material_id="docx")[0]
+        assert (hit["material_id"], hit["chunk_index"], hit["page"]) == ("docx", 7, 4)
+        hit = faiss_store.lexical_search("ohm", top_k=1, material_id="pdf")[0]
+        assert (hit["material_id"], hit["chunk_index"], hit["page"]) == ("pdf", 0, 1)
+
+        faiss_store.delete_by_material("pdf")
+        hit = FAISSStore(user_id=faiss_store.user_id).load().search(vec[0], top_k=1)[0]
+        assert (hit["material_id"], hit["chunk_index"], hit["page"]) == ("docx", 7, 4)
+
+    def test_legacy_shared_references_drop_the_place(self, faiss_store):
+        """A reference stored as a bare material ID has no place to cite, so chunk_index and page are dropped."""
+        vec = np.random.rand(1, 384).astype('float32')
+        faiss_store.add(vec, [{"chunk_text": "Ohm's law: V = I R.", "material_id": "pdf", "chunk_index": 0, "page": 1}])
+        faiss_store.add(vec, [{"chunk_text": "Ohm's law: V = I R.", "material_id": "docx", "chunk_index": 7}])
+        faiss_store._manifest["shared"] = {"0": ["docx"]}  # as written before references kept their place
+
+        hit = faiss_store.search(vec[0], top_k=1, material_id="docx")[0]
+        assert hit["material_id"] == "docx" and "chunk_index" not in hit and "page" not in hit
+        faiss_store.delete_by_material("docx")
+        assert faiss_store._manifest["shared"] == {}
+
+    def test_add_takes_float32_arrays_without_touching_them(self, faiss_store):
+        """A float32 batch is indexed as passed: the caller's buffer is neither normalized nor kept."""
+        vecs = np.random.rand(4, 384).astype('float32') * 3
+        before = vecs.copy()
+        faiss_store.add(vecs, [{"chunk_text": f"array chunk {i}", "material_id": "np"} for i in range(4)])
+        vecs[:] = 0  # the pipeline reuses its buffers
+        np.testing.assert_array_equal(faiss_store.find_duplicates(["array chunk 2"])[0], before[2])
+        assert faiss_store.search(before[1], top_k=1)[0]["chunk_text"] == "array chunk 1"
+
+    def test_store_cache_reuse_and_invalidation(self):
+        """get_store returns one shared instance, and writers replace the cached copy."""
+        user_id = f"cache_test_{random.randint(1000, 9999)}"
+        first = get_store(user_id)
+        assert get_store(user_id) is first
+
+        # A write through a separate instance must not leave a stale cached index
+        writer = FAISSStore(user_id=user_id).load()
+        writer.add(np.random.rand(5, 384).astype('float32'), [{"text": f"W{i}"} for i in range(5)])
+        assert get_store(user_id) is writer
+        assert get_store(user_id).index.ntotal == 5
+
+    def test_writers_wait_for_searches(self):
+        """The store's read/write lock lets readers nest and makes a writer wait until they are done."""
+        import threading
+        from tools.faiss_store import _ReadWriteLock  # type: ignore
+        lock, events = _ReadWriteLock(), []
+        reading, release = threading.Event(), threading.Event()
+
+        def reader():
+            with lock.reading(), lock.reading():
+                events.append("read")
+                reading.set()
+                release.wait(5)
+
+        def writer():
+            with lock.writing(), lock.reading():  # the writer may read its own state
+                events.append("write")
+
+        threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+        threads[0].start()
+        reading.wait(5)
+        threads[1].start()
+        time.sleep(0.05)
+        assert events == ["read"]
+        release.set()
+        for t in threads:
+            t.join(5)
+        assert events == ["read", "write"]
+
+    @pytest.mark.parametrize("pack_max", [2000, 0])  # packed blob and own files
+    def test_searches_run_during_disk_writes(self, monkeypatch, pack_max):
+        """A search on the shared store isn't held up by an add's file writes, and never sees the add halfway."""
+        import threading
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", pack_max)
+
+        store = get_store("busy_reader")
+        old = np.random.rand(50, 384).astype('float32')
+        store.add(old, [{"chunk_text": f"Old {i}"} for i in range(50)])
+        new = np.random.rand(5, 384).astype('float32')
+
+        entered, release = threading.Event(), threading.Event()
+        atomic_write = faiss_store_module._atomic_write
+
+        def paused_write(path, write_fn):
+            entered.set()
+            release.wait(5)
+            return atomic_write(path, write_fn)
+
+        if pack_max:
+            pack_write = faiss_store_module._PackShard.write
+
+            def paused_pack(self, user_id, blob):
+                entered.set()
+                release.wait(5)
+                return pack_write(self, user_id, blob)
+
+            monkeypatch.setattr(faiss_store_module._PackShard, "write", paused_pack)
+        else:
+            monkeypatch.setattr(faiss_store_module, "_atomic_write", paused_write)
+        writer = threading.Thread(target=store.add, args=(new, [{"chunk_text": f"New {i}"} for i in range(5)]))
+        writer.start()
+        assert entered.wait(5)
+
+        hits = []
+        reader = threading.Thread(target=lambda: hits.extend(store.search_many(np.stack([old[3], new[0]]), top_k=1)))
+        reader.start()
+        reader.join(5)
+        assert not reader.is_alive(), "search waited for a file write"
+        assert hits[0][0]["chunk_text"] == "Old 3"
+        assert hits[1][0]["chunk_text"] in ("New 0", *(f"Old {i}" for i in range(50)))  # whole, before or after
+        release.set()
+        writer.join(5)
+        assert store.search(new[0], top_k=1)[0]["chunk_text"] == "New 0"
+
+    def test_concurrent_writers_lose_nothing(self, monkeypatch):
+        """Separate store copies (as in separate workers) writing one user's store keep every vector."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", 30)  # cross from pack to own files
+
+        writers = [FAISSStore(user_id="busy_user").load() for _ in range(4)]
+
+        def upload(args):
+            store, n = args
+            for b in range(3):
+                store.add(np.random.rand(4, 384).astype('float32'),
+                          [{"text": f"W{n} B{b}", "material_id": f"mat_{n}_{b}"} for _ in range(4)])
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(upload, [(w, n) for n, w in enumerate(writers)]))
+
+        final = FAISSStore(user_id="busy_user").load()
+        assert final.index.ntotal == 48
+        assert len(final._manifest["materials"]) == 12
+        assert len(set(final.metadata.ids().tolist())) == 48
+
+        # A stale copy catches up before its next write, and get_store() refreshes stale copies
+        writers[0].delete_by_material("mat_3_2")
+        assert writers[1].is_stale()
+        writers[1].refresh()
+        assert writers[1].index.ntotal == 44
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="fcntl locks are POSIX only")
+    def test_concurrent_writer_processes(self):
+        """Writers in separate processes serialize on the advisory file lock."""
+        import multiprocessing
+
+        ctx = multiprocessing.get_context("fork")
+        procs = [ctx.Process(target=_upload_batches, args=("proc_user", n)) for n in range(3)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join(timeout=120)
+            assert p.exitcode == 0
+
+        assert FAISSStore(user_id="proc_user").load().index.ntotal == 3 * 5 * 4
+
+    def test_store_cache_lru_eviction(self):
+        """Least-recently-used users are evicted once the memory budget is exceeded."""
+        from tools.faiss_store import _StoreCache  # type: ignore
+
+        cache = _StoreCache(budget_bytes=15 * 384 * 4)
+        stores = []
+        for n in range(3):
+            store = FAISSStore(user_id=f"lru_{random.randint(1000, 9999)}_{n}").load()
+            store.index.add_with_ids(np.random.rand(10, 384).astype('float32'), np.arange(10))
+            cache.put(store)
+            stores.append(store)
+
+        assert list(cache._stores) == [stores[2].user_id]
+
     @pytest.mark.benchmark
     def test_search_performance(self, faiss_store, benchmark):
         """Benchmark: Search speed with 10k vectors."""
@@ -203,6 +856,80 @@ class TestFAISSStore:
             faiss_store.search(wrong_query, top_k=5)
 
 
+def _tiny_vector(text: str) -> np.ndarray:
+    """Deterministic 8-dim stand-in for a second embedding model."""
+    import zlib
+    return np.random.default_rng(zlib.crc32(text.encode())).random(8).astype('float32')
+
+
+class TestModelMigration:
+    """Stores record their embedding model and are re-embedded onto a new one without downtime."""
+
+    @pytest.mark.parametrize("pack_max", [2000, 0])
+    def test_cut_over_keeps_concurrent_writes(self, monkeypatch, pack_max):
+        """Chunks added or deleted while re-embedding are caught up before the store switches models."""
+        import tools.faiss_store as faiss_store_module  # type: ignore
+        from tools.model_registry import LEGACY_MODEL, EmbeddingModel  # type: ignore
+        monkeypatch.setattr(faiss_store_module, "FAISS_PACK_MAX_VECTORS", pack_max)
+        tiny = EmbeddingModel("tiny-test-model", 8)
+
+        store = FAISSStore(user_id="migrate_user").load()
+        assert store.model == LEGACY_MODEL and store.dim == 384
+        store.add(np.random.rand(30, 384).astype('float32'),
+                  [{"chunk_text": f"old chunk {i}", "material_id": f"m{i % 3}"} for i in range(30)])
+
+        table = store.migration_snapshot()
+        ids = table.ids.copy()
+        vectors = np.stack([_tiny_vector(table.row(i)["chunk_text"]) for i in range(len(table))])
+        built = store.migration_index(tiny, vectors, ids)
+
+        # Uploads and deletions keep landing on the old model meanwhile
+        store.add(np.random.rand(2, 384).astype('float32'),
+                  [{"chunk_text": f"late chunk {c}", "material_id": "late"} for c in "ab"])
+        store.delete_by_material("m1")
+        assert not store.finish_migration(tiny, vectors, ids, built)
+        assert store.model == LEGACY_MODEL
+
+        delta = store.migration_delta(ids)
+        late = [delta.row(i)["chunk_text"] for i in range(len(delta))]
+        assert late == ["late chunk a", "late chunk b"]
+        ids = np.concatenate([ids, delta.ids])
+        vectors = np.concatenate([vectors, np.stack([_tiny_vector(t) for t in late])])
+        assert store.finish_migration(tiny, vectors, ids, built)
+
+        reloaded = FAISSStore(user_id="migrate_user").load()
+        assert reloaded.model == tiny and reloaded.dim == 8 and len(reloaded.metadata) == 22
+        assert faiss_store_module.stored_model("migrate_user") == tiny
+        assert reloaded.search(_tiny_vector("late chunk b"), top_k=1)[0]["chunk_text"] == "late chunk b"
+        assert all(hit["material_id"] != "m1" for hit in reloaded.search(_tiny_vector("old chunk 1"), top_k=30))
+        with pytest.raises(faiss_store_module.ModelChanged):
+            reloaded.add(np.random.rand(1, 384).astype('float32'), [{"chunk_text": "stale"}], model=LEGACY_MODEL)
+
+    def test_background_job_migrates_each_store_once(self, monkeypatch, store_dir):
+        import asyncio
+        import tools.model_migration as model_migration  # type: ignore
+        from tools.model_registry import EmbeddingModel  # type: ignore
+        monkeypatch.setattr(model_migration, "FAISS_INDEX_PATH", str(store_dir))
+        tiny = EmbeddingModel("tiny-test-model", 8)
+        calls = []
+
+        async def embed_texts(texts, model=None, cache=True):
+            assert not cache, "re-embedded chunks went through the embedding cache"
+            calls.append(model)
+            return np.stack([_tiny_vector(t) for t in texts])
+
+        monkeypatch.setattr(model_migration, "embed_texts", embed_texts)
+        get_store("job_user").add(np.random.rand(12, 384).astype('float32'),
+                                  [{"chunk_text": f"job chunk {i}", "material_id": "m"} for i in range(12)])
+
+        assert asyncio.run(model_migration.migrate_stores(["job_user", "no_store_user"], tiny)) == 1
+        assert set(calls) == {"tiny-test-model"}
+        assert get_store("job_user").search(_tiny_vector("job chunk 5"), top_k=1)[0]["chunk_text"] == "job chunk 5"
+        status = model_migration.migration_status()
+        assert status["stores"] == 2 and status["migrated"] == 1 and not status["running"]
+        assert asyncio.run(model_migration.migrate_store("job_user", tiny)) is False
+
+
 class TestFAISSVsAlternatives:
     """Comparative tests: FAISS vs in-memory dict and cloud alternatives."""
     
@@ -13,7 +13,7 @@ import tempfile
 backend_path = Path(__file__).parent.parent.parent / "backend"
 sys.path.insert(0, str(backend_path))
 
-from agents.parser import parse_node  # type: ignore
+from agents.parser import chunk_blocks, iter_blocks, parse_node  # type: ignore
 
 # Mock the missing functions since they're not in the actual parser
 async def parse_document_mock(file_path: str) -> str:
@@ -303,3 +303,95 @@ class TestParsingQuality:
         
         assert "E = mc²" in combined
         assert "√" in combined or "sqrt" in combined.lower()
+
+
+class TestStreamingParser:
+    """The parser reads documents a block at a time and keeps each chunk's page."""
+
+    PARAGRAPH = "Gradient descent updates each weight against the slope of the loss, one small step at a time. "
+
+    def _pdf(self, tmp_path, pages: int):
+        fitz = pytest.importorskip("fitz")
+        doc = fitz.open()
+        for n in range(1, pages + 1):
+            page = doc.new_page()
+            page.insert_textbox(fitz.Rect(40, 40, 560, 800), f"Page {n}. " + self.PARAGRAPH * 2)
+        path = tmp_path / "book.pdf"
+        doc.save(str(path))
+        doc.close()
+        return path
+
+    @pytest.mark.asyncio
+    async def test_pdf_chunks_carry_their_page(self, tmp_path):
+        """Every PDF chunk records the page it was extracted from."""
+        path = self._pdf(tmp_path, 3)
+        state = await parse_node({"file_path": str(path), "filename": "book.pdf"})
+
+        assert state["chunk_pages"] == [1, 2, 3]
+        assert all(c.startswith(f"Page {p}.") for c, p in zip(state["chunks"], state["chunk_pages"]))
+        assert state["metadata"]["chunk_count"] == 3
+
+    def test_blocks_are_read_lazily(self, tmp_path):
+        """Pulling the first chunk extracts only the first page."""
+        path = self._pdf(tmp_path, 50)
+        blocks = iter_blocks(str(path), "pdf")
+        pulled = []
+        chunks = chunk_blocks((pulled.append(page) or (page, text)) for page, text in blocks)
+
+        assert next(chunks)[1] == 1
+        assert pulled == [1]
+        chunks.close()
+
+    def test_text_pages_split_on_form_feeds(self, tmp_path):
+        """Form feeds in text files start a new page; paragraphs keep theirs."""
+        path = tmp_path / "notes.txt"
+        para = self.PARAGRAPH * 2
+        path.write_text(para + "\n\n" + para + "\fshort\n\n" + para + "\n")
+
+        assert [p for _, p in chunk_blocks(iter_blocks(str(path), "txt"))] == [1, 1, 2]
+
+    def test_oversized_paragraphs_are_sentence_split(self):
+        """Paragraphs over 1500 chars become ~800-char pieces on the same page."""
+        chunks = list(chunk_blocks([(7, self.PARAGRAPH * 30)]))
+
+        assert len(chunks) > 1
+        assert all(100 <= len(c) <= 800 and p == 7 for c, p in chunks)
+
+    def test_short_document_becomes_one_chunk(self):
+        """Without any paragraph of 100+ chars, the whole text is kept as one chunk."""
+        blocks = [(1, "Title"), (2, "A short line.\n\nAnother one.")]
+
+        assert list(chunk_blocks(blocks)) == [("Title\n\nA short line.\n\nAnother one.", 1)]
+
+    def test_docx_page_breaks_advance_the_page(self, tmp_path):
+        """Explicit page breaks in a DOCX move the following paragraphs to the next page."""
+        docx = pytest.importorskip("docx")
+        from docx.enum.text import WD_BREAK
+        doc = docx.Document()
+        doc.add_paragraph(self.PARAGRAPH * 2)
+        doc.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+        doc.add_paragraph(self.PARAGRAPH * 3)
+        path = tmp_path / "notes.docx"
+        doc.save(str(path))
+
+        assert [p for _, p in chunk_blocks(iter_blocks(str(path), "docx"))] == [1, 2]
+
+    def test_large_pdfs_extract_page_ranges_in_parallel(self, tmp_path, monkeypatch):
+        """Above PARSE_PARALLEL_PAGES, pages come from the process pool in the same order and text."""
+        import agents.parser as parser  # type: ignore
+        path = self._pdf(tmp_path, 11)
+        serial = list(iter_blocks(str(path), "pdf"))
+
+        monkeypatch.setattr(parser, "PARSE_PARALLEL_PAGES", 8)
+        monkeypatch.setattr(parser, "PARSE_RANGE_PAGES", 3)
+        monkeypatch.setattr(parser, "_workers", 2)
+        parser.shutdown()
+        try:
+            assert parser._executor is None
+            parallel = list(iter_blocks(str(path), "pdf"))
+            assert parser._executor is not None
+        finally:
+            parser.shutdown()
+
+        assert [p for p, _ in parallel] == list(range(1, 12))
+        assert parallel == serial